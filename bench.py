@@ -0,0 +1,392 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import types
+from typing import Any, Callable
+
+import models
+from models import Cliente, Proveedor, Producto, Compra, ModelCursor, _cache_dumps, _cache_loads
+from logistics import LogisticsManager, TRANSPORT_PARAMS, deadline_windows, select_route
+
+# Benchmarks reproducibles del ODM, la caché, la cola de empaquetado y el
+# cálculo de rutas. Con --backend mock todo corre en el proceso con
+# mongomock/fakeredis (sin Neo4j se mide solo la evaluación de rutas en
+# Python); --backend memory cambia mongomock por memory_backend; con
+# --backend live usa los servicios de config.py sobre una base
+# de datos y claves propias. La salida es JSON para comparar entre commits:
+#   python bench.py --output antes.json
+#   python bench.py --output despues.json --compare antes.json
+
+BENCH_QUEUE = "bench_pending_compras"
+BENCH_LABEL = "BenchNetwork"
+# Instante fijo para las ventanas de entrega (resultados reproducibles)
+BENCH_NOW = datetime.datetime(2024, 4, 11, 10, 0)
+# Objetivo de `import models` en un intérprete nuevo (ms, con bytecode en caché)
+IMPORT_TARGET_MS = 100
+
+
+# ---------------------------------------------------------
+# Datos sintéticos deterministas
+
+def _direccion(rng: random.Random) -> dict:
+    return {
+        "calle": f"Calle {rng.randint(1, 500)}", "numero": rng.randint(1, 200),
+        "ciudad": rng.choice(["Madrid", "Sevilla", "Valencia", "Bilbao"]),
+        "codigo_postal": f"{rng.randint(1000, 52999):05d}", "pais": "España",
+        "location": {"type": "Point", "coordinates": [rng.uniform(-9, 3), rng.uniform(36, 43)]},
+    }
+
+
+def _proveedor(rng: random.Random) -> dict:
+    return {"nombre": f"Proveedor {rng.randint(1, 50)}",
+            "direcciones_almacenes": [_direccion(rng) for _ in range(rng.randint(1, 2))]}
+
+
+def _producto(rng: random.Random) -> dict:
+    return {
+        "nombre": f"Producto {rng.randint(1, 1000)}", "codigo_producto_proveedor": f"P{rng.randint(1, 99999)}",
+        "precio": round(rng.uniform(1, 200), 2), "peso": round(rng.uniform(0.1, 20), 2),
+        "dimensiones": {"ancho": rng.randint(1, 100), "alto": rng.randint(1, 100), "profundidad": rng.randint(1, 100)},
+        "proveedores": [_proveedor(rng) for _ in range(rng.randint(1, 2))],
+    }
+
+
+def compra_documents(n: int, seed: int = 0) -> list[dict]:
+    rng = random.Random(seed)
+    start = datetime.datetime(2024, 1, 1)
+    docs = []
+    for _ in range(n):
+        productos = [_producto(rng) for _ in range(rng.randint(1, 4))]
+        docs.append({
+            "productos": productos,
+            "cliente": {"nombre": f"Cliente {rng.randint(1, 500)}", "fecha_alta": start},
+            "precio_compra": round(sum(p["precio"] for p in productos), 2),
+            "fecha_compra": start + datetime.timedelta(minutes=rng.randint(0, 525600)),
+            "direccion_envio": _direccion(rng),
+        })
+    return docs
+
+
+def cliente_instances(n: int, seed: int = 0) -> list[Cliente]:
+    rng = random.Random(seed)
+    return [Cliente(nombre=f"Cliente {i}", fecha_alta=datetime.datetime(2024, 1, 1) + datetime.timedelta(days=rng.randint(0, 365)))
+            for i in range(n)]
+
+
+# ---------------------------------------------------------
+# Entornos
+
+class Backend:
+    def __init__(self, kind: str, db_name: str, redis_db: int):
+        self.kind = kind
+        if kind in ("mock", "memory"):
+            import fakeredis
+            if kind == "mock":
+                import mongomock
+                self.db = mongomock.MongoClient()[db_name]
+            else:
+                import memory_backend
+                self.db = memory_backend.MemoryDatabase(db_name)
+            server = fakeredis.FakeServer()
+            self.r_cache = fakeredis.FakeRedis(server=server, db=0)
+            self.r_queue = fakeredis.FakeRedis(server=server, db=1)
+            self.neo4j = None
+        else:
+            import redis
+            import config
+            import resources
+            self.db = resources.get_database(db_name)
+            # Base lógica propia: reset() no toca la caché ni la cola reales
+            self.r_cache = self.r_queue = redis.Redis(
+                host=config.CACHE_HOST, port=config.CACHE_PORT, username=config.CACHE_USERNAME,
+                password=config.CACHE_PASSWORD, db=redis_db)
+            self.neo4j = resources.get_neo4j_driver()
+        for model in (Cliente, Proveedor, Producto, Compra):
+            model.init_class(self.db[model.__name__.lower()], self.r_cache)
+
+    def reset(self) -> None:
+        for model in (Cliente, Proveedor, Producto, Compra):
+            model.db.delete_many({})
+            for key in self.r_cache.scan_iter(match=f"{model.__name__}:*", count=1000):
+                self.r_cache.delete(key)
+        self.r_queue.delete(BENCH_QUEUE)
+
+
+# ---------------------------------------------------------
+# Medición
+
+def measure(fn: Callable[[], Any], repeat: int, setup: Callable[[], Any] = None) -> list[float]:
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def result(name: str, n: int, times: list[float], **params: Any) -> dict:
+    median = statistics.median(times)
+    return {
+        "name": name, "n": n, "params": params,
+        "seconds": [round(t, 6) for t in times],
+        "median": round(median, 6), "min": round(min(times), 6),
+        "ops_per_sec": round(n / median, 1) if median else None,
+    }
+
+
+def bench_hydration(backend: Backend, n: int, repeat: int) -> list[dict]:
+    docs = compra_documents(n)
+    times = measure(lambda: list(ModelCursor(Compra, docs, from_cache=True)), repeat)
+    return [result("hydration_compra", n, times)]
+
+
+def bench_save(backend: Backend, n: int, repeat: int) -> list[dict]:
+    def save_each():
+        for instance in cliente_instances(n):
+            instance.save()
+
+    def save_bulk():
+        Cliente.save_many(cliente_instances(n))
+
+    return [result("save_cliente", n, measure(save_each, repeat, backend.reset)),
+            result("save_many_cliente", n, measure(save_bulk, repeat, backend.reset))]
+
+
+def bench_find_by_id(backend: Backend, n: int, repeat: int) -> list[dict]:
+    backend.reset()
+    instances = cliente_instances(n)
+    Cliente.save_many(instances)
+    ids = [instance._id for instance in instances]
+
+    def drop_cache():
+        for object_id in ids:
+            Cliente._cache_delete(object_id)
+
+    def lookup():
+        for object_id in ids:
+            Cliente.find_by_id(object_id)
+
+    cold = measure(lookup, repeat, drop_cache)
+    lookup()
+    warm = measure(lookup, repeat)
+    return [result("find_by_id_cold", n, cold), result("find_by_id_warm", n, warm)]
+
+
+def bench_codec(backend: Backend, n: int, repeat: int) -> list[dict]:
+    docs = compra_documents(n)
+    encoded = [_cache_dumps(doc) for doc in docs]
+    size = sum(len(data) for data in encoded)
+    dumps = measure(lambda: [_cache_dumps(doc) for doc in docs], repeat)
+    loads = measure(lambda: [_cache_loads(data) for data in encoded], repeat)
+    return [result("cache_dumps", n, dumps, bytes=size), result("cache_loads", n, loads, bytes=size)]
+
+
+def bench_queue(backend: Backend, n: int, repeat: int, workers: int = 4) -> list[dict]:
+    ids = [f"{i:024x}" for i in range(n)]
+
+    def enqueue():
+        for compra_id in ids:
+            models.enqueue_compra(backend.r_queue, compra_id, queue=BENCH_QUEUE)
+
+    def drain():
+        # Mismo patrón que los servicios de empaquetado, sin el sleep simulado
+        def worker():
+            while backend.r_queue.blpop(BENCH_QUEUE, timeout=1):
+                pass
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    enqueue_times = measure(enqueue, repeat, lambda: backend.r_queue.delete(BENCH_QUEUE))
+    drain_times = measure(drain, repeat, enqueue)
+    # El último blpop de cada hilo espera 1s al timeout: se descuenta
+    drain_times = [max(t - 1.0, 0.0) for t in drain_times]
+    return [result("queue_enqueue", n, enqueue_times),
+            result("queue_drain", n, drain_times, workers=workers)]
+
+
+def _synthetic_paths(size: int, candidates: int, seed: int = 0) -> list:
+    # Caminos City-RouteSegment-City como los que devuelve shortestPath
+    rng = random.Random(seed)
+    paths = []
+    for _ in range(candidates):
+        nodes = [{"name": "C0"}]
+        for hop in range(1, size + 1):
+            nodes.append({"distancia_km": rng.randint(20, 600), "transporte": rng.choice(list(TRANSPORT_PARAMS))})
+            nodes.append({"name": f"C{hop}"})
+        paths.append(types.SimpleNamespace(nodes=nodes))
+    return paths
+
+
+def _build_network(backend: Backend, size: int, seed: int = 0) -> None:
+    # Cadena de `size` ciudades con atajos aleatorios, etiquetada para poder borrarla
+    rng = random.Random(seed)
+    with backend.neo4j.session() as session:
+        session.run(f"MATCH (n:{BENCH_LABEL}) DETACH DELETE n")
+        session.run(f"UNWIND range(0, $size - 1) AS i CREATE (:{BENCH_LABEL} {{name: 'bench-' + i}})", size=size)
+        edges = [(i, i + 1) for i in range(size - 1)]
+        edges += [(rng.randrange(size), rng.randrange(size)) for _ in range(size)]
+        segments = [{"a": a, "b": b, "km": rng.randint(20, 600), "t": rng.choice(list(TRANSPORT_PARAMS))}
+                    for a, b in edges if a != b]
+        session.run(f"""
+            UNWIND $segments AS s
+            MATCH (a:{BENCH_LABEL} {{name: 'bench-' + s.a}}), (b:{BENCH_LABEL} {{name: 'bench-' + s.b}})
+            CREATE (a)-[:SEGMENT]->(:{BENCH_LABEL}:RouteSegment {{distancia_km: s.km, transporte: s.t}})-[:SEGMENT]->(b)
+        """, segments=segments)
+
+
+def bench_routing(backend: Backend, sizes: list[int], repeat: int) -> list[dict]:
+    results = []
+    if backend.neo4j is None:
+        manager = LogisticsManager.__new__(LogisticsManager)
+        for size in sizes:
+            paths = _synthetic_paths(size, candidates=200)
+
+            def evaluate():
+                costs = [manager._calcular_tiempo_coste_ruta(path) for path in paths]
+                valid = [c for c in costs if manager._cumple_restricciones(3, c[0])]
+                valid.sort(key=lambda c: c[1])
+
+            results.append(result("route_evaluation", len(paths), measure(evaluate, repeat), hops=size))
+
+            def evaluate_batch():
+                # Misma selección con las rutas codificadas en arrays y un "now" fijo
+                select_route(paths, 3, deadline_windows(BENCH_NOW))
+
+            results.append(result("route_evaluation_batch", len(paths), measure(evaluate_batch, repeat), hops=size))
+        return results
+
+    manager = LogisticsManager()
+    try:
+        for size in sizes:
+            _build_network(backend, size)
+            times = measure(lambda: manager.get_optimal_route("bench-0", f"bench-{size - 1}", 3), repeat)
+            results.append(result("route_shortest_path", 1, times, cities=size))
+    finally:
+        with backend.neo4j.session() as session:
+            session.run(f"MATCH (n:{BENCH_LABEL}) DETACH DELETE n")
+    return results
+
+
+def _import_time(module: str) -> float:
+    # Tiempo acumulado (s) de importar module según python -X importtime,
+    # desde el directorio del repositorio aunque se lance desde otro
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                               capture_output=True, text=True, check=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    for line in completed.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1]) / 1e6
+    raise RuntimeError(f"importtime no informa de {module}")
+
+
+def bench_import(repeat: int, modules: tuple[str, ...] = ("models",)) -> list[dict]:
+    results = []
+    for module in modules:
+        # La primera importación compila el bytecode y no se cuenta
+        _import_time(module)
+        times = [_import_time(module) for _ in range(repeat)]
+        entry = result("import_time", 1, times, module=module, target_ms=IMPORT_TARGET_MS)
+        entry["within_target"] = entry["median"] * 1000 <= IMPORT_TARGET_MS
+        results.append(entry)
+    return results
+
+
+BENCHMARKS = ["hydration", "save", "find_by_id", "codec", "queue", "routing", "import"]
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(backend_kind: str, n: int, repeat: int, only: list[str], route_sizes: list[int],
+        db_name: str, redis_db: int) -> dict:
+    backend = Backend(backend_kind, db_name, redis_db)
+    results = []
+    for name in only:
+        if name == "hydration":
+            results += bench_hydration(backend, n, repeat)
+        elif name == "save":
+            results += bench_save(backend, n, repeat)
+        elif name == "find_by_id":
+            results += bench_find_by_id(backend, n, repeat)
+        elif name == "codec":
+            results += bench_codec(backend, n, repeat)
+        elif name == "queue":
+            results += bench_queue(backend, n, repeat)
+        elif name == "routing":
+            results += bench_routing(backend, route_sizes, repeat)
+        elif name == "import":
+            results += bench_import(repeat)
+    backend.reset()
+    return {
+        "meta": {
+            "commit": _git_commit(), "backend": backend_kind, "n": n, "repeat": repeat,
+            "python": platform.python_version(), "platform": platform.platform(),
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        },
+        "results": results,
+    }
+
+
+def _result_key(r: dict) -> tuple:
+    # "bytes" es informativo: no identifica el benchmark
+    params = {k: v for k, v in r["params"].items() if k != "bytes"}
+    return r["name"], r["n"], json.dumps(params, sort_keys=True)
+
+
+def compare(current: dict, baseline: dict) -> str:
+    # Cociente de medianas (>1: más lento que la referencia)
+    previous = {_result_key(r): r for r in baseline["results"]}
+    lines = [f"{'benchmark':<32}{'antes':>12}{'ahora':>12}{'ratio':>8}"]
+    for r in current["results"]:
+        old = previous.get(_result_key(r))
+        label = f"{r['name']} n={r['n']}" + "".join(f" {k}={v}" for k, v in r["params"].items() if k != "bytes")
+        if old is None or not old["median"]:
+            lines.append(f"{label:<32}{'-':>12}{r['median']:>12.6f}{'-':>8}")
+        else:
+            lines.append(f"{label:<32}{old['median']:>12.6f}{r['median']:>12.6f}{r['median'] / old['median']:>8.2f}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks del ODM")
+    parser.add_argument("--backend", choices=["mock", "memory", "live"], default="mock")
+    parser.add_argument("-n", type=int, default=1000, help="documentos / operaciones por benchmark")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help="lista separada por comas")
+    parser.add_argument("--route-sizes", default="5,10,20,40")
+    parser.add_argument("--db", default="odm_bench", help="base de datos para --backend live")
+    parser.add_argument("--redis-db", type=int, default=15, help="base lógica de Redis para --backend live")
+    parser.add_argument("--output", help="fichero JSON de salida (por defecto stdout)")
+    parser.add_argument("--compare", help="JSON de una ejecución anterior")
+    args = parser.parse_args()
+
+    report = run(args.backend, args.n, args.repeat, args.only.split(","),
+                 [int(size) for size in args.route_sizes.split(",")], args.db, args.redis_db)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(report, json.load(f)), file=sys.stderr)
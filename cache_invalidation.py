@@ -0,0 +1,206 @@
+import datetime
+import logging
+import threading
+import time
+from typing import Any, Iterable, Type
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from models import Model, Cliente, Producto, Compra, Proveedor, init_app, _cache_dumps
+
+# Worker de invalidación de caché dirigido por change streams. Sigue las
+# colecciones de los modelos, agrupa los eventos en lotes y borra (o
+# refresca) las claves Class:<id> afectadas y las Class:query:* que lista
+# Class:queries, de modo que las escrituras que no pasan por Model.save()
+# (notebook, mongoimport, otros servicios) no dejan la caché desfasada 24h. El resume token se persiste
+# en Mongo para continuar tras un reinicio.
+logger = logging.getLogger(__name__)
+
+TOKEN_COLLECTION = "_resume_tokens"
+# Código de Mongo cuando el resume token ya no está en el oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+class CacheInvalidationWorker:
+    def __init__(self, models: Iterable[Type[Model]] = None, name: str = "cache_invalidation",
+                 batch_size: int = 500, max_wait: float = 1.0, refresh: bool = False,
+                 views: Iterable[Any] = ()):
+        self.models = list(models or [Cliente, Producto, Compra, Proveedor])
+        self.name = name
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        # refresh=True reescribe Class:<id> con el documento nuevo en vez de borrarlo
+        self.refresh = refresh
+        self.views = list(views)
+        self._by_collection = {m.db.name: m for m in self.models}
+        self._stop = threading.Event()
+        self._thread = None
+        self._saved_token = None
+        self.metrics = {
+            'events_total': 0,
+            'batches_total': 0,
+            'keys_deleted_total': 0,
+            'keys_refreshed_total': 0,
+            'lag_seconds': 0.0,
+            'max_lag_seconds': 0.0,
+            'last_flush_at': None,
+        }
+
+    @property
+    def database(self):
+        return self.models[0].db.database
+
+    # -- resume token ---------------------------------------------------
+    def _load_token(self):
+        state = self.database[TOKEN_COLLECTION].find_one({'_id': self.name})
+        self._saved_token = state['token'] if state else None
+        return self._saved_token
+
+    def _save_token(self, token) -> None:
+        # Los sondeos sin eventos devuelven el mismo token: solo se escribe si cambia
+        if token is None or token == self._saved_token:
+            return
+        self.database[TOKEN_COLLECTION].update_one(
+            {'_id': self.name},
+            {'$set': {'token': token, 'updated_at': datetime.datetime.now(datetime.timezone.utc)}},
+            upsert=True)
+        self._saved_token = token
+
+    # -- procesamiento ----------------------------------------------------
+    def _watch(self, token):
+        pipeline = [{'$match': {
+            'ns.coll': {'$in': list(self._by_collection)},
+            'operationType': {'$in': ['insert', 'update', 'replace', 'delete']},
+        }}]
+        full_document = 'updateLookup' if self.refresh or self.views else None
+        return self.database.watch(pipeline, resume_after=token, full_document=full_document,
+                                   max_await_time_ms=int(self.max_wait * 1000))
+
+    def _lag(self, event: dict) -> float:
+        wall_time = event.get('wallTime')
+        if wall_time is not None:
+            event_time = wall_time.replace(tzinfo=datetime.timezone.utc).timestamp()
+        else:
+            event_time = event['clusterTime'].time
+        return max(0.0, time.time() - event_time)
+
+    def flush(self, events: list[dict], token=None) -> None:
+        if not events:
+            self._save_token(token)
+            return
+        changed: dict[Type[Model], dict] = {}
+        for event in events:
+            model = self._by_collection.get(event['ns']['coll'])
+            if model is None:
+                continue
+            entry = changed.setdefault(model, {'ids': set(), 'docs': {}, 'deleted': set()})
+            object_id = event['documentKey']['_id']
+            entry['ids'].add(object_id)
+            if event['operationType'] == 'delete':
+                entry['deleted'].add(object_id)
+                entry['docs'].pop(object_id, None)
+            elif event.get('fullDocument') is not None:
+                entry['deleted'].discard(object_id)
+                entry['docs'][object_id] = event['fullDocument']
+
+        for model, entry in changed.items():
+            self._invalidate_model(model, entry)
+            for view in self.views:
+                if view.source is model:
+                    view.apply_documents(list(entry['docs'].values()))
+                    view.remove_documents(list(entry['deleted']))
+
+        lag = self._lag(events[-1])
+        self.metrics['events_total'] += len(events)
+        self.metrics['batches_total'] += 1
+        self.metrics['lag_seconds'] = lag
+        self.metrics['max_lag_seconds'] = max(self.metrics['max_lag_seconds'], lag)
+        self.metrics['last_flush_at'] = time.time()
+        # El token se guarda después de aplicar el lote: si el proceso cae
+        # a mitad, el lote se repite (invalidar dos veces es inocuo)
+        self._save_token(token)
+
+    def _invalidate_model(self, model: Type[Model], entry: dict) -> None:
+        r_cache = model.r_cache
+        if not r_cache:
+            return
+        pipe = r_cache.pipeline(transaction=False)
+        deleted = refreshed = 0
+        for object_id in entry['ids']:
+            doc = entry['docs'].get(object_id)
+            if self.refresh and doc is not None:
+                pipe.setex(model._cache_key(str(object_id)), model._cache_ttl, _cache_dumps(doc))
+                refreshed += 1
+            else:
+                pipe.delete(model._cache_key(str(object_id)))
+                deleted += 1
+        # Las consultas cacheadas no se pueden asociar a ids: cualquier cambio
+        # en la colección invalida todas las de ese modelo (una vez por lote).
+        # Leer y vaciar el conjunto es atómico; las consultas que se guarden
+        # después van a un conjunto nuevo
+        claim = r_cache.pipeline(transaction=True)
+        claim.smembers(model._cache_query_set_key())
+        claim.delete(model._cache_query_set_key())
+        keys, _ = claim.execute()
+        for key in keys:
+            pipe.delete(key)
+            deleted += 1
+        pipe.execute()
+        self.metrics['keys_deleted_total'] += deleted
+        self.metrics['keys_refreshed_total'] += refreshed
+
+    def run(self) -> None:
+        token = self._load_token()
+        while not self._stop.is_set():
+            try:
+                with self._watch(token) as stream:
+                    batch, batch_started = [], time.monotonic()
+                    while not self._stop.is_set() and stream.alive:
+                        event = stream.try_next()
+                        if event is not None:
+                            if not batch:
+                                batch_started = time.monotonic()
+                            batch.append(event)
+                        expired = batch and time.monotonic() - batch_started >= self.max_wait
+                        if len(batch) >= self.batch_size or expired or (event is None and not batch):
+                            token = stream.resume_token
+                            self.flush(batch, token)
+                            batch = []
+                    if batch:
+                        token = stream.resume_token
+                        self.flush(batch, token)
+            except OperationFailure as e:
+                if e.code != CHANGE_STREAM_HISTORY_LOST:
+                    raise
+                # El token es demasiado antiguo: se reinicia el stream y se
+                # invalida todo para no servir datos de la ventana perdida
+                logger.warning("Resume token caducado: invalidando toda la caché de los modelos")
+                token = None
+                for model in self.models:
+                    self._invalidate_model(model, {'ids': set(), 'docs': {}})
+                for view in self.views:
+                    view.invalidate()
+            except PyMongoError as e:
+                logger.warning(f"Change stream interrumpido, reintentando: {e}")
+                self._stop.wait(1.0)
+
+    def start(self) -> threading.Thread:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self, timeout: float = None) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+
+if __name__ == "__main__":
+    import views
+    init_app()
+    worker = CacheInvalidationWorker(views=views.VIEWS.values())
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        print(worker.metrics)
@@ -0,0 +1,186 @@
+import logging
+import threading
+from typing import Any, Callable
+
+import config
+import instrumentation
+
+# Cortocircuito de la caché de Redis. Tras varios fallos seguidos de
+# conexión o timeout se abre y el ODM deja de usar la caché (las lecturas
+# van directas a Mongo) sin esperar a Redis. Mientras está abierto, un
+# hilo en segundo plano sondea Redis con PING, con espera creciente, y lo
+# cierra al recuperarse. Las invalidaciones que no se pudieron hacer
+# (claves de objetos escritos con la caché caída) se guardan y se borran
+# al cerrar, para no servir copias antiguas.
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+_STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+# Invalidaciones pendientes como máximo; por encima se descartan (y se avisa)
+MAX_DEFERRED = 10000
+
+
+def is_unavailable(error: BaseException) -> bool:
+    # Solo cuentan los fallos de disponibilidad; los errores de uso se propagan
+    from redis.exceptions import ConnectionError, TimeoutError
+    return isinstance(error, (ConnectionError, TimeoutError, OSError))
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, client: Any, failure_threshold: int = 3, reset_timeout: float = 2.0,
+                 max_reset_timeout: float = 30.0):
+        self.name = name
+        self.client = client
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._state = CLOSED
+        self._failures = 0
+        self._deferred: set[str] = set()
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._probe_thread = None
+        self._stop = threading.Event()
+        instrumentation.CACHE_BREAKER_STATE.set(0, cache=name)
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def allow(self) -> bool:
+        return self._state == CLOSED
+
+    def record_success(self) -> None:
+        if self._failures:
+            with self._lock:
+                self._failures = 0
+
+    def record_failure(self, error: BaseException) -> None:
+        instrumentation.CACHE_ERRORS.inc(cache=self.name)
+        with self._lock:
+            self._failures += 1
+            if self._state != CLOSED or self._failures < self.failure_threshold:
+                return
+            self._set_state(OPEN)
+            logger.warning(f"Caché {self.name} desactivada tras {self._failures} fallos seguidos: {error}")
+            if self._probe_thread is None or not self._probe_thread.is_alive():
+                self._stop.clear()
+                self._probe_thread = threading.Thread(target=self._probe_loop, name=f"breaker-{self.name}",
+                                                      daemon=True)
+                self._probe_thread.start()
+
+    def call(self, operation: str, fn: Callable[[], Any], default: Any = None, model: str = '') -> Any:
+        # fn() si la caché está disponible; default si está abierto o falla
+        if self._state != CLOSED:
+            instrumentation.CACHE_BYPASSED.inc(cache=self.name, operation=operation, model=model)
+            return default
+        try:
+            result = fn()
+        except Exception as e:
+            if not is_unavailable(e):
+                raise
+            self.record_failure(e)
+            return default
+        self.record_success()
+        return result
+
+    async def acall(self, operation: str, fn: Callable[[], Any], default: Any = None, model: str = '') -> Any:
+        # Igual que call() con una corrutina: fn() devuelve el awaitable
+        if self._state != CLOSED:
+            instrumentation.CACHE_BYPASSED.inc(cache=self.name, operation=operation, model=model)
+            return default
+        try:
+            result = await fn()
+        except Exception as e:
+            if not is_unavailable(e):
+                raise
+            self.record_failure(e)
+            return default
+        self.record_success()
+        return result
+
+    def defer_delete(self, keys: list[str]) -> None:
+        # Claves que se borrarán al recuperar la caché
+        with self._lock:
+            for key in keys:
+                if len(self._deferred) >= MAX_DEFERRED:
+                    self._dropped += 1
+                else:
+                    self._deferred.add(key)
+
+    def _set_state(self, state: str) -> None:
+        # Llamar con self._lock tomado
+        self._state = state
+        instrumentation.CACHE_BREAKER_STATE.set(_STATE_VALUES[state], cache=self.name)
+        instrumentation.CACHE_BREAKER_TRANSITIONS.inc(cache=self.name, state=state)
+
+    def _probe_loop(self) -> None:
+        delay = self.reset_timeout
+        while not self._stop.wait(delay):
+            with self._lock:
+                self._set_state(HALF_OPEN)
+            try:
+                self.client.ping()
+                self._flush()
+            except Exception as e:
+                with self._lock:
+                    self._set_state(OPEN)
+                delay = min(delay * 2, self.max_reset_timeout)
+                logger.debug(f"Caché {self.name} sigue sin responder: {e}")
+                continue
+            with self._lock:
+                self._failures = 0
+                self._set_state(CLOSED)
+            logger.warning(f"Caché {self.name} recuperada")
+            try:
+                # Las invalidaciones aplazadas mientras se sondeaba
+                self._flush()
+            except Exception as e:
+                if is_unavailable(e):
+                    self.record_failure(e)
+            return
+
+    def _flush(self) -> None:
+        with self._lock:
+            keys, self._deferred = list(self._deferred), set()
+            dropped, self._dropped = self._dropped, 0
+        try:
+            for start in range(0, len(keys), 1000):
+                self.client.delete(*keys[start:start + 1000])
+        except Exception:
+            self.defer_delete(keys)
+            raise
+        if dropped:
+            logger.warning(f"Caché {self.name}: {dropped} invalidaciones descartadas durante la caída; "
+                           f"puede haber copias antiguas hasta que caduquen")
+
+    def close(self) -> None:
+        self._stop.set()
+
+
+_lock = threading.Lock()
+_breakers: dict[int, tuple[Any, CircuitBreaker]] = {}
+
+
+def for_client(client: Any, **options: Any) -> CircuitBreaker:
+    # Un cortocircuito por cliente de Redis (los modelos comparten el de la caché)
+    key = id(client)
+    with _lock:
+        entry = _breakers.get(key)
+        if entry is None or entry[0] is not client:
+            pool = getattr(client, "connection_pool", None)
+            db = getattr(pool, "connection_kwargs", {}).get("db", 0)
+            options.setdefault("failure_threshold", config.CACHE_BREAKER_FAILURES)
+            options.setdefault("reset_timeout", config.CACHE_BREAKER_RESET)
+            entry = _breakers[key] = (client, CircuitBreaker(f"redis:{db}", client, **options))
+        return entry[1]
+
+
+def close_all() -> None:
+    with _lock:
+        for _, breaker in _breakers.values():
+            breaker.close()
+        _breakers.clear()
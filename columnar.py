@@ -0,0 +1,317 @@
+import argparse
+import json
+import os
+import time
+from typing import Any, Iterable, Iterator
+
+from bson import ObjectId, json_util
+
+# Exportación e importación de colecciones a ficheros columnares (Parquet o
+# Arrow IPC) por lotes, sin pasar por los modelos ni por listas completas en
+# memoria. Los documentos se aplanan a columnas con rutas:
+#   cliente.nombre                  subdocumento
+#   productos[].precio              lista con un valor por elemento de productos
+#   productos[].proveedores[].nombre  lista de listas
+#   direccion_envio.location.coordinates
+# Las columnas que contenían ObjectId se guardan como texto y se marcan en
+# los metadatos del esquema para reconstruirlos al importar. pyarrow es
+# opcional: solo se importa al usar este módulo.
+
+FORMATS = {".parquet": "parquet", ".pq": "parquet", ".arrow": "arrow", ".feather": "arrow", ".ipc": "arrow"}
+_OBJECT_ID_KEY = b"odm.object_id_columns"
+
+
+def _arrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+    except ImportError as e:
+        raise ImportError("La exportación columnar necesita pyarrow (pip install pyarrow)") from e
+    return pyarrow
+
+
+def _format(path: str, format: str = None) -> str:
+    if format is not None:
+        if format not in ("parquet", "arrow"):
+            raise ValueError(f"Formato desconocido: {format}")
+        return format
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError(f"No se deduce el formato de {path}: usa .parquet o .arrow, o indica format")
+    return FORMATS[extension]
+
+
+# ---------------------------------------------------------
+# Aplanado
+
+def _flatten(value: Any, column: str, out: dict, object_ids: set) -> None:
+    if isinstance(value, dict):
+        for key, item in value.items():
+            _flatten(item, f"{column}.{key}" if column else key, out, object_ids)
+    elif isinstance(value, list) and any(isinstance(item, dict) for item in value):
+        # Lista de subdocumentos: una columna de listas por cada campo
+        rows, nested_ids = [], set()
+        for item in value:
+            row = {}
+            if isinstance(item, dict):
+                _flatten(item, "", row, nested_ids)
+            rows.append(row)
+        for key in dict.fromkeys(key for row in rows for key in row):
+            out[f"{column}[].{key}"] = [row.get(key) for row in rows]
+        object_ids.update(f"{column}[].{key}" for key in nested_ids)
+    elif isinstance(value, ObjectId):
+        out[column] = str(value)
+        object_ids.add(column)
+    elif isinstance(value, list) and any(isinstance(item, ObjectId) for item in value):
+        out[column] = [str(item) if isinstance(item, ObjectId) else item for item in value]
+        object_ids.add(column)
+    else:
+        out[column] = value
+
+
+def flatten(document: dict, object_ids: set = None) -> dict:
+    # Documento de Mongo -> fila plana {columna: valor}
+    out = {}
+    _flatten(document, "", out, object_ids if object_ids is not None else set())
+    return out
+
+
+def _set_path(document: dict, path: list[str], value: Any) -> None:
+    for key in path[:-1]:
+        document = document.setdefault(key, {})
+    document[path[-1]] = value
+
+
+def _to_object_ids(value: Any) -> Any:
+    if isinstance(value, list):
+        return [_to_object_ids(item) for item in value]
+    return ObjectId(value) if isinstance(value, str) else value
+
+
+def unflatten(row: dict, object_ids: Iterable[str] = ()) -> dict:
+    # Fila plana -> documento. Los nulos se omiten (campo ausente)
+    object_ids = set(object_ids)
+    document, lists = {}, {}
+    for column, value in row.items():
+        if value is None:
+            continue
+        if column in object_ids:
+            value = _to_object_ids(value)
+        head, sep, rest = column.partition("[].")
+        if sep:
+            lists.setdefault(head, {})[rest] = value
+        else:
+            _set_path(document, column.split("."), value)
+    for head, columns in lists.items():
+        length = max(len(values) for values in columns.values())
+        items = [unflatten({rest: values[i] if i < len(values) else None for rest, values in columns.items()})
+                 for i in range(length)]
+        _set_path(document, head.split("."), items)
+    return document
+
+
+# ---------------------------------------------------------
+# Exportación
+
+def _collection(source: Any):
+    # Acepta una clase Model o una colección de pymongo (collection.db
+    # sería la subcolección "<nombre>.db")
+    return source.db if isinstance(source, type) else source
+
+
+def _source_cursor(collection, filter: dict = None, pipeline: list = None, projection: dict = None,
+                   batch_size: int = 10000):
+    if pipeline is not None:
+        if hasattr(pipeline, "to_list"):
+            pipeline = pipeline.to_list()
+        return collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+    return collection.find(filter or {}, projection, batch_size=batch_size)
+
+
+def _batches(documents: Iterable[dict], batch_size: int) -> Iterator[list[dict]]:
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _infer_schema(pa, rows: list[dict], object_ids: set):
+    schema = pa.Table.from_pylist(rows).schema
+    # Las columnas nulas en el primer lote se exportan como texto
+    fields = []
+    for field in schema:
+        field_type = field.type
+        if pa.types.is_null(field_type):
+            field_type = pa.string()
+        elif pa.types.is_list(field_type) and pa.types.is_null(field_type.value_type):
+            field_type = pa.list_(pa.string())
+        fields.append(pa.field(field.name, field_type))
+    return pa.schema(fields, metadata={_OBJECT_ID_KEY: json.dumps(sorted(object_ids)).encode()})
+
+
+def write_documents(documents: Iterable[dict], path: str, format: str = None, batch_size: int = 10000,
+                    schema=None, compression: str = "zstd") -> dict:
+    """
+    Escribe los documentos en path por lotes de batch_size. El esquema
+    se deduce del primer lote salvo que se indique uno (pyarrow.Schema).
+    Con el esquema deducido, un lote posterior con columnas nuevas lanza
+    ValueError en vez de perderlas; con uno explícito se descartan.
+    """
+    pa = _arrow()
+    format = _format(path, format)
+    writer, rows_written, batches = None, 0, 0
+    object_ids: set = set()
+    inferred = schema is None
+    started = time.perf_counter()
+    try:
+        for batch in _batches(documents, batch_size):
+            rows = [flatten(document, object_ids) for document in batch]
+            if writer is None:
+                if schema is None:
+                    schema = _infer_schema(pa, rows, object_ids)
+                if format == "parquet":
+                    writer = pa.parquet.ParquetWriter(path, schema, compression=compression)
+                else:
+                    writer = pa.ipc.new_file(path, schema)
+            elif inferred:
+                unknown = set().union(*rows) - set(schema.names)
+                if unknown:
+                    raise ValueError(f"El lote {batches} trae columnas que no están en el esquema deducido del "
+                                     f"primero: {', '.join(sorted(unknown))}; indica el esquema con schema=")
+            try:
+                table = pa.Table.from_pylist(rows, schema=schema)
+            except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+                raise ValueError(f"El lote {batches} no encaja en el esquema deducido del primero ({e}); "
+                                 f"indica el esquema con schema=") from e
+            writer.write_table(table)
+            rows_written += len(rows)
+            batches += 1
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise ValueError("No hay documentos que exportar")
+    seconds = time.perf_counter() - started
+    return {"path": path, "format": format, "rows": rows_written, "batches": batches,
+            "columns": len(schema), "bytes": os.path.getsize(path), "seconds": round(seconds, 3)}
+
+
+def export(source: Any, path: str, filter: dict = None, pipeline: list = None, projection: dict = None,
+           format: str = None, batch_size: int = 10000, **options: Any) -> dict:
+    """
+    Exporta una colección (clase Model o colección de pymongo), el
+    resultado de un find (filter/projection) o el de un aggregate
+    (pipeline) a Parquet o Arrow IPC.
+    """
+    cursor = _source_cursor(_collection(source), filter, pipeline, projection, batch_size)
+    try:
+        return write_documents(cursor, path, format=format, batch_size=batch_size, **options)
+    finally:
+        cursor.close()
+
+
+# ---------------------------------------------------------
+# Lectura e importación
+
+def read(path: str, format: str = None, columns: list[str] = None, memory_map: bool = True):
+    """
+    Lee el fichero como pyarrow.Table. Con memory_map los ficheros Arrow
+    IPC se leen sin copiar (los buffers apuntan al fichero mapeado);
+    table.to_pandas() sobre el resultado evita pasar por listas de dicts.
+    """
+    pa = _arrow()
+    if _format(path, format) == "parquet":
+        return pa.parquet.read_table(path, columns=columns, memory_map=memory_map)
+    source = pa.memory_map(path, "r") if memory_map else pa.OSFile(path, "rb")
+    table = pa.ipc.open_file(source).read_all()
+    return table.select(columns) if columns else table
+
+
+def _object_id_columns(schema) -> set[str]:
+    metadata = schema.metadata or {}
+    return set(json.loads(metadata.get(_OBJECT_ID_KEY, b"[]")))
+
+
+def iter_documents(path: str, format: str = None, batch_size: int = 10000,
+                   memory_map: bool = True) -> Iterator[list[dict]]:
+    # Devuelve los documentos reconstruidos por lotes
+    pa = _arrow()
+    if _format(path, format) == "parquet":
+        parquet_file = pa.parquet.ParquetFile(path, memory_map=memory_map)
+        object_ids = _object_id_columns(parquet_file.schema_arrow)
+        record_batches = parquet_file.iter_batches(batch_size=batch_size)
+    else:
+        source = pa.memory_map(path, "r") if memory_map else pa.OSFile(path, "rb")
+        reader = pa.ipc.open_file(source)
+        object_ids = _object_id_columns(reader.schema)
+        record_batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+    for record_batch in record_batches:
+        # Los lotes IPC conservan el tamaño con el que se escribieron
+        for offset in range(0, record_batch.num_rows, batch_size):
+            rows = record_batch.slice(offset, batch_size).to_pylist()
+            yield [unflatten(row, object_ids) for row in rows]
+
+
+def import_file(path: str, target: Any, format: str = None, batch_size: int = 10000) -> dict:
+    """
+    Inserta los documentos del fichero en la colección (clase Model o
+    colección de pymongo) con insert_many por lotes. Los _id que ya
+    existen se cuentan como omitidos, así que se puede relanzar.
+    """
+    from pymongo.errors import BulkWriteError
+
+    collection = _collection(target)
+    inserted = skipped = 0
+    started = time.perf_counter()
+    for documents in iter_documents(path, format=format, batch_size=batch_size):
+        try:
+            inserted += len(collection.insert_many(documents, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            duplicates = sum(1 for error in e.details["writeErrors"] if error["code"] == 11000)
+            if duplicates != len(e.details["writeErrors"]):
+                raise
+            inserted += e.details["nInserted"]
+            skipped += duplicates
+    seconds = time.perf_counter() - started
+    return {"path": path, "collection": collection.name, "inserted": inserted, "skipped": skipped,
+            "seconds": round(seconds, 3),
+            "inserts_per_sec": round(inserted / seconds, 1) if seconds else None}
+
+
+if __name__ == "__main__":
+    import resources
+
+    parser = argparse.ArgumentParser(description="Exporta/importa colecciones a Parquet o Arrow IPC")
+    parser.add_argument("--db", default=None, help="base de datos (por defecto DB_NAME)")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--format", choices=["parquet", "arrow"], default=None)
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export")
+    export_parser.add_argument("collection")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--filter", help="filtro en JSON extendido")
+    export_parser.add_argument("--projection", help="proyección en JSON")
+    export_parser.add_argument("--pipeline", help="fichero JSON con el pipeline de agregación")
+    import_parser = commands.add_parser("import")
+    import_parser.add_argument("path")
+    import_parser.add_argument("collection")
+    args = parser.parse_args()
+
+    db = resources.get_database(args.db)
+    if args.command == "export":
+        pipeline = None
+        if args.pipeline:
+            with open(args.pipeline) as f:
+                pipeline = json_util.loads(f.read())
+        report = export(db[args.collection], args.path,
+                        filter=json_util.loads(args.filter) if args.filter else None,
+                        projection=json.loads(args.projection) if args.projection else None,
+                        pipeline=pipeline, format=args.format, batch_size=args.batch_size)
+    else:
+        report = import_file(args.path, db[args.collection], format=args.format, batch_size=args.batch_size)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
@@ -1,22 +1,142 @@
-from dotenv import load_dotenv
 import os
+import threading
 
-# Cargar las variables de entorno desde el archivo .env
-load_dotenv()
-
-# Extraer las variables necesarias
-#Database
-DB_PASSWORD = os.getenv("DB_PASSWORD")
-DB_USERNAME = os.getenv("DB_USERNAME")
-URL_SERVER = os.getenv("URL_SERVER")
-DB_NAME = os.getenv("DB_NAME")
-URL_DB = f"mongodb+srv://{DB_USERNAME}:{DB_PASSWORD}{URL_SERVER}"
-#Cache
-CACHE_HOST = os.getenv("CACHE_HOST")
-CACHE_PORT = int(os.getenv("CACHE_PORT"))
-CACHE_USERNAME = os.getenv("CACHE_USERNAME")
-CACHE_PASSWORD = os.getenv("CACHE_PASSWORD")
-#Neo4J
-NEO4J_URI = os.getenv("NEO4J_URI")
-NEO4J_USER = os.getenv("NEO4J_USER")
-NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD")
\ No newline at end of file
+# Configuración perezosa: nada se lee al importar el módulo. La primera
+# vez que se pide un valor (config.CACHE_PORT, from config import ...) se
+# carga el .env, se valida esa variable y se guarda su valor. Una variable
+# con un valor inválido lanza ValueError con su nombre, en lugar de
+# romper la importación de todo el ODM.
+
+
+def _int(value: str) -> int:
+    return int(value)
+
+
+def _float(value: str) -> float:
+    return float(value)
+
+
+def _flag(value: str) -> bool:
+    return value.lower() in ("1", "true", "yes")
+
+
+def _threshold(value: str) -> float:
+    # Vacío desactiva el umbral
+    return float(value or "inf")
+
+
+def _backend(value: str) -> str:
+    # mongo, o memory para el almacenamiento en proceso de memory_backend
+    if value not in ("mongo", "memory"):
+        raise ValueError(value)
+    return value
+
+
+# Nombre -> (valor por defecto, conversión)
+_SETTINGS = {
+    #Database
+    "DB_PASSWORD": (None, None),
+    "DB_USERNAME": (None, None),
+    "URL_SERVER": (None, None),
+    "DB_NAME": (None, None),
+    "STORAGE_BACKEND": ("mongo", _backend),
+    #Cache
+    "CACHE_HOST": ("localhost", None),
+    "CACHE_PORT": ("6379", _int),
+    "CACHE_USERNAME": (None, None),
+    "CACHE_PASSWORD": (None, None),
+    #Neo4J
+    "NEO4J_URI": (None, None),
+    "NEO4J_USER": (None, None),
+    "NEO4J_PASSWORD": (None, None),
+    #Pools, timeouts y health checks
+    "MONGO_MAX_POOL_SIZE": ("50", _int),
+    "MONGO_MIN_POOL_SIZE": ("0", _int),
+    "MONGO_CONNECT_TIMEOUT_MS": ("10000", _int),
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": ("10000", _int),
+    "CACHE_DB": ("0", _int),
+    "QUEUE_DB": ("1", _int),
+    "CACHE_MAX_CONNECTIONS": ("50", _int),
+    # La caché falla rápido (la consulta sigue en Mongo); la cola puede esperar
+    "CACHE_POOL_TIMEOUT": ("0.5", _float),
+    "QUEUE_POOL_TIMEOUT": ("20", _float),
+    "CACHE_SOCKET_TIMEOUT": ("0.25", _float),
+    "CACHE_CONNECT_TIMEOUT": ("0.5", _float),
+    "CACHE_HEALTH_CHECK_INTERVAL": ("30", _int),
+    # Cortocircuito de la caché: fallos seguidos para abrirlo y primer sondeo (s)
+    "CACHE_BREAKER_FAILURES": ("3", _int),
+    "CACHE_BREAKER_RESET": ("2", _float),
+    # Vacío para no tocar la configuración del servidor (Redis gestionado)
+    "CACHE_MAXMEMORY": ("150mb", None),
+    "CACHE_MAXMEMORY_POLICY": ("volatile-ttl", None),
+    "NEO4J_MAX_POOL_SIZE": ("50", _int),
+    "NEO4J_CONNECTION_TIMEOUT": ("15", _float),
+    "NEO4J_ACQUISITION_TIMEOUT": ("60", _float),
+    "NEO4J_LIVENESS_CHECK_TIMEOUT": ("30", _float),
+    #Instrumentación
+    "INSTRUMENTATION": ("0", _flag),
+    #Agregados en escritura (rollups.py) activados por init_app
+    "ROLLUPS": ("0", _flag),
+    # Umbral del log de consultas lentas (ms); vacío lo desactiva
+    "SLOW_QUERY_MS": ("100", _threshold),
+}
+
+_lock = threading.Lock()
+_values: dict = {}
+_env_loaded = False
+
+
+def _load_env() -> None:
+    global _env_loaded
+    if _env_loaded:
+        return
+    with _lock:
+        if not _env_loaded:
+            # Cargar las variables de entorno desde el archivo .env
+            from dotenv import load_dotenv
+            load_dotenv()
+            _env_loaded = True
+
+
+def _read(name: str):
+    default, parse = _SETTINGS[name]
+    raw = os.getenv(name)
+    # Un número vacío cuenta como no definido (CACHE_MAXMEMORY="" sí es un valor)
+    if raw is None or (raw == "" and parse in (_int, _float)):
+        raw = default
+    if raw is None or parse is None:
+        return raw
+    try:
+        return parse(raw)
+    except ValueError:
+        raise ValueError(f"Valor inválido para {name}: {raw!r}") from None
+
+
+def __getattr__(name: str):
+    if name == "URL_DB":
+        return f"mongodb+srv://{__getattr__('DB_USERNAME')}:{__getattr__('DB_PASSWORD')}{__getattr__('URL_SERVER')}"
+    if name not in _SETTINGS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    try:
+        return _values[name]
+    except KeyError:
+        _load_env()
+        value = _values[name] = _read(name)
+        return value
+
+
+def __dir__() -> list[str]:
+    return sorted(list(globals()) + list(_SETTINGS) + ["URL_DB"])
+
+
+def reload() -> None:
+    # Vuelve a leer el entorno en el siguiente acceso (tests, cambios del .env)
+    global _env_loaded
+    with _lock:
+        _values.clear()
+        _env_loaded = False
+
+
+def validate() -> dict:
+    # Lee y valida todas las variables de una vez (útil al arrancar un servicio)
+    return {name: __getattr__(name) for name in _SETTINGS}
@@ -0,0 +1,172 @@
+import argparse
+import datetime
+import logging
+import time
+from typing import Type
+
+from models import Model, Compra, enqueue_compras, init_app
+
+# Despacho diario por almacén (sustituye a la consulta 10 del notebook, que
+# calculaba un almacén y una fecha cada vez). Una pasada por las compras
+# del día, en ventanas de fecha_compra (índice fecha_compra), agrupa por
+# almacén de los proveedores de sus productos y escribe cada ventana con
+# $merge en la colección de despachos. El $merge une los conjuntos de
+# compras ($setUnion), así que repetir una ventana no cambia nada: el
+# trabajo es idempotente y, con el estado por ventana en _dispatch_state,
+# se reanuda donde se quedó. Las compras de cada ventana se encolan para
+# empaquetado en bloque y una sola vez. El estado guarda el tamaño de
+# ventana: los índices solo valen para ese tamaño.
+logger = logging.getLogger(__name__)
+
+TARGET_COLLECTION = "despachos"
+STATE_COLLECTION = "_dispatch_state"
+
+_ALMACEN = "$productos.proveedores.direcciones_almacenes"
+
+
+def _day(fecha: datetime.date | datetime.datetime) -> datetime.datetime:
+    return datetime.datetime(fecha.year, fecha.month, fecha.day)
+
+
+class DispatchJob:
+    def __init__(self, fecha: datetime.date | datetime.datetime, source: Type[Model] = Compra,
+                 target: str = TARGET_COLLECTION, window: datetime.timedelta = datetime.timedelta(hours=1),
+                 queue: str = "pending_compras"):
+        self.fecha = _day(fecha)
+        self.source = source
+        self.target = target
+        self.window = window
+        self.queue = queue
+        self.name = f"{target}:{self.fecha.date().isoformat()}"
+
+    @property
+    def collection(self):
+        return self.source.db.database[self.target]
+
+    def _state(self):
+        return self.source.db.database[STATE_COLLECTION]
+
+    def windows(self) -> list[tuple[datetime.datetime, datetime.datetime]]:
+        end_of_day = self.fecha + datetime.timedelta(days=1)
+        start, windows = self.fecha, []
+        while start < end_of_day:
+            windows.append((start, min(start + self.window, end_of_day)))
+            start += self.window
+        return windows
+
+    def pipeline(self, start: datetime.datetime, end: datetime.datetime) -> list[dict]:
+        # Listas de despacho de una ventana: una por almacén con alguna compra
+        return [
+            {"$match": {"fecha_compra": {"$gte": start, "$lt": end}}},
+            {"$project": {"productos.proveedores.nombre": 1,
+                          "productos.proveedores.direcciones_almacenes": 1}},
+            {"$unwind": "$productos"},
+            {"$unwind": "$productos.proveedores"},
+            {"$unwind": "$productos.proveedores.direcciones_almacenes"},
+            {"$group": {
+                "_id": {
+                    "fecha": self.fecha,
+                    "almacen": {
+                        "calle": f"{_ALMACEN}.calle",
+                        "numero": f"{_ALMACEN}.numero",
+                        "ciudad": f"{_ALMACEN}.ciudad",
+                        "pais": f"{_ALMACEN}.pais",
+                    },
+                },
+                "location": {"$first": f"{_ALMACEN}.location"},
+                "proveedores": {"$addToSet": "$productos.proveedores.nombre"},
+                "compras": {"$addToSet": "$_id"},
+            }},
+            {"$project": {"_id": 1, "fecha": "$_id.fecha",
+                          "almacen": {"calle": "$_id.almacen.calle", "numero": "$_id.almacen.numero",
+                                      "ciudad": "$_id.almacen.ciudad", "pais": "$_id.almacen.pais",
+                                      "location": "$location"},
+                          "proveedores": 1, "compras": 1, "n_compras": {"$size": "$compras"}}},
+            {"$merge": {
+                "into": self.target,
+                "on": "_id",
+                # Unión de conjuntos: reaplicar una ventana es inocuo
+                "whenMatched": [
+                    {"$set": {"compras": {"$setUnion": ["$compras", "$$new.compras"]},
+                              "proveedores": {"$setUnion": ["$proveedores", "$$new.proveedores"]},
+                              "almacen": "$$new.almacen"}},
+                    {"$set": {"n_compras": {"$size": "$compras"}}},
+                ],
+                "whenNotMatched": "insert",
+            }},
+        ]
+
+    def _window_seconds(self) -> int:
+        return int(self.window.total_seconds())
+
+    def _enqueue_key(self, index: int) -> str:
+        return f"dispatch:{self.name}:{self._window_seconds()}:{index}"
+
+    def run(self, r_queue=None, restart: bool = False) -> dict:
+        """
+        Calcula (o completa) el despacho del día. Con r_queue, las compras
+        de cada ventana se encolan en self.queue. Reanudar con otro tamaño
+        de ventana lanza ValueError. restart=True borra las listas del día
+        y rehace todas las ventanas, así que desaparecen las compras
+        borradas o movidas a otro día; las ya encoladas con el mismo tamaño
+        de ventana no se repiten.
+        """
+        started = time.perf_counter()
+        state = self._state()
+        if restart:
+            state.delete_one({"_id": self.name})
+            self.collection.delete_many({"fecha": self.fecha})
+        saved = state.find_one({"_id": self.name}) or {}
+        if saved.get("window", self._window_seconds()) != self._window_seconds():
+            raise ValueError(f"{self.name} se empezó con ventanas de {saved['window']} s; "
+                             f"usa el mismo tamaño o restart=True")
+        done = set(saved.get("windows_done", []))
+        windows = self.windows()
+        report = {"job": self.name, "windows": len(windows), "skipped": len(done), "processed": 0,
+                  "compras": 0, "enqueued": 0}
+        for index, (start, end) in enumerate(windows):
+            if index in done:
+                continue
+            list(self.source.db.aggregate(self.pipeline(start, end), allowDiskUse=True))
+            ids = [doc["_id"] for doc in self.source.db.find({"fecha_compra": {"$gte": start, "$lt": end},
+                                                              "productos.proveedores.direcciones_almacenes": {
+                                                                  "$exists": True}}, {"_id": 1})]
+            report["compras"] += len(ids)
+            if r_queue is not None:
+                report["enqueued"] += enqueue_compras(r_queue, ids, self.queue, once_key=self._enqueue_key(index))
+            # Se marca después de escribir y encolar: si se interrumpe antes,
+            # la ventana se repite sin efectos duplicados
+            state.update_one({"_id": self.name},
+                             {"$addToSet": {"windows_done": index},
+                              "$set": {"fecha": self.fecha, "window": self._window_seconds(),
+                                       "updated_at": datetime.datetime.now(datetime.timezone.utc)}},
+                             upsert=True)
+            report["processed"] += 1
+        state.update_one({"_id": self.name}, {"$set": {"finished": True}}, upsert=True)
+        report["seconds"] = round(time.perf_counter() - started, 3)
+        logger.info(f"{self.name}: {report['processed']} ventanas, {report['compras']} compras, "
+                    f"{report['enqueued']} encoladas")
+        return report
+
+    def lists(self) -> list[dict]:
+        # Listas de despacho del día, un documento por almacén
+        return list(self.collection.find({"fecha": self.fecha}).sort("n_compras", -1))
+
+
+def dispatch(fecha: datetime.date | datetime.datetime, r_queue=None, **options) -> dict:
+    return DispatchJob(fecha, **options).run(r_queue)
+
+
+if __name__ == "__main__":
+    import resources
+
+    parser = argparse.ArgumentParser(description="Genera las listas de despacho por almacén de un día")
+    parser.add_argument("fecha", type=lambda value: datetime.datetime.strptime(value, "%Y-%m-%d"))
+    parser.add_argument("--window-minutes", type=int, default=60, help="tamaño de cada ventana de $merge")
+    parser.add_argument("--no-enqueue", action="store_true", help="no encolar las compras para empaquetado")
+    parser.add_argument("--restart", action="store_true", help="rehacer todas las ventanas")
+    args = parser.parse_args()
+
+    init_app()
+    job = DispatchJob(args.fecha, window=datetime.timedelta(minutes=args.window_minutes))
+    print(job.run(None if args.no_enqueue else resources.get_redis_queue(), restart=args.restart))
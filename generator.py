@@ -0,0 +1,308 @@
+import argparse
+import datetime
+import functools
+import logging
+import math
+import multiprocessing
+import random
+import struct
+import time
+from typing import Any
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+# Generador de datos sintéticos a escala para pruebas de carga. Cada
+# documento es una función pura de (semilla, tipo, índice), así que el
+# resultado no depende del número de procesos ni del orden de los lotes, y
+# los _id también son deterministas: relanzar una carga interrumpida solo
+# inserta lo que falta. Las direcciones llevan ya sus coordenadas (no se
+# geocodifica) y los documentos se insertan con insert_many, sin pasar por
+# Model.save().
+logger = logging.getLogger(__name__)
+
+KINDS = ["proveedor", "producto", "cliente", "compra"]
+COLLECTIONS = {"proveedor": "proveedor", "producto": "producto", "cliente": "cliente", "compra": "compra"}
+_KIND_CODES = {kind: code for code, kind in enumerate(KINDS, start=1)}
+# Marca de tiempo base de los ObjectId generados (2024-01-01)
+_ID_EPOCH = 1704067200
+
+# Ciudad, longitud, latitud, prefijo postal, país
+CITIES = [
+    ("Madrid", -3.7038, 40.4168, "28", "España"),
+    ("Barcelona", 2.1734, 41.3851, "08", "España"),
+    ("Valencia", -0.3763, 39.4699, "46", "España"),
+    ("Sevilla", -5.9845, 37.3891, "41", "España"),
+    ("Zaragoza", -0.8891, 41.6488, "50", "España"),
+    ("Málaga", -4.4214, 36.7213, "29", "España"),
+    ("Bilbao", -2.9350, 43.2630, "48", "España"),
+    ("Valladolid", -4.7245, 41.6523, "47", "España"),
+    ("Alicante", -0.4810, 38.3452, "03", "España"),
+    ("Lisboa", -9.1393, 38.7223, "1100", "Portugal"),
+]
+STREETS = ["Calle Mayor", "Gran Vía", "Avenida de la Constitución", "Calle de Alcalá", "Paseo de Gracia",
+           "Calle Real", "Avenida de Andalucía", "Calle del Carmen", "Rúa Augusta", "Calle de la Paz"]
+FIRST_NAMES = ["Luis", "Ana", "Carlos", "Beatriz", "María", "Javier", "Lucía", "Pablo", "Elena", "Sergio",
+               "Carmen", "Diego", "Laura", "Marta", "Andrés", "Paula", "Raúl", "Sara", "Iván", "Nuria"]
+LAST_NAMES = ["Martínez", "Sánchez", "López", "Gómez", "Fernández", "García", "Pérez", "Ruiz", "Díaz",
+              "Moreno", "Álvarez", "Romero", "Navarro", "Torres", "Domínguez", "Vázquez", "Ramos"]
+SUPPLIER_WORDS = ["Distribuciones", "Logística", "Textil", "Moda", "Suministros", "Almacenes", "Comercial"]
+SUPPLIER_PLACES = ["Norte", "Sur", "Este", "Central", "Ibérica", "Levante", "Atlántico", "Mediterráneo"]
+PRODUCTS = ["Camiseta de manga corta", "Camisa de manga larga", "Pantalón vaquero", "Vestido de fiesta",
+            "Zapatos deportivos", "Chaqueta de cuero", "Jersey de lana", "Falda plisada", "Sombrero de paja",
+            "Polo de manga corta", "Traje de baño", "Calcetines de algodón", "Bufanda de seda", "Gafas de sol",
+            "Cinturón de cuero", "Guantes de invierno", "Zapatos de vestir"]
+COLORS = ["blanca", "negra", "roja", "azul", "verde", "gris", "beige", "marrón"]
+
+# Entidades que usan las consultas del notebook
+FIXED_SUPPLIER = ("Modas Paqui", ("Calle de la Moda", "123", "Madrid", "28015", "España", -3.703790, 40.416775))
+FIXED_CLIENT = ("Beatriz Gómez", ("Avenida de la Constitución", "1", "Sevilla", "41001", "España", -5.996295, 37.389092))
+FIXED_CLIENT_DATE = datetime.datetime(2024, 4, 11)
+
+DEFAULTS = {
+    "seed": 42,
+    "proveedores": 100,
+    "productos": 2000,
+    "clientes": 10000,
+    "compras": 100000,
+    "productos_por_compra": (1, 5),
+    "proveedores_por_producto": (1, 3),
+    "direcciones_por_cliente": (1, 3),
+    # Fracción de clientes "calientes" y fracción de compras que se llevan
+    "hot_clients": 0.01,
+    "hot_share": 0.3,
+    "desde": datetime.datetime(2023, 1, 1),
+    "hasta": datetime.datetime(2024, 12, 31),
+    # Desviación típica (km) de las direcciones alrededor del centro de su ciudad
+    "spread_km": 10.0,
+    # Compras extra de FIXED_CLIENT en FIXED_CLIENT_DATE
+    "fixture_compras": 5,
+}
+
+
+def object_id(seed: int, kind: str, index: int) -> ObjectId:
+    # 4 bytes de tiempo (dependiente de la semilla) + tipo + índice
+    timestamp = _ID_EPOCH + seed % (1 << 20)
+    return ObjectId(struct.pack(">IB", timestamp, _KIND_CODES[kind]) + index.to_bytes(7, "big"))
+
+
+class SyntheticData:
+    def __init__(self, **params: Any):
+        self.params = {**DEFAULTS, **params}
+        self.seed = self.params["seed"]
+        # Los subdocumentos se repiten mucho (un producto aparece en miles de compras)
+        self.proveedor = functools.lru_cache(maxsize=None)(self.proveedor)
+        self.producto = functools.lru_cache(maxsize=None)(self.producto)
+        self.cliente = functools.lru_cache(maxsize=200_000)(self.cliente)
+
+    def count(self, kind: str) -> int:
+        if kind == "compra":
+            return self.params["compras"] + self.params["fixture_compras"]
+        return self.params[{"proveedor": "proveedores", "producto": "productos", "cliente": "clientes"}[kind]]
+
+    def _rng(self, kind: str, index: int) -> random.Random:
+        return random.Random(f"{self.seed}:{kind}:{index}")
+
+    def _range(self, rng: random.Random, key: str) -> int:
+        low, high = self.params[key]
+        return rng.randint(low, high)
+
+    def direccion(self, rng: random.Random, city: tuple = None) -> dict:
+        name, lon, lat, prefix, pais = city or rng.choice(CITIES)
+        spread = self.params["spread_km"]
+        lat += rng.gauss(0, spread / 111.0)
+        lon += rng.gauss(0, spread / (111.0 * math.cos(math.radians(lat))))
+        return {
+            "calle": rng.choice(STREETS), "numero": str(rng.randint(1, 200)), "ciudad": name,
+            "codigo_postal": (prefix + f"{rng.randint(0, 999):03d}")[:5] if pais == "España" else f"{prefix}-{rng.randint(1, 999):03d}",
+            "pais": pais,
+            "location": {"type": "Point", "coordinates": [round(lon, 6), round(lat, 6)]},
+        }
+
+    @staticmethod
+    def _fixed_direccion(data: tuple) -> dict:
+        calle, numero, ciudad, cp, pais, lon, lat = data
+        return {"calle": calle, "numero": numero, "ciudad": ciudad, "codigo_postal": cp, "pais": pais,
+                "location": {"type": "Point", "coordinates": [lon, lat]}}
+
+    def proveedor(self, index: int) -> dict:
+        rng = self._rng("proveedor", index)
+        if index == 0:
+            nombre, direccion = FIXED_SUPPLIER
+            almacenes = [self._fixed_direccion(direccion)]
+        else:
+            nombre = f"{rng.choice(SUPPLIER_WORDS)} {rng.choice(SUPPLIER_PLACES)} {index}"
+            almacenes = [self.direccion(rng) for _ in range(rng.randint(1, 2))]
+        return {"_id": object_id(self.seed, "proveedor", index), "nombre": nombre,
+                "direcciones_almacenes": almacenes}
+
+    def producto(self, index: int) -> dict:
+        rng = self._rng("producto", index)
+        base = rng.choice(PRODUCTS)
+        nombre = f"{base} {rng.choice(COLORS)}"
+        total = self.params["proveedores"]
+        k = min(self._range(rng, "proveedores_por_producto"), total)
+        indices = rng.sample(range(total), k)
+        if "manga corta" in base and 0 not in indices:
+            # Los productos de manga corta los sirve siempre FIXED_SUPPLIER
+            indices[0] = 0
+        return {
+            "_id": object_id(self.seed, "producto", index),
+            "nombre": nombre,
+            "codigo_producto_proveedor": f"PRD{index + 1:06d}",
+            "precio": round(rng.uniform(5, 200), 2),
+            "dimensiones": {"ancho": rng.randint(5, 50), "alto": rng.randint(5, 50), "profundidad": rng.randint(5, 50)},
+            "peso": round(rng.uniform(0.1, 10), 2),
+            "proveedores": [self.proveedor(i) for i in indices],
+        }
+
+    def cliente(self, index: int) -> dict:
+        rng = self._rng("cliente", index)
+        if index == 0:
+            nombre, direccion = FIXED_CLIENT
+            city = next(c for c in CITIES if c[0] == direccion[2])
+            direcciones = [self._fixed_direccion(direccion)]
+            direcciones += [self.direccion(rng, city) for _ in range(self._range(rng, "direcciones_por_cliente") - 1)]
+        else:
+            nombre = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {rng.choice(LAST_NAMES)}"
+            city = rng.choice(CITIES)
+            direcciones = [self.direccion(rng, city) for _ in range(self._range(rng, "direcciones_por_cliente"))]
+        desde = self.params["desde"]
+        return {
+            "_id": object_id(self.seed, "cliente", index),
+            "nombre": nombre,
+            "fecha_alta": desde - datetime.timedelta(days=rng.randint(0, 1000)),
+            "direcciones_envio": direcciones,
+        }
+
+    def _pick_cliente(self, rng: random.Random) -> int:
+        total = self.params["clientes"]
+        hot = max(1, int(total * self.params["hot_clients"]))
+        if rng.random() < self.params["hot_share"]:
+            return rng.randrange(hot)
+        return rng.randrange(total)
+
+    def compra(self, index: int) -> dict:
+        rng = self._rng("compra", index)
+        if index >= self.params["compras"]:
+            cliente, fecha = self.cliente(0), FIXED_CLIENT_DATE + datetime.timedelta(minutes=rng.randint(0, 1439))
+        else:
+            cliente = self.cliente(self._pick_cliente(rng))
+            desde, hasta = self.params["desde"], self.params["hasta"]
+            fecha = desde + datetime.timedelta(seconds=rng.randint(0, int((hasta - desde).total_seconds())))
+        total = self.params["productos"]
+        k = min(self._range(rng, "productos_por_compra"), total)
+        productos = [self.producto(i) for i in rng.sample(range(total), k)]
+        return {
+            "_id": object_id(self.seed, "compra", index),
+            "productos": productos,
+            "cliente": cliente,
+            "precio_compra": round(sum(p["precio"] for p in productos), 2),
+            "fecha_compra": fecha,
+            "fecha_modificacion": fecha,
+            "direccion_envio": rng.choice(cliente["direcciones_envio"]),
+        }
+
+    def documents(self, kind: str, start: int, stop: int) -> list[dict]:
+        make = getattr(self, kind)
+        return [make(i) for i in range(start, stop)]
+
+
+def check_schema(data: SyntheticData) -> None:
+    # Un documento de cada tipo debe ser un modelo válido
+    from models import Proveedor, Producto, Cliente, Compra
+    for kind, model in (("proveedor", Proveedor), ("producto", Producto), ("cliente", Cliente), ("compra", Compra)):
+        doc = dict(getattr(data, kind)(0))
+        doc.pop("_id")
+        model(**doc)
+
+
+# ---------------------------------------------------------
+# Carga en paralelo
+
+_worker_state: dict[str, Any] = {}
+
+
+def _init_worker(params: dict, db_name: str) -> None:
+    import resources
+    _worker_state["data"] = SyntheticData(**params)
+    _worker_state["db"] = resources.get_database(db_name)
+
+
+def _insert_chunk(task: tuple[str, int, int]) -> tuple[str, int, int, float]:
+    kind, start, stop = task
+    begin = time.perf_counter()
+    docs = _worker_state["data"].documents(kind, start, stop)
+    inserted, skipped = len(docs), 0
+    try:
+        _worker_state["db"][COLLECTIONS[kind]].insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        # Duplicados de una ejecución anterior con la misma semilla
+        duplicates = sum(1 for error in e.details["writeErrors"] if error["code"] == 11000)
+        if duplicates != len(e.details["writeErrors"]):
+            raise
+        inserted, skipped = e.details["nInserted"], duplicates
+    return kind, inserted, skipped, time.perf_counter() - begin
+
+
+def generate(db_name: str = None, processes: int = None, batch_size: int = 1000,
+             kinds: list[str] = None, **params: Any) -> dict:
+    data = SyntheticData(**params)
+    check_schema(data)
+    processes = processes or multiprocessing.cpu_count()
+    report = {"processes": processes, "batch_size": batch_size, "kinds": {}}
+    # spawn: cada proceso abre su propio MongoClient (no se hereda tras fork)
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes, initializer=_init_worker, initargs=(data.params, db_name)) as pool:
+        for kind in kinds or KINDS:
+            total = data.count(kind)
+            tasks = [(kind, start, min(start + batch_size, total)) for start in range(0, total, batch_size)]
+            begin = time.perf_counter()
+            inserted = skipped = 0
+            for _, chunk_inserted, chunk_skipped, _ in pool.imap_unordered(_insert_chunk, tasks):
+                inserted += chunk_inserted
+                skipped += chunk_skipped
+            seconds = time.perf_counter() - begin
+            report["kinds"][kind] = {"documents": total, "inserted": inserted, "skipped": skipped,
+                                     "seconds": round(seconds, 3),
+                                     "inserts_per_sec": round(inserted / seconds, 1) if seconds else None}
+            logger.info(f"{kind}: {inserted} insertados, {skipped} ya existían, "
+                        f"{report['kinds'][kind]['inserts_per_sec']} inserts/s")
+    return report
+
+
+def _parse_range(value: str) -> tuple[int, int]:
+    low, _, high = value.partition("-")
+    return int(low), int(high or low)
+
+
+def _parse_date(value: str) -> datetime.datetime:
+    return datetime.datetime.strptime(value, "%Y-%m-%d")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Genera datos sintéticos deterministas en MongoDB")
+    parser.add_argument("--seed", type=int, default=DEFAULTS["seed"])
+    parser.add_argument("--proveedores", type=int, default=DEFAULTS["proveedores"])
+    parser.add_argument("--productos", type=int, default=DEFAULTS["productos"])
+    parser.add_argument("--clientes", type=int, default=DEFAULTS["clientes"])
+    parser.add_argument("--compras", type=int, default=DEFAULTS["compras"])
+    parser.add_argument("--productos-por-compra", type=_parse_range, default=DEFAULTS["productos_por_compra"])
+    parser.add_argument("--proveedores-por-producto", type=_parse_range, default=DEFAULTS["proveedores_por_producto"])
+    parser.add_argument("--direcciones-por-cliente", type=_parse_range, default=DEFAULTS["direcciones_por_cliente"])
+    parser.add_argument("--hot-clients", type=float, default=DEFAULTS["hot_clients"])
+    parser.add_argument("--hot-share", type=float, default=DEFAULTS["hot_share"])
+    parser.add_argument("--desde", type=_parse_date, default=DEFAULTS["desde"])
+    parser.add_argument("--hasta", type=_parse_date, default=DEFAULTS["hasta"])
+    parser.add_argument("--spread-km", type=float, default=DEFAULTS["spread_km"])
+    parser.add_argument("--fixture-compras", type=int, default=DEFAULTS["fixture_compras"])
+    parser.add_argument("--db", default=None, help="base de datos (por defecto DB_NAME)")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--kinds", default=",".join(KINDS))
+    args = vars(parser.parse_args())
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    options = {key: args.pop(key) for key in ("db", "processes", "batch_size", "kinds")}
+    report = generate(options["db"], options["processes"], options["batch_size"],
+                      options["kinds"].split(","), **args)
+    print(report)
@@ -0,0 +1,182 @@
+import logging
+import threading
+from typing import Any
+
+# Asesor de índices: registra las formas de filtro y ordenación que llegan a
+# Model.find / Model.paginate / Model.aggregate, ejecuta explain sobre un
+# ejemplo de cada forma y propone índices para las que acaban en COLLSCAN.
+logger = logging.getLogger(__name__)
+
+# Tipos de índice (los valores de pymongo, sin importarlo al arrancar)
+ASCENDING = 1
+DESCENDING = -1
+GEOSPHERE = '2dsphere'
+
+_EQUALITY_OPS = {'$eq', '$in'}
+_GEO_OPS = {'$geoWithin', '$geoIntersects', '$near', '$nearSphere'}
+
+
+def query_shape(value: Any) -> Any:
+    # Forma normalizada de un filtro o pipeline: se conservan claves y
+    # operadores y los valores literales se sustituyen por "?"
+    if isinstance(value, dict):
+        return {k: query_shape(v) for k, v in sorted(value.items())}
+    if isinstance(value, list):
+        if value and all(isinstance(v, dict) for v in value):
+            return [query_shape(v) for v in value]
+        return '?'
+    if isinstance(value, str) and value.startswith('$'):
+        # Referencias a campos dentro de expresiones de agregación
+        return value
+    return '?'
+
+
+def _shape_key(shape: Any) -> str:
+    return repr(shape)
+
+
+def _find_stage(plan: Any, stage: str) -> bool:
+    if isinstance(plan, dict):
+        if plan.get('stage') == stage:
+            return True
+        return any(_find_stage(v, stage) for v in plan.values())
+    if isinstance(plan, list):
+        return any(_find_stage(v, stage) for v in plan)
+    return False
+
+
+def _classify_fields(filter: dict) -> tuple[list[str], list[str], list[str]]:
+    equality, ranges, geo = [], [], []
+    for field, condition in filter.items():
+        if field in ('$and', '$or', '$nor'):
+            # En $and todas las ramas restringen; en $or no hay índice común
+            if field == '$and':
+                for sub in condition:
+                    e, r, g = _classify_fields(sub)
+                    equality += e
+                    ranges += r
+                    geo += g
+            continue
+        if field.startswith('$'):
+            continue
+        if isinstance(condition, dict) and any(k.startswith('$') for k in condition):
+            ops = set(condition)
+            if ops & _GEO_OPS:
+                geo.append(field)
+            elif ops <= _EQUALITY_OPS:
+                equality.append(field)
+            else:
+                ranges.append(field)
+        else:
+            equality.append(field)
+    return equality, ranges, geo
+
+
+def suggest_index(filter: dict, sort: list | None = None) -> list[tuple[str, Any]]:
+    # Regla ESR: igualdad, después ordenación y por último rangos
+    equality, ranges, geo = _classify_fields(filter or {})
+    keys: list[tuple[str, Any]] = []
+    seen = set()
+
+    def add(field, direction):
+        if field not in seen:
+            seen.add(field)
+            keys.append((field, direction))
+
+    for field in equality:
+        add(field, ASCENDING)
+    for field, direction in sort or []:
+        if field != '_id':
+            add(field, direction)
+    for field in ranges:
+        add(field, ASCENDING)
+    for field in geo:
+        add(field, GEOSPHERE)
+    return keys
+
+
+class IndexAdvisor:
+    def __init__(self, max_shapes: int = 1000):
+        self.max_shapes = max_shapes
+        self._lock = threading.Lock()
+        # (modelo, tipo, forma) -> {"model", "kind", "filter", "sort", "pipeline", "count"}
+        self.shapes: dict[tuple, dict] = {}
+
+    def _record(self, model_class, kind: str, shape: Any, entry: dict) -> None:
+        key = (model_class.__name__, kind, _shape_key(shape))
+        with self._lock:
+            current = self.shapes.get(key)
+            if current is not None:
+                current['count'] += 1
+            elif len(self.shapes) < self.max_shapes:
+                self.shapes[key] = dict(entry, model=model_class, kind=kind, shape=shape, count=1)
+
+    def record_find(self, model_class, filter: dict, sort: list | None = None) -> None:
+        self._record(model_class, 'find', query_shape({'filter': filter, 'sort': dict(sort or [])}),
+                     {'filter': filter, 'sort': sort})
+
+    def record_aggregate(self, model_class, pipeline: list[dict]) -> None:
+        self._record(model_class, 'aggregate', query_shape(pipeline), {'pipeline': pipeline})
+
+    def _explain(self, entry: dict) -> dict:
+        db = entry['model'].db
+        if entry['kind'] == 'find':
+            cursor = db.find(entry['filter'])
+            if entry['sort']:
+                cursor = cursor.sort(entry['sort'])
+            return cursor.explain()
+        return db.database.command('aggregate', db.name, pipeline=entry['pipeline'], explain=True)
+
+    @staticmethod
+    def _leading_filter(pipeline: list[dict]) -> tuple[dict, list | None]:
+        # Solo los $match/$sort iniciales pueden aprovechar un índice
+        filter, sort = {}, None
+        for stage in pipeline:
+            if '$match' in stage:
+                filter = {'$and': [filter, stage['$match']]} if filter else stage['$match']
+            elif '$sort' in stage and sort is None:
+                sort = list(stage['$sort'].items())
+            else:
+                break
+        return filter, sort
+
+    def analyze(self) -> list[dict]:
+        report = []
+        with self._lock:
+            entries = list(self.shapes.values())
+        for entry in entries:
+            try:
+                plan = self._explain(entry)
+            except Exception as e:
+                logger.warning(f"No se pudo ejecutar explain para {entry['model'].__name__}: {e}")
+                continue
+            if not _find_stage(plan, 'COLLSCAN'):
+                continue
+            if entry['kind'] == 'find':
+                filter, sort = entry['filter'], entry['sort']
+                note = None
+            else:
+                filter, sort = self._leading_filter(entry['pipeline'])
+                note = None if filter else "El pipeline no empieza con $match: ningún índice puede usarse"
+            keys = suggest_index(filter, sort)
+            report.append({
+                'model': entry['model'].__name__,
+                'collection': entry['model'].db.name,
+                'kind': entry['kind'],
+                'shape': entry['shape'],
+                'count': entry['count'],
+                'suggested_index': keys or None,
+                'note': note,
+            })
+        report.sort(key=lambda r: r['count'], reverse=True)
+        return report
+
+    def report(self) -> str:
+        lines = []
+        for item in self.analyze():
+            lines.append(f"[COLLSCAN] {item['model']} ({item['kind']}, {item['count']} veces): {item['shape']}")
+            if item['suggested_index']:
+                lines.append(f"    sugerencia: Index({item['suggested_index']!r})")
+            if item['note']:
+                lines.append(f"    nota: {item['note']}")
+        return '\n'.join(lines) or "Sin COLLSCAN en las consultas registradas."
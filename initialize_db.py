@@ -1,4 +1,4 @@
-from neo4j import GraphDatabase
+import resources
 
 # Credenciales de conexión a Neo4j
 URI = "bolt://localhost:7687"
@@ -7,12 +7,12 @@ PASSWORD = "testtest"
 
 class DBInitializer:
     def __init__(self, uri, user, password):
-        # Conexión al servidor Neo4j
-        self.driver = GraphDatabase.driver(uri, auth=(user, password))
+        # Conexión al servidor Neo4j (driver compartido de resources)
+        self.driver = resources.get_neo4j_driver(uri, user, password)
 
     def close(self):
-        # Cierre de conexión
-        self.driver.close()
+        # El driver es compartido: se libera con resources.close_all()
+        self.driver = None
 
     def initialize_infrastructure(self):
         # Ciudades clasificadas
@@ -65,4 +65,5 @@ if __name__ == "__main__":
     db_init = DBInitializer(URI, USER, PASSWORD)
     db_init.initialize_infrastructure()
     db_init.close()
+    resources.close_all()
     print("Inicialización completada.")
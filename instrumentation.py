@@ -0,0 +1,292 @@
+import json
+import logging
+import threading
+import time
+from typing import Any
+
+import config
+from index_advisor import query_shape
+
+# Instrumentación del ODM: contadores e histogramas con salida en formato
+# de texto de Prometheus, monitorización de comandos de pymongo, tiempos de
+# la caché de Redis, de la hidratación de ModelCursor y de las consultas a
+# Neo4j, y un log de consultas lentas con la forma normalizada del filtro o
+# pipeline. Desactivada, cada punto de medida se reduce a comprobar
+# `enabled` (y pymongo no recibe listener si se desactiva antes de conectar).
+# La configuración (INSTRUMENTATION, SLOW_QUERY_MS) se lee en la primera
+# medida o al crear el cliente de Mongo, no al importar el módulo.
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger("odm.slow_queries")
+
+enabled = False
+slow_query_ms = None
+_configured = False
+
+# Buckets en segundos: de 0,5 ms a 10 s
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels_text(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels: Any) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def value(self, **labels: Any) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels_text(labels)} {value}")
+        return lines
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+class Gauge:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def value(self, **labels: Any) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels_text(labels)} {value}")
+        return lines
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # etiquetas -> [cuentas por bucket, suma, total]
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, **labels: Any) -> int:
+        entry = self._values.get(tuple(sorted(labels.items())))
+        return entry[2] if entry else 0
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in sorted(self._values.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_labels_text(labels + (('le', bound),))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_labels_text(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{_labels_text(labels)} {total}")
+            lines.append(f"{self.name}_count{_labels_text(labels)} {count}")
+        return lines
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+MONGO_COMMANDS = Counter("odm_mongo_commands_total", "Comandos enviados a MongoDB")
+MONGO_FAILURES = Counter("odm_mongo_command_failures_total", "Comandos de MongoDB fallidos")
+MONGO_DURATION = Histogram("odm_mongo_command_seconds", "Duración de los comandos de MongoDB")
+CACHE_REQUESTS = Counter("odm_cache_requests_total", "Operaciones sobre la caché de Redis por resultado")
+CACHE_DURATION = Histogram("odm_cache_seconds", "Duración de las operaciones sobre la caché de Redis")
+HYDRATION_DURATION = Histogram("odm_hydration_seconds", "Tiempo de hidratación por ModelCursor")
+HYDRATED_DOCUMENTS = Counter("odm_hydrated_documents_total", "Documentos convertidos en instancias del modelo")
+NEO4J_DURATION = Histogram("odm_neo4j_query_seconds", "Duración de las consultas a Neo4j")
+SLOW_QUERIES = Counter("odm_slow_queries_total", "Consultas por encima del umbral del log de lentas")
+# El estado del cortocircuito de la caché se registra aunque la instrumentación esté desactivada
+CACHE_BREAKER_STATE = Gauge("odm_cache_breaker_state", "Estado del cortocircuito de Redis (0 cerrado, 1 abierto, 2 sondeando)")
+CACHE_BREAKER_TRANSITIONS = Counter("odm_cache_breaker_transitions_total", "Cambios de estado del cortocircuito de Redis")
+CACHE_ERRORS = Counter("odm_cache_errors_total", "Operaciones sobre la caché fallidas por conexión o timeout")
+CACHE_BYPASSED = Counter("odm_cache_bypassed_total", "Operaciones sobre la caché omitidas con el cortocircuito abierto")
+
+METRICS = [MONGO_COMMANDS, MONGO_FAILURES, MONGO_DURATION, CACHE_REQUESTS, CACHE_DURATION,
+           HYDRATION_DURATION, HYDRATED_DOCUMENTS, NEO4J_DURATION, SLOW_QUERIES, CACHE_BREAKER_STATE,
+           CACHE_BREAKER_TRANSITIONS, CACHE_ERRORS, CACHE_BYPASSED]
+
+
+def configure() -> None:
+    # Valores de config.py; enable()/disable() explícitos tienen prioridad
+    global enabled, slow_query_ms, _configured
+    if _configured:
+        return
+    enabled = config.INSTRUMENTATION
+    slow_query_ms = config.SLOW_QUERY_MS
+    _configured = True
+
+
+def enable(slow_ms: float = None) -> None:
+    # Para medir los comandos de Mongo hay que activarla antes de la primera conexión
+    global enabled, slow_query_ms
+    configure()
+    enabled = True
+    if slow_ms is not None:
+        slow_query_ms = slow_ms
+
+
+def disable() -> None:
+    global enabled
+    configure()
+    enabled = False
+
+
+def reset() -> None:
+    for metric in METRICS:
+        metric.reset()
+
+
+def render() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def start() -> float | None:
+    # Marca de inicio de una medida; None si la instrumentación está desactivada
+    if not _configured:
+        configure()
+    return time.perf_counter() if enabled else None
+
+
+def log_slow_query(kind: str, target: str, seconds: float, shape: Any) -> None:
+    if slow_query_ms is None or seconds * 1000 < slow_query_ms:
+        return
+    SLOW_QUERIES.inc(kind=kind, target=target)
+    slow_query_logger.warning(json.dumps({
+        'kind': kind, 'target': target, 'ms': round(seconds * 1000, 2), 'shape': shape,
+    }, default=str, ensure_ascii=False))
+
+
+def observe_cache(operation: str, model: str, started: float | None, result: str = 'ok') -> None:
+    if started is None:
+        return
+    CACHE_DURATION.observe(time.perf_counter() - started, operation=operation, model=model)
+    CACHE_REQUESTS.inc(operation=operation, model=model, result=result)
+
+
+def observe_hydration(model: str, seconds: float, documents: int) -> None:
+    HYDRATION_DURATION.observe(seconds, model=model)
+    HYDRATED_DOCUMENTS.inc(documents, model=model)
+
+
+def observe_neo4j(query: str, started: float | None) -> None:
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    NEO4J_DURATION.observe(seconds, query=query)
+    log_slow_query('neo4j', query, seconds, None)
+
+
+# Colecciones de los modelos (las demás no se miden)
+_collections: set[str] = set()
+
+
+def watch_collection(name: str) -> None:
+    _collections.add(name)
+
+
+def _command_shape(command_name: str, command: dict) -> Any:
+    if command_name == 'find':
+        return query_shape({'filter': command.get('filter', {}), 'sort': command.get('sort', {})})
+    if command_name == 'aggregate':
+        return query_shape(command.get('pipeline', []))
+    if command_name in ('update', 'delete'):
+        key = 'updates' if command_name == 'update' else 'deletes'
+        return [query_shape(op.get('q', {})) for op in command.get(key, [])[:1]]
+    if command_name in ('count', 'distinct'):
+        return query_shape(command.get('query', {}))
+    return None
+
+
+class _CommandListener:
+    def __init__(self):
+        # request_id -> (colección, forma)
+        self._pending: dict[int, tuple[str, Any]] = {}
+
+    def started(self, event) -> None:
+        if not enabled:
+            return
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str) or collection not in _collections:
+            return
+        self._pending[event.request_id] = (collection, _command_shape(event.command_name, event.command))
+
+    def _finish(self, event, failed: bool) -> None:
+        pending = self._pending.pop(event.request_id, None)
+        if pending is None:
+            return
+        collection, shape = pending
+        seconds = event.duration_micros / 1e6
+        labels = {'command': event.command_name, 'collection': collection}
+        MONGO_COMMANDS.inc(**labels)
+        MONGO_DURATION.observe(seconds, **labels)
+        if failed:
+            MONGO_FAILURES.inc(**labels)
+        log_slow_query(event.command_name, collection, seconds, shape)
+
+    def succeeded(self, event) -> None:
+        self._finish(event, failed=False)
+
+    def failed(self, event) -> None:
+        self._finish(event, failed=True)
+
+
+_command_listener = None
+
+
+def command_listener():
+    # pymongo.monitoring solo se importa cuando se crea un cliente de Mongo
+    global _command_listener
+    if _command_listener is None:
+        from pymongo import monitoring
+
+        class CommandListener(_CommandListener, monitoring.CommandListener):
+            pass
+
+        _command_listener = CommandListener()
+    return _command_listener
+
+
+def event_listeners() -> list:
+    # Listeners para MongoClient; vacío si está desactivada al conectar
+    configure()
+    return [command_listener()] if enabled else []
@@ -0,0 +1,498 @@
+import datetime
+import re
+from functools import cmp_to_key
+from typing import Any
+
+from bson import ObjectId, json_util
+
+# Evaluador local de un subconjunto de etapas y expresiones de agregación.
+# Se usa para terminar en el cliente los pipelines cuyos resultados
+# parciales se han fusionado (agregación por particiones). Las etapas o
+# expresiones no soportadas lanzan NotImplementedError para que el
+# llamador pueda volver a ejecutar el pipeline completo en Mongo.
+
+SUPPORTED_STAGES = {'$match', '$project', '$addFields', '$set', '$unset', '$sort', '$limit',
+                    '$skip', '$unwind', '$group', '$count', '$replaceRoot'}
+
+_MISSING = object()
+
+# Orden de tipos BSON para comparar valores heterogéneos
+_TYPE_ORDER = [(type(None), 1), (bool, 8), ((int, float), 2), (str, 3), (dict, 4),
+               (list, 5), (ObjectId, 7), (datetime.datetime, 9)]
+
+
+def type_rank(value: Any) -> int:
+    if value is _MISSING:
+        return 0
+    for types, rank in _TYPE_ORDER:
+        if isinstance(value, types):
+            return rank
+    return 10
+
+
+def compare(a: Any, b: Any) -> int:
+    rank_a, rank_b = type_rank(a), type_rank(b)
+    if rank_a != rank_b:
+        return -1 if rank_a < rank_b else 1
+    if rank_a in (0, 1):
+        return 0
+    if isinstance(a, dict):
+        a, b = list(a.items()), list(b.items())
+    if isinstance(a, list):
+        for x, y in zip(a, b):
+            if isinstance(x, tuple):
+                result = compare(x[0], y[0]) or compare(x[1], y[1])
+            else:
+                result = compare(x, y)
+            if result:
+                return result
+        return (len(a) > len(b)) - (len(a) < len(b))
+    return (a > b) - (a < b)
+
+
+def group_key(value: Any) -> str:
+    # Clave hashable para agrupar por _id (incluidos subdocumentos)
+    return json_util.dumps(value)
+
+
+def get_path(doc: Any, path: str, default: Any = None) -> Any:
+    # Resuelve "a.b.c" atravesando arrays como Mongo ("productos.precio" -> lista)
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, list):
+            # Los arrays anidados ("productos.proveedores.nombre") dan listas anidadas
+            values = [get_path(item, part, _MISSING) for item in value if isinstance(item, (dict, list))]
+            value = [v for v in values if v is not _MISSING]
+        elif isinstance(value, dict) and part in value:
+            value = value[part]
+        else:
+            return default
+    return value
+
+
+def set_path(doc: dict, path: str, value: Any) -> None:
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def unset_path(doc: dict, path: str) -> None:
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+# ---------------------------------------------------------
+# Expresiones
+
+def _numbers(values: list) -> list:
+    return [v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool)]
+
+
+def _arith(args: list, fn) -> Any:
+    if any(a is None for a in args):
+        return None
+    return fn(*args)
+
+
+_DATE_PARTS = {
+    '$year': lambda d: d.year,
+    '$month': lambda d: d.month,
+    '$dayOfMonth': lambda d: d.day,
+    '$hour': lambda d: d.hour,
+    '$minute': lambda d: d.minute,
+    '$dayOfWeek': lambda d: d.isoweekday() % 7 + 1,
+}
+
+
+def evaluate(expr: Any, doc: dict, variables: dict = None) -> Any:
+    if isinstance(expr, str):
+        if expr.startswith('$$'):
+            name, _, path = expr[2:].partition('.')
+            if name in ('ROOT', 'CURRENT'):
+                base = doc
+            elif variables and name in variables:
+                base = variables[name]
+            else:
+                raise NotImplementedError(f"Variable no soportada: {expr}")
+            return get_path(base, path) if path else base
+        if expr.startswith('$'):
+            return get_path(doc, expr[1:])
+        return expr
+    if isinstance(expr, list):
+        return [evaluate(e, doc, variables) for e in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if len(expr) != 1 or not next(iter(expr)).startswith('$'):
+        return {k: evaluate(v, doc, variables) for k, v in expr.items()}
+
+    op, arg = next(iter(expr.items()))
+    if op == '$literal':
+        return arg
+    if op == '$cond':
+        if isinstance(arg, dict):
+            arg = [arg['if'], arg['then'], arg['else']]
+        return evaluate(arg[1] if _truthy(evaluate(arg[0], doc, variables)) else arg[2], doc, variables)
+    if op == '$ifNull':
+        for e in arg:
+            value = evaluate(e, doc, variables)
+            if value is not None:
+                return value
+        return None
+
+    # Los operadores aceptan un argumento suelto o una lista de argumentos
+    if isinstance(arg, list):
+        args = [evaluate(a, doc, variables) for a in arg]
+    else:
+        args = [evaluate(arg, doc, variables)]
+    if op in _DATE_PARTS:
+        return _DATE_PARTS[op](args[0]) if isinstance(args[0], datetime.datetime) else None
+    if op == '$dateFromParts':
+        parts = args[0]
+        if parts.get('year') is None:
+            return None
+        return datetime.datetime(parts['year'], parts.get('month', 1), parts.get('day', 1), parts.get('hour', 0),
+                                 parts.get('minute', 0), parts.get('second', 0),
+                                 parts.get('millisecond', 0) * 1000)
+    if op == '$add':
+        return _arith(args, lambda *a: sum(a))
+    if op == '$subtract':
+        return _arith(args, lambda a, b: a - b)
+    if op == '$multiply':
+        def product(*a):
+            result = 1
+            for x in a:
+                result *= x
+            return result
+        return _arith(args, product)
+    if op == '$divide':
+        return _arith(args, lambda a, b: a / b)
+    if op in ('$sum', '$avg', '$min', '$max'):
+        values = args[0] if len(args) == 1 and isinstance(args[0], list) else args
+        if op in ('$min', '$max'):
+            values = [v for v in values if v is not None]
+            if not values:
+                return None
+            pick = min if op == '$min' else max
+            return pick(values, key=cmp_to_key(compare))
+        numbers = _numbers(values)
+        if op == '$sum':
+            return sum(numbers)
+        return sum(numbers) / len(numbers) if numbers else None
+    if op == '$round':
+        value, places = (args + [0])[:2]
+        return None if value is None else round(value, places)
+    if op == '$size':
+        return len(args[0])
+    if op == '$arrayElemAt':
+        array, index = args
+        return array[index] if array is not None and -len(array) <= index < len(array) else None
+    if op == '$setUnion':
+        if any(a is None for a in args):
+            return None
+        unique = {}
+        for value in (v for array in args for v in array):
+            unique.setdefault(group_key(value), value)
+        return list(unique.values())
+    if op == '$concat':
+        return None if any(a is None for a in args) else ''.join(args)
+    if op == '$toLower':
+        return (args[0] or '').lower()
+    if op == '$toUpper':
+        return (args[0] or '').upper()
+    if op == '$isNumber':
+        return bool(_numbers(args[:1]))
+    if op in ('$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$cmp'):
+        result = compare(args[0], args[1])
+        return {'$eq': result == 0, '$ne': result != 0, '$gt': result > 0, '$gte': result >= 0,
+                '$lt': result < 0, '$lte': result <= 0, '$cmp': result}[op]
+    if op == '$and':
+        return all(_truthy(a) for a in args)
+    if op == '$or':
+        return any(_truthy(a) for a in args)
+    if op == '$not':
+        return not _truthy(args[0])
+    raise NotImplementedError(f"Operador de expresión no soportado: {op}")
+
+
+def _truthy(value: Any) -> bool:
+    return value not in (None, False, 0, _MISSING)
+
+
+# ---------------------------------------------------------
+# Filtros de $match
+
+def _candidates(value: Any) -> list:
+    # Un campo array compara tanto el array como cada elemento (también los
+    # de los arrays anidados que resultan de recorrer varios niveles)
+    if isinstance(value, list):
+        result = [value]
+        for item in value:
+            result += _candidates(item) if isinstance(item, list) else [item]
+        return result
+    return [value]
+
+
+def _condition(value: Any, condition: Any) -> bool:
+    if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+        for op, arg in condition.items():
+            if op == '$options':
+                continue
+            if not _operator(value, op, arg, condition):
+                return False
+        return True
+    if isinstance(condition, re.Pattern):
+        return _operator(value, '$regex', condition, {})
+    if value is _MISSING:
+        return condition is None
+    return any(compare(v, condition) == 0 for v in _candidates(value))
+
+
+def _operator(value: Any, op: str, arg: Any, condition: dict) -> bool:
+    if op == '$exists':
+        return (value is not _MISSING) == bool(arg)
+    if op == '$ne':
+        return not _condition(value, arg)
+    if op == '$nin':
+        return not any(_condition(value, a) for a in arg)
+    if op == '$not':
+        return not _condition(value, arg)
+    if value is _MISSING:
+        return op in ('$eq', '$in') and (arg is None or op == '$in' and None in arg)
+    if op == '$eq':
+        return _condition(value, arg)
+    if op == '$in':
+        return any(_condition(value, a) for a in arg)
+    if op in ('$gt', '$gte', '$lt', '$lte'):
+        test = {'$gt': lambda c: c > 0, '$gte': lambda c: c >= 0,
+                '$lt': lambda c: c < 0, '$lte': lambda c: c <= 0}[op]
+        return any(type_rank(v) == type_rank(arg) and test(compare(v, arg)) for v in _candidates(value))
+    if op == '$regex':
+        flags = re.IGNORECASE if 'i' in condition.get('$options', '') else 0
+        pattern = arg if isinstance(arg, re.Pattern) else re.compile(arg, flags)
+        return any(isinstance(v, str) and pattern.search(v) for v in _candidates(value))
+    if op == '$size':
+        return isinstance(value, list) and len(value) == arg
+    if op == '$all':
+        return isinstance(value, list) and all(_condition(value, a) for a in arg)
+    if op == '$elemMatch':
+        return isinstance(value, list) and any(isinstance(v, dict) and matches(v, arg) for v in value)
+    raise NotImplementedError(f"Operador de consulta no soportado: {op}")
+
+
+def matches(doc: dict, filter: dict) -> bool:
+    for key, condition in filter.items():
+        if key == '$and':
+            if not all(matches(doc, sub) for sub in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(doc, sub) for sub in condition):
+                return False
+        elif key == '$nor':
+            if any(matches(doc, sub) for sub in condition):
+                return False
+        elif key == '$expr':
+            if not _truthy(evaluate(condition, doc)):
+                return False
+        elif key.startswith('$'):
+            raise NotImplementedError(f"Operador de consulta no soportado: {key}")
+        elif not _condition(get_path(doc, key, _MISSING), condition):
+            return False
+    return True
+
+
+# ---------------------------------------------------------
+# Etapas
+
+def path_tree(paths) -> dict:
+    # ["a.b", "a.c", "d"] -> {"a": {"b": True, "c": True}, "d": True}
+    tree = {}
+    for path in paths:
+        node = tree
+        parts = path.split('.')
+        for part in parts[:-1]:
+            if node.get(part) is True:
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = True
+    return tree
+
+
+def include(doc: Any, tree: dict) -> Any:
+    # Proyección de inclusión: en los arrays se proyecta cada subdocumento
+    if isinstance(doc, list):
+        return [include(item, tree) for item in doc if isinstance(item, (dict, list))]
+    return {key: value if tree[key] is True else include(value, tree[key])
+            for key, value in doc.items()
+            if key in tree and (tree[key] is True or isinstance(value, (dict, list)))}
+
+
+def _project(doc: dict, spec: dict) -> dict:
+    include_id = spec.get('_id', 1) not in (0, False)
+    fields = {k: v for k, v in spec.items() if k != '_id'}
+    if fields and all(v in (0, False) for v in fields.values()):
+        result = {k: v for k, v in doc.items()}
+        for path in fields:
+            unset_path(result, path)
+        if not include_id:
+            result.pop('_id', None)
+        return result
+    result = {}
+    if include_id and '_id' in doc:
+        result['_id'] = doc['_id'] if spec.get('_id', 1) in (1, True) else evaluate(spec['_id'], doc)
+    elif '_id' in spec and spec['_id'] not in (0, False, 1, True):
+        result['_id'] = evaluate(spec['_id'], doc)
+    result.update(include(doc, path_tree(path for path, value in fields.items() if value in (1, True))))
+    for path, value in fields.items():
+        if value not in (1, True):
+            set_path(result, path, evaluate(value, doc))
+    return result
+
+
+def _unwind(docs: list[dict], spec: Any) -> list[dict]:
+    if isinstance(spec, str):
+        spec = {'path': spec}
+    path = spec['path'][1:]
+    preserve = spec.get('preserveNullAndEmptyArrays', False)
+    index_field = spec.get('includeArrayIndex')
+    result = []
+    for doc in docs:
+        value = get_path(doc, path, _MISSING)
+        if isinstance(value, list) and value:
+            for i, item in enumerate(value):
+                new = _copy_along(doc, path)
+                set_path(new, path, item)
+                if index_field:
+                    new[index_field] = i
+                result.append(new)
+        elif isinstance(value, list) or value in (None, _MISSING):
+            if preserve:
+                new = _copy_along(doc, path)
+                if isinstance(value, list):
+                    unset_path(new, path)
+                if index_field:
+                    new[index_field] = None
+                result.append(new)
+        else:
+            new = dict(doc)
+            if index_field:
+                new[index_field] = None
+            result.append(new)
+    return result
+
+
+def _copy_along(doc: dict, path: str) -> dict:
+    # Copia los subdocumentos del camino para no compartirlos entre las salidas del $unwind
+    root = dict(doc)
+    current = root
+    for part in path.split('.')[:-1]:
+        child = current.get(part)
+        if not isinstance(child, dict):
+            break
+        current[part] = dict(child)
+        current = current[part]
+    return root
+
+
+def _accumulate(op: str, expr: Any, docs: list[dict]) -> Any:
+    if op == '$count':
+        return len(docs)
+    values = [evaluate(expr, doc) for doc in docs]
+    if op == '$sum':
+        return sum(_numbers(values))
+    if op == '$avg':
+        numbers = _numbers(values)
+        return sum(numbers) / len(numbers) if numbers else None
+    if op in ('$min', '$max'):
+        values = [v for v in values if v is not None]
+        if not values:
+            return None
+        return (min if op == '$min' else max)(values, key=cmp_to_key(compare))
+    if op == '$first':
+        return values[0] if values else None
+    if op == '$last':
+        return values[-1] if values else None
+    if op == '$push':
+        return values
+    if op == '$addToSet':
+        unique = {}
+        for value in values:
+            unique.setdefault(group_key(value), value)
+        return list(unique.values())
+    raise NotImplementedError(f"Acumulador no soportado: {op}")
+
+
+def _group(docs: list[dict], spec: dict) -> list[dict]:
+    groups: dict[str, tuple[Any, list]] = {}
+    for doc in docs:
+        key = evaluate(spec['_id'], doc)
+        groups.setdefault(group_key(key), (key, []))[1].append(doc)
+    result = []
+    for key, members in groups.values():
+        out = {'_id': key}
+        for name, accumulator in spec.items():
+            if name == '_id':
+                continue
+            (op, expr), = accumulator.items()
+            out[name] = _accumulate(op, expr, members)
+        result.append(out)
+    return result
+
+
+def _sort(docs: list[dict], spec: dict) -> list[dict]:
+    def cmp(a, b):
+        for path, direction in spec.items():
+            result = compare(get_path(a, path, _MISSING), get_path(b, path, _MISSING))
+            if result:
+                return result * direction
+        return 0
+    return sorted(docs, key=cmp_to_key(cmp))
+
+
+def run_stage(docs: list[dict], stage: dict) -> list[dict]:
+    (name, spec), = stage.items()
+    if name == '$match':
+        return [doc for doc in docs if matches(doc, spec)]
+    if name == '$project':
+        return [_project(doc, spec) for doc in docs]
+    if name in ('$addFields', '$set'):
+        result = []
+        for doc in docs:
+            new = dict(doc)
+            for path, expr in spec.items():
+                set_path(new, path, evaluate(expr, doc))
+            result.append(new)
+        return result
+    if name == '$unset':
+        paths = [spec] if isinstance(spec, str) else spec
+        return [_project(doc, {path: 0 for path in paths}) for doc in docs]
+    if name == '$sort':
+        return _sort(docs, spec)
+    if name == '$limit':
+        return docs[:spec]
+    if name == '$skip':
+        return docs[spec:]
+    if name == '$unwind':
+        return _unwind(docs, spec)
+    if name == '$group':
+        return _group(docs, spec)
+    if name == '$count':
+        return [{spec: len(docs)}] if docs else []
+    if name == '$replaceRoot':
+        return [evaluate(spec['newRoot'], doc) for doc in docs]
+    raise NotImplementedError(f"Etapa no soportada: {name}")
+
+
+def supports(pipeline: list[dict]) -> bool:
+    return all(next(iter(stage)) in SUPPORTED_STAGES for stage in pipeline)
+
+
+def run_pipeline(docs: list[dict], pipeline: list[dict]) -> list[dict]:
+    for stage in pipeline:
+        docs = run_stage(docs, stage)
+    return docs
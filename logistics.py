@@ -1,7 +1,9 @@
 import os
 import uuid
 from datetime import datetime, timedelta
-from neo4j import GraphDatabase
+import numpy as np
+import resources
+import instrumentation
 
 # Parámetros de transporte según el enunciado
 TRANSPORT_PARAMS = {
@@ -11,47 +13,198 @@ TRANSPORT_PARAMS = {
     "Marítimo": {"min_100km": 120, "carga_descarga": 20, "coste_100km": 0.3},
 }
 
+# Parámetros por código de transporte, para evaluar rutas en bloque
+TRANSPORTS = list(TRANSPORT_PARAMS)
+_TRANSPORT_CODES = {transporte: code for code, transporte in enumerate(TRANSPORTS)}
+_MIN_100KM = np.array([TRANSPORT_PARAMS[t]["min_100km"] for t in TRANSPORTS], dtype=float)
+_CARGA_DESCARGA = np.array([TRANSPORT_PARAMS[t]["carga_descarga"] for t in TRANSPORTS], dtype=float)
+_COSTE_100KM = np.array([TRANSPORT_PARAMS[t]["coste_100km"] for t in TRANSPORTS], dtype=float)
+
+# Capacidad de cada vehículo por tipo de transporte (kg, m³)
+VEHICLE_CAPACITY = {
+    "Carretera": {"peso_kg": 3500, "volumen_m3": 20},
+    "Ferrocarril": {"peso_kg": 60000, "volumen_m3": 150},
+    "Aéreo": {"peso_kg": 10000, "volumen_m3": 60},
+    "Marítimo": {"peso_kg": 250000, "volumen_m3": 1500},
+}
+
+# Margen para comparar capacidades en coma flotante
+_EPSILON = 1e-9
+
+
+def encode_routes(paths):
+    """
+    Codifica rutas como arrays n x L de distancia y código de transporte
+    (relleno: distancia 0 y código -1). Acepta caminos de Neo4j (o con
+    .nodes), cuyos RouteSegment aportan distancia_km y transporte, o
+    listas de (distancia_km, transporte).
+    """
+    # Listas planas y una sola asignación por array
+    flat_distances, flat_codes, lengths = [], [], []
+    for path in paths:
+        if hasattr(path, "nodes"):
+            path = [(node["distancia_km"], node["transporte"]) for node in path.nodes
+                    if node.get("distancia_km") and node.get("transporte")]
+        for distancia, transporte in path:
+            flat_distances.append(distancia)
+            flat_codes.append(_TRANSPORT_CODES[transporte])
+        lengths.append(len(path))
+    lengths = np.array(lengths, dtype=np.int64)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    columns = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    distances = np.zeros((len(lengths), int(lengths.max(initial=0))))
+    codes = np.full(distances.shape, -1, dtype=np.int64)
+    distances[rows, columns] = flat_distances
+    codes[rows, columns] = flat_codes
+    return distances, codes
+
+
+def evaluate_routes(distances, codes):
+    # Tiempo (min) y coste de todas las rutas a la vez; un cambio de
+    # transporte suma la carga/descarga del transporte nuevo
+    distances, codes = np.asarray(distances, dtype=float), np.asarray(codes)
+    hundreds = distances / 100
+    tiempo = (_MIN_100KM[codes] * hundreds).sum(axis=1)
+    coste = (_COSTE_100KM[codes] * hundreds).sum(axis=1)
+    if codes.shape[1] > 1:
+        previous, current = codes[:, :-1], codes[:, 1:]
+        switch = (previous >= 0) & (current >= 0) & (previous != current)
+        tiempo += np.where(switch, _CARGA_DESCARGA[current], 0).sum(axis=1)
+    return tiempo, coste
+
+
+def deadline_windows(now=None):
+    # Minutos disponibles por tipo de envío. Se calculan una vez por ciclo
+    # de planificación; `now` fijo hace las evaluaciones reproducibles
+    now = now or datetime.now()
+    # Tipo 1: antes de las 19h - 1h => 18h
+    limite_1 = now.replace(hour=19, minute=0, second=0, microsecond=0) - timedelta(hours=1)
+    # Tipo 2: al día siguiente antes de las 14h
+    limite_2 = (now + timedelta(days=1)).replace(hour=14, minute=0, second=0, microsecond=0)
+    return {
+        1: (limite_1 - now).total_seconds() / 60.0,
+        2: (limite_2 - now).total_seconds() / 60.0,
+        # Tipo 3: sin límite
+        3: float("inf"),
+    }
+
+
+def select_route(paths, tipo_envio, windows):
+    """
+    Ruta más barata de `paths` que llega a tiempo para tipo_envio.
+    Devuelve (índice, tiempo, coste) o None.
+    """
+    if tipo_envio not in windows or not len(paths):
+        return None
+    tiempo, coste = evaluate_routes(*encode_routes(paths))
+    valid = tiempo <= windows[tipo_envio]
+    if not valid.any():
+        return None
+    best = int(np.argmin(np.where(valid, coste, np.inf)))
+    return best, float(tiempo[best]), float(coste[best])
+
+
+def package_loads(compras):
+    # Peso (kg) y volumen (m³) de cada compra (la consulta 5, en bloque):
+    # los productos de todas las compras se aplanan en arrays y se suman
+    # por compra con bincount. Las dimensiones están en cm
+    ids, owner, pesos, dimensiones = [], [], [], []
+    for i, compra in enumerate(compras):
+        if hasattr(compra, "to_dict"):
+            compra = compra.to_dict()
+        ids.append(compra.get("_id"))
+        for producto in compra.get("productos") or []:
+            d = producto.get("dimensiones") or {}
+            owner.append(i)
+            pesos.append(producto.get("peso") or 0)
+            dimensiones.append((d.get("ancho") or 0, d.get("alto") or 0, d.get("profundidad") or 0))
+    owner = np.array(owner, dtype=np.int64)
+    volumenes = np.array(dimensiones, dtype=float).reshape(-1, 3).prod(axis=1) / 1e6
+    peso = np.bincount(owner, weights=np.array(pesos, dtype=float), minlength=len(ids))
+    volumen = np.bincount(owner, weights=volumenes, minlength=len(ids))
+    return ids, peso, volumen
+
+
+def first_fit_decreasing(peso, volumen, capacidad, restante=None):
+    """
+    Empaquetado first-fit decreasing en dos dimensiones (peso y volumen).
+    capacidad = (kg, m³) de cada vehículo nuevo; restante (k x 2) es la
+    capacidad libre de los k vehículos existentes, que se llenan primero.
+    Devuelve el vehículo de cada paquete y la capacidad libre final de
+    todos los vehículos usados (los existentes primero).
+    """
+    peso, volumen = np.asarray(peso, dtype=float), np.asarray(volumen, dtype=float)
+    capacidad = np.asarray(capacidad, dtype=float)
+    oversized = (peso > capacidad[0] + _EPSILON) | (volumen > capacidad[1] + _EPSILON)
+    if oversized.any():
+        raise ValueError(f"{int(oversized.sum())} paquetes superan la capacidad de un vehículo.")
+    existing = 0 if restante is None else len(restante)
+    free = np.empty((existing + len(peso), 2))
+    if existing:
+        free[:existing] = restante
+    opened = existing
+    bins = np.empty(len(peso), dtype=np.int64)
+    # Primero los paquetes que ocupan más fracción del vehículo
+    order = np.argsort(-np.maximum(peso / capacidad[0], volumen / capacidad[1]), kind="stable")
+    for item in order:
+        p, v = peso[item], volumen[item]
+        fits = (free[:opened, 0] >= p - _EPSILON) & (free[:opened, 1] >= v - _EPSILON)
+        target = int(fits.argmax()) if opened else 0
+        if not opened or not fits[target]:
+            target = opened
+            free[target] = capacidad
+            opened += 1
+        free[target, 0] -= p
+        free[target, 1] -= v
+        bins[item] = target
+    return bins, free[:opened]
+
 class LogisticsManager:
-    def __init__(self, uri, user, password):
-        # Conexión a Neo4j
-        self.driver = GraphDatabase.driver(uri, auth=(user, password))
+    def __init__(self, uri=None, user=None, password=None, capacities=None):
+        # Conexión a Neo4j compartida entre instancias (pool de resources)
+        self.driver = resources.get_neo4j_driver(uri, user, password)
+        self.capacities = {**VEHICLE_CAPACITY, **(capacities or {})}
 
     def close(self):
-        # Cierra la conexión
-        self.driver.close()
+        # El driver es compartido: se libera con resources.close_all()
+        self.driver = None
+
+    def _run(self, session, name, query, **params):
+        # Ejecuta la consulta y lee todos los registros, midiendo la duración con su nombre
+        started = instrumentation.start()
+        records = list(session.run(query, **params))
+        instrumentation.observe_neo4j(name, started)
+        return records
+
+    def _single(self, session, name, query, **params):
+        records = self._run(session, name, query, **params)
+        return records[0] if records else None
 
-    def get_optimal_route(self, start_name, end_name, tipo_envio):
+    def get_optimal_route(self, start_name, end_name, tipo_envio, now=None, windows=None):
         # Obtiene la ruta óptima usando shortestPath en un patrón City-(SEGMENT)-RouteSegment-(SEGMENT)-City
         # Sin direcciones, y con un único tipo de relación :SEGMENT
         with self.driver.session() as session:
-            result = session.run("""
+            result = self._run(session, "optimal_route", """
                 MATCH (start {name:$start_name}), (end {name:$end_name})
                 MATCH p = shortestPath((start)-[:SEGMENT*1..10]-(end))
                 RETURN p
             """, start_name=start_name, end_name=end_name)
 
-            candidate_paths = []
-            for record in result:
-                p = record["p"]
-                tiempo_total, coste_total = self._calcular_tiempo_coste_ruta(p)
-                # Verificar restricciones de tiempo
-                if self._cumple_restricciones(tipo_envio, tiempo_total):
-                    candidate_paths.append((p, tiempo_total, coste_total))
-
-            if not candidate_paths:
+            # Todas las candidatas se evalúan a la vez contra las ventanas
+            # de entrega (pasar windows para reutilizarlas en una oleada)
+            paths = [record["p"] for record in result]
+            best = select_route(paths, tipo_envio, windows or deadline_windows(now))
+            if best is None:
                 # No se encontraron rutas que cumplan restricciones
                 return None
 
-            # Ordenar por coste y devolver la mejor
-            candidate_paths.sort(key=lambda x: x[2])
-            best_path = candidate_paths[0]
-
+            index, tiempo_total, coste_total = best
             # Extraer las ciudades (nodos con 'name')
-            nodos = [n["name"] for n in best_path[0].nodes if "name" in n]
+            nodos = [n["name"] for n in paths[index].nodes if "name" in n]
             return {
                 "ruta": nodos,
-                "tiempo_total": best_path[1],
-                "coste_total": best_path[2]
+                "tiempo_total": tiempo_total,
+                "coste_total": coste_total
             }
 
     def _calcular_tiempo_coste_ruta(self, path):
@@ -78,23 +231,12 @@ class LogisticsManager:
 
         return tiempo_total, coste_total
 
-    def _cumple_restricciones(self, tipo_envio, tiempo_total):
-        # Calcula el tiempo disponible según tipo de envío
-        now = datetime.now()
-        if tipo_envio == 1:
-            # Antes de las 19h - 1h => 18h
-            limite = now.replace(hour=19, minute=0, second=0, microsecond=0) - timedelta(hours=1)
-            tiempo_disponible = (limite - now).total_seconds() / 60.0
-            return tiempo_total <= tiempo_disponible
-        elif tipo_envio == 2:
-            # Al día siguiente antes de las 14h
-            manana = now + timedelta(days=1)
-            limite = manana.replace(hour=14, minute=0, second=0, microsecond=0)
-            tiempo_disponible = (limite - now).total_seconds() / 60.0
-            return tiempo_total <= tiempo_disponible
-        elif tipo_envio == 3:
-            # Sin límite
-            return True
+    def _cumple_restricciones(self, tipo_envio, tiempo_total, now=None, windows=None):
+        # Compara con el tiempo disponible según tipo de envío
+        windows = windows or deadline_windows(now)
+        if tipo_envio not in windows:
+            return None
+        return tiempo_total <= windows[tipo_envio]
 
     def assign_vehicle_to_route(self, route_nodes, transporte):
         # Asigna vehículos a cada tramo (start->end) buscando un RouteSegment con transporte
@@ -104,12 +246,11 @@ class LogisticsManager:
             for i in range(len(route_nodes) - 1):
                 start = route_nodes[i]
                 end = route_nodes[i+1]
-                res = session.run("""
+                record = self._single(session, "find_segment", """
                     MATCH (start {name:$start})-[:SEGMENT]-(rs:RouteSegment {transporte:$transporte})-[:SEGMENT]-(end {name:$end})
                     OPTIONAL MATCH (v:Vehicle)-[:CUBRE]->(rs)
                     RETURN rs, v.unique_id AS vid LIMIT 1
                 """, start=start, end=end, transporte=transporte)
-                record = res.single()
 
                 if record is None:
                     # No existe tramo con ese transporte entre start y end
@@ -122,7 +263,7 @@ class LogisticsManager:
                 else:
                     # Crear un nuevo vehículo
                     unique_id = str(uuid.uuid4())
-                    new_v = session.run("""
+                    new_v = self._single(session, "create_vehicle", """
                         MATCH (start {name:$start})-[:SEGMENT]-(rs:RouteSegment {transporte:$transporte})-[:SEGMENT]-(end {name:$end})
                         CREATE (v:Vehicle {
                             unique_id: $unique_id,
@@ -131,15 +272,100 @@ class LogisticsManager:
                             timestamp:$ts
                         })-[:CUBRE]->(rs)
                         RETURN v.unique_id AS vid
-                    """, start=start, end=end, transporte=transporte, ts=datetime.now().isoformat(), unique_id=unique_id).single()
+                    """, start=start, end=end, transporte=transporte, ts=datetime.now().isoformat(), unique_id=unique_id)
                     vehicles_assigned.append(new_v["vid"])
 
         return vehicles_assigned
 
+    def plan_segment_loads(self, start, end, transporte, peso, volumen):
+        """
+        Reparte los paquetes de un tramo entre los vehículos que ya lo
+        cubren, según su carga, y crea vehículos nuevos solo cuando no
+        caben. Devuelve el vehículo asignado a cada paquete (mismo orden).
+        """
+        capacity = self.capacities[transporte]
+        capacidad = (capacity["peso_kg"], capacity["volumen_m3"])
+
+        def plan(tx):
+            record = self._single(tx, "segment_vehicles", """
+                MATCH (start {name:$start})-[:SEGMENT]-(rs:RouteSegment {transporte:$transporte})-[:SEGMENT]-(end {name:$end})
+                WITH rs LIMIT 1
+                // Cerrojo de escritura sobre el tramo: los planificadores del mismo
+                // tramo se serializan y ninguno reparte sobre cargas ya leídas por otro
+                REMOVE rs._lock
+                OPTIONAL MATCH (v:Vehicle)-[:CUBRE]->(rs)
+                WITH rs, v ORDER BY v.timestamp, v.unique_id
+                RETURN id(rs) AS rs_id, collect({
+                    vid: v.unique_id,
+                    capacidad_kg: v.capacidad_kg, capacidad_m3: v.capacidad_m3,
+                    carga_kg: coalesce(v.carga_kg, 0.0), carga_m3: coalesce(v.carga_m3, 0.0)
+                }) AS vehicles
+            """, start=start, end=end, transporte=transporte)
+            if record is None:
+                raise ValueError("No existe el tramo solicitado con ese transporte.")
+
+            # collect() de un OPTIONAL MATCH vacío deja un mapa con vid nulo
+            vehicles = [v for v in record["vehicles"] if v["vid"] is not None]
+            restante = np.array([[(v["capacidad_kg"] or capacidad[0]) - v["carga_kg"],
+                                  (v["capacidad_m3"] or capacidad[1]) - v["carga_m3"]] for v in vehicles],
+                                dtype=float).reshape(-1, 2)
+            bins, free = first_fit_decreasing(peso, volumen, capacidad, restante)
+
+            vids = [v["vid"] for v in vehicles] + [str(uuid.uuid4()) for _ in range(len(free) - len(vehicles))]
+            used = np.zeros(len(free), dtype=bool)
+            used[bins] = True
+            updates = [{"vid": vids[i], "carga_kg": float((vehicles[i]["capacidad_kg"] or capacidad[0]) - free[i, 0]),
+                        "carga_m3": float((vehicles[i]["capacidad_m3"] or capacidad[1]) - free[i, 1])}
+                       for i in range(len(vehicles)) if used[i]]
+            new = [{"vid": vids[i], "carga_kg": float(capacidad[0] - free[i, 0]),
+                    "carga_m3": float(capacidad[1] - free[i, 1])} for i in range(len(vehicles), len(free))]
+            if updates:
+                self._run(tx, "update_vehicle_loads", """
+                    UNWIND $updates AS u
+                    MATCH (v:Vehicle {unique_id: u.vid})
+                    SET v.carga_kg = u.carga_kg, v.carga_m3 = u.carga_m3
+                """, updates=updates)
+            if new:
+                self._run(tx, "create_vehicles", """
+                    MATCH (rs) WHERE id(rs) = $rs_id
+                    UNWIND $new AS n
+                    CREATE (v:Vehicle {
+                        unique_id: n.vid,
+                        transporte: $transporte,
+                        last_node: $start,
+                        timestamp: $ts,
+                        capacidad_kg: $capacidad_kg,
+                        capacidad_m3: $capacidad_m3,
+                        carga_kg: n.carga_kg,
+                        carga_m3: n.carga_m3
+                    })-[:CUBRE]->(rs)
+                """, rs_id=record["rs_id"], new=new, transporte=transporte, start=start,
+                   ts=datetime.now().isoformat(), capacidad_kg=capacidad[0], capacidad_m3=capacidad[1])
+            return [vids[b] for b in bins]
+
+        # Lectura y escrituras en una transacción (reintentada si Neo4j lo pide)
+        with self.driver.session() as session:
+            return session.execute_write(plan)
+
+    def plan_route_loads(self, route_nodes, transporte, compras):
+        """
+        Planificación de carga de una oleada de compras que siguen la misma
+        ruta: calcula peso y volumen de cada una y las reparte por tramo.
+        Devuelve {compra_id: [vehículo de cada tramo]}, la entrada
+        vehicles_assigned de manage_package.
+        """
+        compra_ids, peso, volumen = package_loads(compras)
+        assigned = {compra_id: [] for compra_id in compra_ids}
+        for i in range(len(route_nodes) - 1):
+            vids = self.plan_segment_loads(route_nodes[i], route_nodes[i + 1], transporte, peso, volumen)
+            for compra_id, vid in zip(compra_ids, vids):
+                assigned[compra_id].append(vid)
+        return assigned
+
     def update_vehicle_position(self, vehicle_id, next_node):
         # Actualiza la posición del vehículo
         with self.driver.session() as session:
-            session.run("""
+            self._run(session, "update_vehicle", """
                 MATCH (v:Vehicle {unique_id: $vid})
                 SET v.last_node = $last_node, v.timestamp = $ts
             """, vid=vehicle_id, last_node=next_node, ts=datetime.now().isoformat())
@@ -147,7 +373,7 @@ class LogisticsManager:
     def manage_package(self, compra_id, tipo_envio, ruta_info, vehicles_assigned):
         # Crea un paquete y lo asocia a los vehículos
         with self.driver.session() as session:
-            package_res = session.run("""
+            p_record = self._single(session, "create_package", """
                 CREATE (p:Package {
                     compra_id:$compra_id,
                     tipo_envio:$tipo_envio,
@@ -159,11 +385,10 @@ class LogisticsManager:
             """, compra_id=str(compra_id), tipo_envio=tipo_envio,
                tiempo_total=ruta_info["tiempo_total"], coste_total=ruta_info["coste_total"],
                ruta="->".join(ruta_info["ruta"]), created_at=datetime.now().isoformat())
-            p_record = package_res.single()
             p_id = p_record["p"].id
 
             for vid in vehicles_assigned:
-                session.run("""
+                self._run(session, "link_package", """
                     MATCH (p:Package), (v:Vehicle {unique_id:$vid})
                     WHERE id(p) = $pid
                     CREATE (p)-[:USADO_POR]->(v)
@@ -174,10 +399,10 @@ class LogisticsManager:
     def get_package_status(self, package_id):
         # Devuelve el estado del paquete, incluyendo ubicacion_actual y tiempo_restante_aprox
         with self.driver.session() as session:
-            pkg = session.run("""
+            pkg = self._single(session, "package_status", """
                 MATCH (p:Package) WHERE id(p) = $pid
                 RETURN p.compra_id AS compra_id, p.ruta AS ruta, p.tiempo_total AS tiempo_total
-            """, pid=package_id).single()
+            """, pid=package_id)
 
             if not pkg:
                 return None
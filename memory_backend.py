@@ -0,0 +1,1118 @@
+import heapq
+import itertools
+import math
+import re
+import threading
+import unicodedata
+from bisect import bisect_left, bisect_right, insort
+from functools import cmp_to_key
+from typing import Any, Iterable, Iterator
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+import local_aggregate
+
+# Almacenamiento en memoria con la parte de la interfaz de pymongo que usa
+# el ODM (Model.db). Los documentos se guardan en un dict por _id y los
+# índices declarados se mantienen en cada escritura: de igualdad (hashed),
+# ordenados (1/-1, igualdad y rangos sobre el primer campo), una rejilla
+# para los campos 2dsphere y un índice invertido para los de texto. Las
+# consultas usan los índices para elegir candidatos y local_aggregate para
+# comprobar el filtro completo y ejecutar los pipelines. Pensado para tests
+# y reproducciones sin servidor: los TTL no caducan documentos, los índices
+# de texto no aplican raíces ni palabras vacías y las etapas que
+# local_aggregate no soporta lanzan NotImplementedError.
+
+# Radio terrestre que usa Mongo en las consultas esféricas (metros)
+EARTH_RADIUS_M = 6378100.0
+# Lado de las celdas de la rejilla geoespacial (grados)
+GRID_CELL_DEGREES = 0.1
+
+_GEO_OPS = {'$near', '$nearSphere', '$geoWithin', '$geoIntersects'}
+_RANGE_OPS = {'$gt', '$gte', '$lt', '$lte'}
+_ORDER = cmp_to_key(local_aggregate.compare)
+
+
+def _copy(value: Any) -> Any:
+    # Copia de documentos BSON (más rápida que deepcopy: los escalares son inmutables)
+    if isinstance(value, dict):
+        return {k: _copy(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_copy(v) for v in value]
+    return value
+
+
+def _hash_key(value: Any) -> Any:
+    # Clave de igualdad al estilo de Mongo: 1 == 1.0, pero True != 1
+    if isinstance(value, (dict, list)):
+        return 4, local_aggregate.group_key(value)
+    return local_aggregate.type_rank(value), value
+
+
+def _is_scalar(value: Any) -> bool:
+    return not isinstance(value, (dict, list, re.Pattern))
+
+
+def _is_operator(condition: Any) -> bool:
+    return isinstance(condition, dict) and bool(condition) and all(k.startswith('$') for k in condition)
+
+
+def _field_values(doc: Any, parts: list[str], out: list) -> None:
+    # Valores de una ruta recorriendo arrays; los arrays finales aportan cada elemento
+    if isinstance(doc, list):
+        for item in doc:
+            _field_values(item, parts, out)
+    elif not parts:
+        out.append(doc)
+    elif isinstance(doc, dict) and parts[0] in doc:
+        _field_values(doc[parts[0]], parts[1:], out)
+
+
+def index_values(doc: dict, path: str) -> list:
+    # Valores que indexa Mongo para un documento (multiclave); un campo ausente cuenta como null
+    values = []
+    _field_values(doc, path.split('.'), values)
+    return values or [None]
+
+
+def _points(value: Any) -> list[tuple[float, float]]:
+    # Puntos GeoJSON o pares [lon, lat], también dentro de arrays
+    if isinstance(value, dict):
+        if value.get('type') == 'Point':
+            return [(float(value['coordinates'][0]), float(value['coordinates'][1]))]
+        return []
+    if isinstance(value, list):
+        if len(value) == 2 and all(isinstance(c, (int, float)) and not isinstance(c, bool) for c in value):
+            return [(float(value[0]), float(value[1]))]
+        return [point for item in value for point in _points(item)]
+    return []
+
+
+def haversine_m(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _in_ring(lon: float, lat: float, ring: list) -> bool:
+    # Par/impar con aristas planas en (lon, lat), como zones.py
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+        if (y1 > lat) != (y2 > lat) and lon < (x2 - x1) * (lat - y1) / (y2 - y1) + x1:
+            inside = not inside
+    return inside
+
+
+def _in_polygon(lon: float, lat: float, rings: list) -> bool:
+    rings = [[tuple(p[:2]) for p in ring] for ring in rings]
+    return _in_ring(lon, lat, rings[0]) and not any(_in_ring(lon, lat, hole) for hole in rings[1:])
+
+
+def _normalize_text(text: str) -> str:
+    # Minúsculas y sin diacríticos, como los índices de texto de Mongo (versión 3)
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def _tokens(text: str) -> list[str]:
+    return re.findall(r'\w+', _normalize_text(text))
+
+
+def _strings(value: Any) -> list[str]:
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, list):
+        return [s for item in value for s in _strings(item)]
+    return []
+
+
+# ---------------------------------------------------------
+# Índices
+
+class HashIndex:
+    """
+    Índice de igualdad sobre el primer campo de la clave: valor -> claves
+    de los documentos que lo contienen (un documento con un array aparece
+    en cada uno de sus elementos). Con unique comprueba la clave completa.
+    """
+
+    def __init__(self, name: str, keys: list[tuple], unique: bool = False, sparse: bool = False,
+                 partial: dict = None):
+        self.name = name
+        self.keys = keys
+        self.field = keys[0][0]
+        self.unique = unique
+        self.sparse = sparse
+        self.partial = partial
+        self._entries: dict[Any, tuple[Any, set]] = {}
+        # Como en Mongo, basta un documento con varios valores (arrays) para
+        # que el índice sea multiclave para siempre
+        self.multikey = False
+
+    @property
+    def plannable(self) -> bool:
+        # Los índices parciales o dispersos no contienen todos los documentos
+        return not self.sparse and self.partial is None
+
+    def covers(self, doc: dict) -> bool:
+        if self.partial is not None and not local_aggregate.matches(doc, self.partial):
+            return False
+        if self.sparse and all(local_aggregate.get_path(doc, field) is None for field, _ in self.keys):
+            return False
+        return True
+
+    def values(self, doc: dict) -> list:
+        return index_values(doc, self.field)
+
+    def add(self, key: Any, doc: dict) -> None:
+        if not self.covers(doc):
+            return
+        values = self.values(doc)
+        if len(values) > 1:
+            self.multikey = True
+        for value in values:
+            entry = self._entries.get(_hash_key(value))
+            if entry is None:
+                self._entries[_hash_key(value)] = (value, {key})
+                self._added(value)
+            else:
+                entry[1].add(key)
+
+    def remove(self, key: Any, doc: dict) -> None:
+        if not self.covers(doc):
+            return
+        for value in self.values(doc):
+            hashed = _hash_key(value)
+            entry = self._entries.get(hashed)
+            if entry is not None:
+                entry[1].discard(key)
+                if not entry[1]:
+                    del self._entries[hashed]
+                    self._removed(value)
+
+    def _added(self, value: Any) -> None:
+        pass
+
+    def _removed(self, value: Any) -> None:
+        pass
+
+    def lookup(self, value: Any) -> set:
+        entry = self._entries.get(_hash_key(value))
+        return set(entry[1]) if entry else set()
+
+    def _unique_keys(self, doc: dict) -> set:
+        per_field = [{_hash_key(v) for v in index_values(doc, field)} for field, _ in self.keys]
+        return set(itertools.product(*per_field))
+
+    def conflict(self, key: Any, doc: dict, documents: dict) -> Any:
+        # Valor duplicado si otro documento tiene la misma clave completa
+        if not self.unique or not self.covers(doc):
+            return None
+        own = self._unique_keys(doc)
+        for value in self.values(doc):
+            for other in self.lookup(value) - {key}:
+                if own & self._unique_keys(documents[other]):
+                    return value
+        return None
+
+
+class SortedIndex(HashIndex):
+    """
+    Índice ordenado: además de la tabla de igualdad mantiene los valores
+    distintos ordenados como en Mongo para resolver rangos con bisección.
+    Las altas se insertan en orden al consultar (o se reordena todo si
+    hay muchas pendientes) y las bajas se descartan al recorrer.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self._sorted: list = []
+        self._pending: list = []
+        self._stale = 0
+
+    def _added(self, value: Any) -> None:
+        self._pending.append(value)
+
+    def _removed(self, value: Any) -> None:
+        self._stale += 1
+
+    def _ordered(self) -> list:
+        if self._stale > len(self._sorted) // 2 or len(self._pending) > max(64, len(self._sorted) // 8):
+            self._sorted = sorted((value for value, _ in self._entries.values()), key=_ORDER)
+            self._stale = 0
+        else:
+            for value in self._pending:
+                insort(self._sorted, value, key=_ORDER)
+        self._pending = []
+        return self._sorted
+
+    def range(self, low: Any = None, high: Any = None, low_inclusive: bool = True,
+              high_inclusive: bool = True) -> set:
+        # Solo valores del mismo tipo BSON que los límites, como los operadores de rango
+        rank = local_aggregate.type_rank(high if low is None else low)
+        values = self._ordered()
+        if low is None:
+            start = bisect_left(values, rank, key=local_aggregate.type_rank)
+        else:
+            start = (bisect_left if low_inclusive else bisect_right)(values, _ORDER(low), key=_ORDER)
+        if high is None:
+            end = bisect_left(values, rank + 1, key=local_aggregate.type_rank)
+        else:
+            end = (bisect_right if high_inclusive else bisect_left)(values, _ORDER(high), key=_ORDER)
+        keys = set()
+        seen = set()
+        for value in values[start:end]:
+            hashed = _hash_key(value)
+            if hashed not in seen:
+                seen.add(hashed)
+                entry = self._entries.get(hashed)
+                if entry is not None:
+                    keys |= entry[1]
+        return keys
+
+
+class GridIndex(HashIndex):
+    """
+    Índice geoespacial: celdas de GRID_CELL_DEGREES en (lon, lat) -> claves
+    de los documentos con algún punto en la celda. Da los candidatos de
+    $near y $geoWithin a partir de la caja que envuelve la consulta.
+    """
+
+    def values(self, doc: dict) -> list:
+        points = _points(local_aggregate.get_path(doc, self.field))
+        return list({self.cell(lon, lat) for lon, lat in points})
+
+    @staticmethod
+    def cell(lon: float, lat: float) -> tuple[int, int]:
+        return math.floor(lon / GRID_CELL_DEGREES), math.floor(lat / GRID_CELL_DEGREES)
+
+    def box(self, min_lon: float, min_lat: float, max_lon: float, max_lat: float) -> set | None:
+        if min_lon < -180 or max_lon > 180:
+            # La caja cruza el antimeridiano: se recorre la colección
+            return None
+        (x1, y1), (x2, y2) = self.cell(min_lon, min_lat), self.cell(max_lon, max_lat)
+        keys = set()
+        if (x2 - x1 + 1) * (y2 - y1 + 1) > len(self._entries):
+            # Caja grande: es más barato recorrer las celdas ocupadas
+            for (x, y), members in self._entries.values():
+                if x1 <= x <= x2 and y1 <= y <= y2:
+                    keys |= members
+            return keys
+        for x in range(x1, x2 + 1):
+            for y in range(y1, y2 + 1):
+                entry = self._entries.get(_hash_key((x, y)))
+                if entry is not None:
+                    keys |= entry[1]
+        return keys
+
+
+class TextIndex(HashIndex):
+    """Índice invertido de los campos de texto: palabra normalizada -> claves."""
+
+    def __init__(self, *args: Any, weights: dict = None, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.fields = [field for field, direction in self.keys if direction == 'text']
+        self.weights = weights or {field: 1 for field in self.fields}
+
+    def values(self, doc: dict) -> list:
+        return list({token for field in self.fields
+                     for text in _strings(local_aggregate.get_path(doc, field))
+                     for token in _tokens(text)})
+
+    def texts(self, doc: dict) -> list[tuple[str, int]]:
+        # (texto normalizado, peso) de cada campo de texto del documento
+        return [(_normalize_text(text), self.weights.get(field, 1)) for field in self.fields
+                for text in _strings(local_aggregate.get_path(doc, field))]
+
+
+def _index_keys(keys: Any, direction: Any = 1) -> list[tuple]:
+    if isinstance(keys, str):
+        return [(keys, direction)]
+    return [(k, 1) if isinstance(k, str) else (k[0], k[1]) for k in keys]
+
+
+def _make_index(name: str, keys: list[tuple], options: dict) -> HashIndex:
+    kind = keys[0][1]
+    args = dict(unique=bool(options.get('unique')), sparse=bool(options.get('sparse')),
+                partial=options.get('partialFilterExpression'))
+    if any(direction == 'text' for _, direction in keys):
+        return TextIndex(name, keys, weights=options.get('weights'), **args)
+    if kind in ('2dsphere', '2d'):
+        return GridIndex(name, keys, **args)
+    if kind == 'hashed':
+        return HashIndex(name, keys, **args)
+    return SortedIndex(name, keys, **args)
+
+
+# ---------------------------------------------------------
+# Actualizaciones
+
+def _unset_path(doc: Any, parts: list[str]) -> None:
+    if isinstance(doc, list):
+        for item in doc:
+            _unset_path(item, parts)
+    elif isinstance(doc, dict):
+        if len(parts) == 1:
+            doc.pop(parts[0], None)
+        elif parts[0] in doc:
+            _unset_path(doc[parts[0]], parts[1:])
+
+
+def _pull_matches(item: Any, condition: Any) -> bool:
+    if _is_operator(condition):
+        return local_aggregate.matches({'v': item}, {'v': condition})
+    if isinstance(condition, dict) and isinstance(item, dict):
+        return local_aggregate.matches(item, condition)
+    return local_aggregate.compare(item, condition) == 0
+
+
+def apply_update(doc: dict, update: dict | list, inserting: bool = False) -> dict:
+    # Devuelve el documento actualizado (una copia): operadores $, reemplazo o pipeline
+    if isinstance(update, list):
+        result = local_aggregate.run_pipeline([_copy(doc)], update)[0]
+        result['_id'] = doc['_id']
+        return result
+    if not any(key.startswith('$') for key in update):
+        result = {'_id': doc['_id']} if '_id' in doc else {}
+        result.update(_copy(update))
+        return result
+    result = _copy(doc)
+    for op, fields in update.items():
+        if op == '$setOnInsert' and not inserting:
+            continue
+        for path, arg in fields.items():
+            current = local_aggregate.get_path(result, path)
+            if op in ('$set', '$setOnInsert'):
+                local_aggregate.set_path(result, path, _copy(arg))
+            elif op == '$unset':
+                _unset_path(result, path.split('.'))
+            elif op == '$inc':
+                local_aggregate.set_path(result, path, (current or 0) + arg)
+            elif op == '$mul':
+                local_aggregate.set_path(result, path, (current or 0) * arg)
+            elif op in ('$min', '$max'):
+                order = 0 if current is None else local_aggregate.compare(arg, current)
+                if current is None or (order < 0 if op == '$min' else order > 0):
+                    local_aggregate.set_path(result, path, _copy(arg))
+            elif op in ('$push', '$addToSet'):
+                items = arg['$each'] if isinstance(arg, dict) and '$each' in arg else [arg]
+                array = list(current) if isinstance(current, list) else []
+                for item in items:
+                    if op == '$push' or not any(local_aggregate.compare(item, v) == 0 for v in array):
+                        array.append(_copy(item))
+                local_aggregate.set_path(result, path, array)
+            elif op == '$pull':
+                if isinstance(current, list):
+                    local_aggregate.set_path(result, path, [v for v in current if not _pull_matches(v, arg)])
+            else:
+                raise NotImplementedError(f"Operador de actualización no soportado: {op}")
+    return result
+
+
+def _upsert_base(filter: dict) -> dict:
+    # Campos de igualdad del filtro con los que se crea el documento de un upsert
+    doc = {}
+    for key, condition in filter.items():
+        if key == '$and':
+            for sub in condition:
+                doc.update(_upsert_base(sub))
+        elif key.startswith('$'):
+            continue
+        elif _is_operator(condition):
+            if '$eq' in condition:
+                local_aggregate.set_path(doc, key, _copy(condition['$eq']))
+        elif not isinstance(condition, re.Pattern):
+            local_aggregate.set_path(doc, key, _copy(condition))
+    return doc
+
+
+# ---------------------------------------------------------
+# Proyección y orden
+
+def _projection_dict(projection: dict | list | None) -> dict | None:
+    if isinstance(projection, (list, tuple)):
+        return {field: 1 for field in projection}
+    return projection
+
+
+def _project(doc: dict, projection: dict | None, meta: dict) -> dict:
+    if not projection:
+        return _copy(doc)
+    metas = {k: v['$meta'] for k, v in projection.items() if isinstance(v, dict) and '$meta' in v}
+    fields = {k: v for k, v in projection.items() if k not in metas and k != '_id'}
+    if fields and all(not v for v in fields.values()):
+        result = _copy(doc)
+        for path in fields:
+            _unset_path(result, path.split('.'))
+    elif fields:
+        result = _copy(local_aggregate.include(doc, local_aggregate.path_tree(fields)))
+    else:
+        result = _copy(doc)
+    if projection.get('_id', 1) and '_id' in doc:
+        result = {'_id': doc['_id'], **result}
+    else:
+        result.pop('_id', None)
+    for name, kind in metas.items():
+        result[name] = meta.get(kind)
+    return result
+
+
+def _sort_spec(key_or_list: Any, direction: Any = None) -> list[tuple]:
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction if direction is not None else 1)]
+    if isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return [tuple(item) for item in key_or_list]
+
+
+def _sort_key(spec: list[tuple]):
+    def cmp(a, b):
+        for path, direction in spec:
+            if isinstance(direction, dict):
+                # {'$meta': 'textScore'}: de mayor a menor puntuación
+                result = -local_aggregate.compare(a[1].get(direction['$meta']), b[1].get(direction['$meta']))
+            else:
+                result = local_aggregate.compare(local_aggregate.get_path(a[0], path),
+                                                 local_aggregate.get_path(b[0], path)) * direction
+            if result:
+                return result
+        return 0
+    return cmp_to_key(cmp)
+
+
+# ---------------------------------------------------------
+# Colecciones
+
+class MemoryCursor:
+    # Cursor perezoso de find(): sort/skip/limit se aplican al iterar
+    def __init__(self, collection: 'MemoryCollection', filter: dict, projection: dict | None):
+        self.collection = collection
+        self.filter = filter
+        self.projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._results: Iterator[dict] | None = None
+
+    def sort(self, key_or_list: Any, direction: Any = None) -> 'MemoryCursor':
+        self._sort = _sort_spec(key_or_list, direction)
+        return self
+
+    def skip(self, skip: int) -> 'MemoryCursor':
+        self._skip = skip
+        return self
+
+    def limit(self, limit: int) -> 'MemoryCursor':
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size: int) -> 'MemoryCursor':
+        return self
+
+    def _execute(self) -> list[dict]:
+        with self.collection._lock:
+            matched = self.collection._select(self.filter)
+            count = self._skip + self._limit if self._limit else None
+            if self._sort:
+                key = _sort_key(self._sort)
+                matched = heapq.nsmallest(count, matched, key=key) if count else sorted(matched, key=key)
+            matched = matched[self._skip:count]
+            return [_project(doc, self.projection, meta) for doc, meta in matched]
+
+    def __iter__(self) -> 'MemoryCursor':
+        return self
+
+    def __next__(self) -> dict:
+        if self._results is None:
+            self._results = iter(self._execute())
+        return next(self._results)
+
+    def close(self) -> None:
+        self._results = iter(())
+
+    def __enter__(self) -> 'MemoryCursor':
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+
+class MemoryCollection:
+    """
+    Colección en memoria. Admite los métodos de pymongo.Collection que usa
+    el proyecto (find, find_one, insert_*, update_*, replace_one, delete_*,
+    bulk_write, aggregate, count_documents, distinct y los de índices) con
+    los mismos resultados y errores (DuplicateKeyError, BulkWriteError).
+    """
+
+    def __init__(self, database: 'MemoryDatabase', name: str):
+        self.database = database
+        self.name = name
+        self._docs: dict[Any, dict] = {}
+        # Orden de inserción, para devolver los candidatos de un índice en orden natural
+        self._positions: dict[Any, int] = {}
+        self._counter = itertools.count()
+        self._indexes: dict[str, HashIndex] = {}
+        self._index_info: dict[str, dict] = {'_id_': {'key': [('_id', 1)], 'v': 2}}
+        self._lock = threading.RLock()
+
+    @property
+    def full_name(self) -> str:
+        return f"{self.database.name}.{self.name}"
+
+    def __repr__(self) -> str:
+        return f"MemoryCollection({self.full_name!r}, {len(self._docs)} documentos)"
+
+    # ---- Índices
+
+    def create_index(self, keys: Any, name: str = None, **options: Any) -> str:
+        keys = _index_keys(keys)
+        name = name or '_'.join(f"{field}_{direction}" for field, direction in keys)
+        info = {'key': keys, 'v': 2, **options}
+        if any(direction == 'text' for _, direction in keys):
+            info.setdefault('weights', {field: 1 for field, direction in keys if direction == 'text'})
+            info.setdefault('default_language', 'english')
+        with self._lock:
+            existing = self._index_info.get(name)
+            if existing is not None:
+                if existing != info:
+                    raise OperationFailure(f"Index with name: {name} already exists with different options", 85)
+                return name
+            index = _make_index(name, keys, options)
+            for key, doc in self._docs.items():
+                if index.conflict(key, doc, self._docs) is not None:
+                    raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.full_name} "
+                                            f"index: {name}", 11000)
+                index.add(key, doc)
+            self._indexes[name] = index
+            self._index_info[name] = info
+        return name
+
+    def drop_index(self, index_or_name: Any) -> None:
+        name = index_or_name
+        if not isinstance(name, str):
+            keys = _index_keys(index_or_name)
+            name = next((n for n, info in self._index_info.items() if info['key'] == keys), None)
+        with self._lock:
+            if name == '_id_' or name not in self._index_info:
+                raise OperationFailure(f"index not found with name [{name}]", 27)
+            del self._index_info[name]
+            del self._indexes[name]
+
+    def drop_indexes(self) -> None:
+        with self._lock:
+            self._indexes.clear()
+            self._index_info = {'_id_': self._index_info['_id_']}
+
+    def index_information(self) -> dict:
+        return {name: dict(info) for name, info in self._index_info.items()}
+
+    def list_indexes(self) -> Iterator[dict]:
+        return iter([{'name': name, **info} for name, info in self._index_info.items()])
+
+    def _field_index(self, field: str, kinds: tuple) -> HashIndex | None:
+        # Se prefiere un índice ordenado, que también resuelve rangos
+        found = None
+        for index in self._indexes.values():
+            if index.field == field and index.plannable and type(index) in kinds:
+                if type(index) is SortedIndex:
+                    return index
+                found = found or index
+        return found
+
+    # ---- Selección
+
+    def _field_candidates(self, field: str, condition: Any) -> set | None:
+        # Claves candidatas para una condición sobre un campo; None si ningún índice sirve
+        if _is_operator(condition) and _GEO_OPS & condition.keys():
+            return self._geo_candidates(field, condition)
+        if field == '_id':
+            lookup = lambda value: {_hash_key(value)} & self._docs.keys()
+            index = None
+        else:
+            index = self._field_index(field, (HashIndex, SortedIndex))
+            if index is None:
+                return None
+            lookup = index.lookup
+        if not _is_operator(condition):
+            return lookup(condition) if not isinstance(condition, (list, re.Pattern)) else None
+        keys = None
+        for op, arg in condition.items():
+            if op == '$eq' and _is_scalar(arg):
+                keys = _narrow(keys, lookup(arg))
+            elif op == '$in' and all(_is_scalar(a) for a in arg):
+                keys = _narrow(keys, set().union(*(lookup(a) for a in arg)))
+        bounds = {op: arg for op, arg in condition.items() if op in _RANGE_OPS and _is_scalar(arg)}
+        if bounds and isinstance(index, SortedIndex):
+            low = bounds.get('$gt', bounds.get('$gte'))
+            high = bounds.get('$lt', bounds.get('$lte'))
+            if index.multikey and low is not None:
+                # Cada límite puede cumplirlo un elemento distinto del array:
+                # se planifica con uno y matches() comprueba el otro
+                high = None
+            if low is not None and high is not None \
+                    and local_aggregate.type_rank(low) != local_aggregate.type_rank(high):
+                return set()
+            if low is not None or high is not None:
+                keys = _narrow(keys, index.range(low, high, '$gt' not in bounds, '$lt' not in bounds))
+        return keys
+
+    def _plan(self, filter: dict) -> set | None:
+        keys = None
+        for field, condition in filter.items():
+            if field == '$and':
+                for sub in condition:
+                    keys = _narrow(keys, self._plan(sub))
+            elif field == '$or':
+                branches = [self._plan(sub) for sub in condition]
+                if all(branch is not None for branch in branches):
+                    keys = _narrow(keys, set().union(*branches))
+            elif field == '$text':
+                keys = _narrow(keys, self._text_candidates(condition))
+            elif not field.startswith('$'):
+                keys = _narrow(keys, self._field_candidates(field, condition))
+        return keys
+
+    def _select(self, filter: dict | None) -> list[tuple[dict, dict]]:
+        # (documento, metadatos) que cumplen el filtro, en orden natural o de distancia con $near
+        filter = filter or {}
+        rest, checks = {}, []
+        for field, condition in filter.items():
+            if field == '$text':
+                checks.append(self._text_check(condition))
+            elif _is_operator(condition) and _GEO_OPS & condition.keys():
+                checks.append(self._geo_check(field, condition))
+            else:
+                rest[field] = condition
+        keys = self._plan(filter)
+        if keys is None:
+            docs = self._docs.values()
+        else:
+            docs = [self._docs[key] for key in sorted(keys, key=self._positions.__getitem__)]
+        matched = []
+        for doc in docs:
+            meta = {}
+            if all(check(doc, meta) for check in checks) and local_aggregate.matches(doc, rest):
+                matched.append((doc, meta))
+        if any('distance' in meta for _, meta in matched[:1]):
+            matched.sort(key=lambda item: item[1]['distance'])
+        return matched
+
+    # ---- Texto
+
+    def _text_index(self) -> TextIndex:
+        for index in self._indexes.values():
+            if isinstance(index, TextIndex):
+                return index
+        raise OperationFailure("text index required for $text query", 27)
+
+    @staticmethod
+    def _parse_search(search: str) -> tuple[list[str], list[str], list[str]]:
+        phrases = [_normalize_text(p) for p in re.findall(r'"([^"]*)"', search) if p.strip()]
+        words = re.sub(r'"[^"]*"', ' ', search).split()
+        terms = [t for word in words if not word.startswith('-') for t in _tokens(word)]
+        negated = [t for word in words if word.startswith('-') for t in _tokens(word[1:])]
+        return phrases, terms, negated
+
+    def _text_candidates(self, spec: dict) -> set:
+        index = self._text_index()
+        phrases, terms, _ = self._parse_search(spec['$search'])
+        if phrases:
+            keys = None
+            for token in (t for phrase in phrases for t in _tokens(phrase)):
+                keys = _narrow(keys, index.lookup(token))
+            return keys if keys is not None else set()
+        return set().union(*(index.lookup(term) for term in terms)) if terms else set()
+
+    def _text_check(self, spec: dict):
+        index = self._text_index()
+        phrases, terms, negated = self._parse_search(spec['$search'])
+        scored = terms + [t for phrase in phrases for t in _tokens(phrase)]
+
+        def check(doc: dict, meta: dict) -> bool:
+            texts = index.texts(doc)
+            tokens = [(re.findall(r'\w+', text), weight) for text, weight in texts]
+            if any(t in words for t in negated for words, _ in tokens):
+                return False
+            if phrases and not all(any(phrase in text for text, _ in texts) for phrase in phrases):
+                return False
+            score = sum(weight * words.count(t) for t in scored for words, weight in tokens)
+            meta['textScore'] = float(score)
+            return score > 0
+        return check
+
+    # ---- Geoespacial
+
+    def _geo_shape(self, condition: dict) -> tuple[str, Any]:
+        for op in ('$near', '$nearSphere'):
+            if op in condition:
+                spec = condition[op]
+                if not isinstance(spec, dict) or '$geometry' not in spec:
+                    raise NotImplementedError(f"Solo se admite {op} con $geometry (GeoJSON)")
+                lon, lat = spec['$geometry']['coordinates'][:2]
+                return 'near', (lon, lat, spec.get('$minDistance', 0), spec.get('$maxDistance', math.inf))
+        op = '$geoWithin' if '$geoWithin' in condition else '$geoIntersects'
+        spec = condition[op]
+        if '$centerSphere' in spec:
+            (lon, lat), radians = spec['$centerSphere']
+            return 'circle', (lon, lat, radians * EARTH_RADIUS_M)
+        if '$box' in spec:
+            (x1, y1), (x2, y2) = spec['$box']
+            return 'polygons', [[[[x1, y1], [x2, y1], [x2, y2], [x1, y2]]]]
+        if '$polygon' in spec:
+            return 'polygons', [[spec['$polygon']]]
+        geometry = spec.get('$geometry', {})
+        if geometry.get('type') == 'Polygon':
+            return 'polygons', [geometry['coordinates']]
+        if geometry.get('type') == 'MultiPolygon':
+            return 'polygons', geometry['coordinates']
+        raise NotImplementedError(f"Forma no soportada en {op}: {spec}")
+
+    def _geo_candidates(self, field: str, condition: dict) -> set | None:
+        index = self._field_index(field, (GridIndex,))
+        if index is None:
+            return None
+        kind, shape = self._geo_shape(condition)
+        if kind == 'polygons':
+            coords = [p for polygon in shape for p in polygon[0]]
+            return index.box(min(p[0] for p in coords), min(p[1] for p in coords),
+                             max(p[0] for p in coords), max(p[1] for p in coords))
+        lon, lat, radius = (shape[0], shape[1], shape[3]) if kind == 'near' else shape
+        if math.isinf(radius):
+            return None
+        dlat = math.degrees(radius / EARTH_RADIUS_M)
+        cos_lat = math.cos(math.radians(min(abs(lat) + dlat, 90.0)))
+        dlon = 180.0 if cos_lat < 1e-9 else min(math.degrees(radius / EARTH_RADIUS_M) / cos_lat, 180.0)
+        return index.box(lon - dlon, lat - dlat, lon + dlon, lat + dlat)
+
+    def _geo_check(self, field: str, condition: dict):
+        kind, shape = self._geo_shape(condition)
+
+        def check(doc: dict, meta: dict) -> bool:
+            points = _points(local_aggregate.get_path(doc, field))
+            if kind == 'polygons':
+                return any(_in_polygon(lon, lat, polygon) for lon, lat in points for polygon in shape)
+            distances = [haversine_m(shape[0], shape[1], lon, lat) for lon, lat in points]
+            if kind == 'circle':
+                return any(d <= shape[2] for d in distances)
+            inside = [d for d in distances if shape[2] <= d <= shape[3]]
+            if inside:
+                meta['distance'] = min(inside)
+            return bool(inside)
+        return check
+
+    # ---- Lectura
+
+    def find(self, filter: dict = None, projection: dict | list = None, sort: Any = None, skip: int = 0,
+             limit: int = 0, **kwargs: Any) -> MemoryCursor:
+        cursor = MemoryCursor(self, filter or {}, _projection_dict(projection)).skip(skip).limit(limit)
+        return cursor.sort(sort) if sort else cursor
+
+    def find_one(self, filter: Any = None, projection: dict | list = None, *args: Any, **kwargs: Any) -> dict | None:
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        return next(self.find(filter, projection, *args, **kwargs).limit(1), None)
+
+    def count_documents(self, filter: dict, **kwargs: Any) -> int:
+        with self._lock:
+            return len(self._select(filter))
+
+    def estimated_document_count(self, **kwargs: Any) -> int:
+        return len(self._docs)
+
+    def distinct(self, key: str, filter: dict = None, **kwargs: Any) -> list:
+        values = {}
+        with self._lock:
+            for doc, _ in self._select(filter):
+                found = []
+                _field_values(doc, key.split('.'), found)
+                for value in found:
+                    values.setdefault(_hash_key(value), value)
+        return [_copy(value) for value in values.values()]
+
+    def aggregate(self, pipeline: list[dict], **kwargs: Any) -> Iterator[dict]:
+        # El $match inicial usa los índices; el resto lo ejecuta local_aggregate
+        # salvo un $merge/$out final, que escribe en otra colección de la base
+        pipeline = list(pipeline)
+        output = pipeline.pop() if pipeline and next(iter(pipeline[-1])) in ('$merge', '$out') else None
+        with self._lock:
+            if pipeline and '$match' in pipeline[0]:
+                docs = [_copy(doc) for doc, _ in self._select(pipeline.pop(0)['$match'])]
+            else:
+                docs = [_copy(doc) for doc in self._docs.values()]
+        docs = local_aggregate.run_pipeline(docs, pipeline)
+        if output is None:
+            return iter(docs)
+        if '$out' in output:
+            target = self.database[output['$out']]
+            target.delete_many({})
+            target.insert_many(docs)
+        else:
+            self._merge(docs, output['$merge'])
+        return iter(())
+
+    def _merge(self, docs: list[dict], spec: dict | str) -> None:
+        if isinstance(spec, str):
+            spec = {'into': spec}
+        into = spec['into'] if isinstance(spec['into'], str) else spec['into']['coll']
+        target = self.database[into]
+        on = spec.get('on', '_id')
+        on = [on] if isinstance(on, str) else list(on)
+        matched_action = spec.get('whenMatched', 'merge')
+        with target._lock:
+            for doc in docs:
+                doc.setdefault('_id', ObjectId())
+                found = target._select({field: local_aggregate.get_path(doc, field) for field in on})
+                if not found:
+                    if spec.get('whenNotMatched', 'insert') == 'fail':
+                        raise OperationFailure("$merge could not find a matching document in the target collection", 13113)
+                    if spec.get('whenNotMatched', 'insert') == 'insert':
+                        target._insert(doc)
+                    continue
+                existing = found[0][0]
+                if matched_action == 'fail':
+                    raise self._duplicate('_id_', existing['_id'])
+                if matched_action == 'keepExisting':
+                    continue
+                if matched_action == 'replace':
+                    new = {**doc, '_id': existing['_id']}
+                elif matched_action == 'merge':
+                    new = {**_copy(existing), **doc, '_id': existing['_id']}
+                else:
+                    # Pipeline con $$new: el documento que llega
+                    new = _copy(existing)
+                    for stage in matched_action:
+                        (name, fields), = stage.items()
+                        if name not in ('$set', '$addFields'):
+                            new = local_aggregate.run_stage([new], stage)[0]
+                            continue
+                        updated = dict(new)
+                        for path, expr in fields.items():
+                            local_aggregate.set_path(updated, path,
+                                                     local_aggregate.evaluate(expr, new, {'new': doc}))
+                        new = updated
+                target._replace(_hash_key(existing['_id']), new)
+
+    # ---- Escritura
+
+    def _duplicate(self, index_name: str, value: Any) -> DuplicateKeyError:
+        return DuplicateKeyError(f"E11000 duplicate key error collection: {self.full_name} index: {index_name} "
+                                 f"dup key: {value!r}", 11000, {'code': 11000, 'keyValue': value})
+
+    def _insert(self, document: dict) -> Any:
+        # Como pymongo, añade el _id generado al documento recibido
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        doc = _copy(document)
+        key = _hash_key(doc['_id'])
+        if key in self._docs:
+            raise self._duplicate('_id_', doc['_id'])
+        for index in self._indexes.values():
+            value = index.conflict(key, doc, self._docs)
+            if value is not None:
+                raise self._duplicate(index.name, value)
+        self._docs[key] = doc
+        self._positions[key] = next(self._counter)
+        for index in self._indexes.values():
+            index.add(key, doc)
+        return doc['_id']
+
+    def _replace(self, key: Any, new: dict) -> bool:
+        old = self._docs[key]
+        # == no distingue 1, 1.0 y True; la serialización sí
+        if new == old and local_aggregate.group_key(new) == local_aggregate.group_key(old):
+            return False
+        for index in self._indexes.values():
+            value = index.conflict(key, new, self._docs)
+            if value is not None:
+                raise self._duplicate(index.name, value)
+        for index in self._indexes.values():
+            index.remove(key, old)
+        self._docs[key] = new
+        for index in self._indexes.values():
+            index.add(key, new)
+        return True
+
+    def _delete(self, key: Any) -> None:
+        doc = self._docs.pop(key)
+        del self._positions[key]
+        for index in self._indexes.values():
+            index.remove(key, doc)
+
+    def _update(self, filter: dict, update: dict | list, upsert: bool, multi: bool, replace: bool = False) -> dict:
+        if replace and any(key.startswith('$') for key in update):
+            raise ValueError("replacement can not include $ operators")
+        if not replace and isinstance(update, dict) and not any(key.startswith('$') for key in update):
+            raise ValueError("update only works with $ operators")
+        with self._lock:
+            matched = self._select(filter)
+            if not multi:
+                matched = matched[:1]
+            modified = 0
+            for doc, _ in matched:
+                new = apply_update(doc, update)
+                if new.get('_id', doc['_id']) != doc['_id']:
+                    raise OperationFailure("Performing an update on the path '_id' would modify the immutable field '_id'", 66)
+                modified += self._replace(_hash_key(doc['_id']), new)
+            result = {'n': len(matched), 'nModified': modified, 'ok': 1.0}
+            if not matched and upsert:
+                base = _upsert_base(filter)
+                new = apply_update(base, update, inserting=True)
+                if '_id' in base and '_id' not in new:
+                    new['_id'] = base['_id']
+                result.update(n=1, upserted=self._insert(new))
+            return result
+
+    def insert_one(self, document: dict, **kwargs: Any) -> InsertOneResult:
+        with self._lock:
+            return InsertOneResult(self._insert(document), True)
+
+    def insert_many(self, documents: Iterable[dict], ordered: bool = True, **kwargs: Any) -> InsertManyResult:
+        ids, errors = [], []
+        with self._lock:
+            for i, document in enumerate(documents):
+                try:
+                    ids.append(self._insert(document))
+                except DuplicateKeyError as e:
+                    errors.append({'index': i, 'code': 11000, 'errmsg': str(e), 'op': document})
+                    if ordered:
+                        break
+        if errors:
+            raise BulkWriteError({'writeErrors': errors, 'writeConcernErrors': [], 'nInserted': len(ids),
+                                  'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []})
+        return InsertManyResult(ids, True)
+
+    def update_one(self, filter: dict, update: dict | list, upsert: bool = False, **kwargs: Any) -> UpdateResult:
+        return UpdateResult(self._update(filter, update, upsert, multi=False), True)
+
+    def update_many(self, filter: dict, update: dict | list, upsert: bool = False, **kwargs: Any) -> UpdateResult:
+        return UpdateResult(self._update(filter, update, upsert, multi=True), True)
+
+    def replace_one(self, filter: dict, replacement: dict, upsert: bool = False, **kwargs: Any) -> UpdateResult:
+        return UpdateResult(self._update(filter, replacement, upsert, multi=False, replace=True), True)
+
+    def find_one_and_replace(self, filter: dict, replacement: dict, projection: dict | list = None,
+                             upsert: bool = False, return_document: bool = ReturnDocument.BEFORE,
+                             **kwargs: Any) -> dict | None:
+        # Lectura y reemplazo atómicos, como en Mongo
+        with self._lock:
+            before = self.find_one(filter)
+            result = self._update(filter, replacement, upsert, multi=False, replace=True)
+            if return_document == ReturnDocument.BEFORE:
+                return before and _project(before, _projection_dict(projection), {})
+            object_id = before['_id'] if before else result.get('upserted')
+            return None if object_id is None else self.find_one({'_id': object_id}, projection)
+
+    def find_one_and_delete(self, filter: dict, projection: dict | list = None, **kwargs: Any) -> dict | None:
+        with self._lock:
+            doc = self.find_one(filter)
+            if doc is not None:
+                self._delete(_hash_key(doc['_id']))
+            return doc and _project(doc, _projection_dict(projection), {})
+
+    def _delete_matching(self, filter: dict, multi: bool) -> int:
+        with self._lock:
+            matched = self._select(filter)
+            if not multi:
+                matched = matched[:1]
+            for doc, _ in matched:
+                self._delete(_hash_key(doc['_id']))
+            return len(matched)
+
+    def delete_one(self, filter: dict, **kwargs: Any) -> DeleteResult:
+        return DeleteResult({'n': self._delete_matching(filter, multi=False), 'ok': 1.0}, True)
+
+    def delete_many(self, filter: dict, **kwargs: Any) -> DeleteResult:
+        return DeleteResult({'n': self._delete_matching(filter, multi=True), 'ok': 1.0}, True)
+
+    def bulk_write(self, requests: list, ordered: bool = True, **kwargs: Any) -> BulkWriteResult:
+        # Operaciones de pymongo (InsertOne, UpdateOne, ReplaceOne, DeleteOne...)
+        totals = {'writeErrors': [], 'writeConcernErrors': [], 'nInserted': 0, 'nUpserted': 0,
+                  'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        with self._lock:
+            for i, request in enumerate(requests):
+                kind = type(request).__name__
+                try:
+                    if kind == 'InsertOne':
+                        self._insert(request._doc)
+                        totals['nInserted'] += 1
+                    elif kind in ('DeleteOne', 'DeleteMany'):
+                        totals['nRemoved'] += self._delete_matching(request._filter, multi=kind == 'DeleteMany')
+                    elif kind in ('UpdateOne', 'UpdateMany', 'ReplaceOne'):
+                        result = self._update(request._filter, request._doc, request._upsert,
+                                              multi=kind == 'UpdateMany', replace=kind == 'ReplaceOne')
+                        if 'upserted' in result:
+                            totals['nUpserted'] += 1
+                            totals['upserted'].append({'index': i, '_id': result['upserted']})
+                        else:
+                            totals['nMatched'] += result['n']
+                            totals['nModified'] += result['nModified']
+                    else:
+                        raise TypeError(f"Operación no soportada en bulk_write: {request!r}")
+                except DuplicateKeyError as e:
+                    totals['writeErrors'].append({'index': i, 'code': 11000, 'errmsg': str(e)})
+                    if ordered:
+                        break
+        if totals['writeErrors']:
+            raise BulkWriteError(totals)
+        return BulkWriteResult(totals, True)
+
+    def drop(self) -> None:
+        self.database.drop_collection(self.name)
+
+
+def _narrow(keys: set | None, candidates: set | None) -> set | None:
+    # Intersección de candidatos; None significa "sin restricción"
+    if candidates is None:
+        return keys
+    if keys is None:
+        return candidates
+    return keys & candidates if len(keys) <= len(candidates) else candidates & keys
+
+
+class MemoryDatabase:
+    # Base de datos en memoria: colecciones creadas al pedirlas, como en pymongo
+    def __init__(self, name: str = 'odm'):
+        self.name = name
+        self._collections: dict[str, MemoryCollection] = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        return self.get_collection(name)
+
+    def __getattr__(self, name: str) -> MemoryCollection:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.get_collection(name)
+
+    def __repr__(self) -> str:
+        return f"MemoryDatabase({self.name!r})"
+
+    def get_collection(self, name: str, **options: Any) -> MemoryCollection:
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = self._collections[name] = MemoryCollection(self, name)
+            return collection
+
+    def list_collection_names(self, **kwargs: Any) -> list[str]:
+        return [name for name, collection in self._collections.items()
+                if collection._docs or collection._indexes]
+
+    def drop_collection(self, name: str) -> None:
+        with self._lock:
+            collection = self._collections.pop(name, None)
+        if collection is not None:
+            with collection._lock:
+                collection._docs.clear()
+                collection._positions.clear()
+                collection.drop_indexes()
+
+    def command(self, command: str | dict, *args: Any, **kwargs: Any) -> dict:
+        name = command if isinstance(command, str) else next(iter(command))
+        if name == 'ping':
+            return {'ok': 1.0}
+        raise NotImplementedError(f"Comando no soportado en memoria: {name}")
@@ -1,24 +1,40 @@
-from typing import Any, Type, Generator
-import pymongo
-from pymongo import MongoClient, collection
-from bson import ObjectId
-from config import URL_DB, DB_NAME, CACHE_PORT, CACHE_HOST, CACHE_USERNAME, CACHE_PASSWORD
+from typing import Any, Type, Generator, TYPE_CHECKING
+from bson import ObjectId, json_util
+import config
+import resources
+from pipeline import Pipeline, optimize_pipeline
+import parallel_aggregate
+import instrumentation
+import columnar
+import circuit_breaker
+from index_advisor import ASCENDING, DESCENDING, GEOSPHERE
 import datetime
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut, GeocoderServiceError, GeocoderUnavailable
-from geojson import Point
 import logging
 import time
-import redis
 import json
 import threading
+import base64
+import hashlib
+import math
+import random
+
+# pymongo, geopy y asyncio no se importan al cargar el módulo: el cliente
+# de Mongo se crea en resources con la primera consulta, el geocodificador
+# con la primera Direccion sin ubicación y asyncio en la API asíncrona
+if TYPE_CHECKING:
+    from pymongo import collection
+    from geojson import Point
 
 # Configuración del logger
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
-def get_location_point(address: str) -> Point:
+def get_location_point(address: str) -> 'Point':
+    from geopy.geocoders import Nominatim
+    from geopy.exc import GeocoderTimedOut, GeocoderServiceError, GeocoderUnavailable
+    from geojson import Point
+
     geolocator = Nominatim(user_agent="ODM/1.1 (nestorvillap@gmail.com)", timeout=10)
     for attempt in range(5):
         try:
@@ -31,28 +47,213 @@ def get_location_point(address: str) -> Point:
     logger.warning(f"No se pudo obtener la ubicación para la dirección: {address}")
     return None
 
+def _cache_dumps(value: Any) -> str:
+    # Codec común para la caché síncrona y la asíncrona
+    return json.dumps(value, default=str)
+
+
+def _cache_loads(data: bytes | str) -> Any:
+    return json.loads(data)
+
+
+def _query_entry(data: bytes | str) -> dict | None:
+    # Los valores anteriores al sobre {'v', 'd', 'e'} (listas sueltas) cuentan como fallo
+    entry = _cache_loads(data)
+    if isinstance(entry, dict) and {'v', 'd', 'e'} <= entry.keys():
+        return entry
+    return None
+
+
+class UnloadedFieldError(AttributeError):
+    # Acceso a un campo que no se cargó en una consulta con proyección
+    pass
+
+
+def _projection_tree(projection) -> dict | None:
+    # Normaliza una proyección ("a", "b.c" o {"a": 1}) a un árbol {"a": True, "b": {"c": True}}
+    if projection is None:
+        return None
+    if isinstance(projection, dict):
+        if any(not v for v in projection.values()):
+            raise ValueError("Solo se admiten proyecciones de inclusión")
+        paths = projection.keys()
+    else:
+        paths = projection
+    tree = {}
+    for path in paths:
+        if path == '_id':
+            continue
+        node = tree
+        parts = path.split('.')
+        for part in parts[:-1]:
+            child = node.get(part)
+            if child is True:
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = True
+    return tree
+
+
+def _projection_paths(tree: dict, prefix: str = '') -> dict:
+    # Árbol de proyección -> proyección de Mongo con rutas con puntos
+    paths = {}
+    for key, sub in tree.items():
+        path = f"{prefix}{key}"
+        if sub is True:
+            paths[path] = 1
+        else:
+            paths.update(_projection_paths(sub, f"{path}."))
+    return paths
+
+
+def _get_path(doc: dict, path: str) -> Any:
+    for part in path.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+def _project_document(doc, tree: dict):
+    # Aplica localmente la proyección (p.ej. a un documento completo de la caché)
+    if isinstance(doc, list):
+        return [_project_document(item, tree) for item in doc]
+    if not isinstance(doc, dict):
+        return doc
+    projected = {'_id': doc['_id']} if '_id' in doc else {}
+    for key, sub in tree.items():
+        if key in doc:
+            projected[key] = doc[key] if sub is True else _project_document(doc[key], sub)
+    return projected
+
+
+class Index:
+    # Declaración de índice para Model._indexes: simple, compuesto, parcial o TTL
+    def __init__(self, keys, name: str = None, unique: bool = False, partial: dict = None,
+                 ttl: int = None, sparse: bool = False, **options: Any):
+        if isinstance(keys, str):
+            keys = [(keys, ASCENDING)]
+        elif isinstance(keys, tuple) and len(keys) == 2 and isinstance(keys[0], str) \
+                and not isinstance(keys[1], tuple):
+            # Forma antigua: ("campo", GEOSPHERE)
+            keys = [keys]
+        self.keys = [(k, ASCENDING) if isinstance(k, str) else tuple(k) for k in keys]
+        self.name = name or '_'.join(f"{field}_{direction}" for field, direction in self.keys)
+        self.options = dict(options)
+        if unique:
+            self.options['unique'] = True
+        if sparse:
+            self.options['sparse'] = True
+        if partial is not None:
+            self.options['partialFilterExpression'] = partial
+        if ttl is not None:
+            self.options['expireAfterSeconds'] = ttl
+
+    @classmethod
+    def from_spec(cls, spec) -> 'Index':
+        return spec if isinstance(spec, Index) else cls(spec)
+
+    @property
+    def text_fields(self) -> list[str]:
+        return [field for field, direction in self.keys if direction == 'text']
+
+    def _stored_keys(self) -> list[tuple]:
+        # Así describe Mongo un índice de texto: los campos de texto se
+        # agrupan en _fts/_ftsx y sus pesos van en "weights"
+        keys = []
+        for field, direction in self.keys:
+            if direction != 'text':
+                keys.append((field, direction))
+            elif ('_fts', 'text') not in keys:
+                keys += [('_fts', 'text'), ('_ftsx', 1)]
+        return keys
+
+    def matches(self, info: dict) -> bool:
+        # Compara con una entrada de collection.index_information()
+        keys = [(k, d) for k, d in info.get('key', [])]
+        if keys != [(k, d) for k, d in self.keys] and keys != self._stored_keys():
+            return False
+        for option in ('unique', 'sparse', 'partialFilterExpression', 'expireAfterSeconds'):
+            if info.get(option) != self.options.get(option):
+                return False
+        if self.text_fields and 'weights' in info:
+            weights = self.options.get('weights') or {field: 1 for field in self.text_fields}
+            if dict(info['weights']) != weights:
+                return False
+            if info.get('default_language', 'english') != self.options.get('default_language', 'english'):
+                return False
+        return True
+
+    def __repr__(self) -> str:
+        options = ''.join(f", {k}={v!r}" for k, v in self.options.items())
+        return f"Index({self.keys!r}{options})"
+
+
+_indexes_lock = threading.RLock()
+
+
 class Model:
     required_vars: set[str] = set()
     admissible_vars: set[str] = set()
-    db: collection.Collection = None
+    db: 'collection.Collection' = None
 
     # Campos para modelos anidados y fechas
     _embedded_list_fields: list[str] = []
     _embedded_fields: list[str] = []
     _model_classes: dict[str, Type['Model']] = {}
     _date_fields: set[str] = set()
+    # Referencias por _id a documentos de otro modelo: campo -> nombre del modelo
+    _reference_fields: dict[str, str] = {}
     _indexes: list = []
+    # Campo con la fecha de última escritura (marca de agua de las vistas)
+    _timestamp_field: str | None = None
 
-    # Referencias al cliente Redis de caché
+    # Referencias al cliente Redis de caché y a su cortocircuito
     r_cache = None
+    _cache_breaker = None
+
+    # TTLs de caché por modelo (segundos). _query_stale_ttl > 0 permite servir
+    # resultados caducados durante ese margen mientras un worker los recalcula
+    _cache_ttl: int = 86400
+    _query_cache_ttl: int = 86400
+    _query_stale_ttl: int = 0
+    # Expiración temprana probabilística (XFetch): mayor beta, antes se recalcula
+    _xfetch_beta: float = 1.0
+    # Tiempo máximo del cerrojo de recálculo de una consulta
+    _query_lock_timeout: float = 30.0
+
+    # Asesor de índices opcional (ver index_advisor.IndexAdvisor)
+    _index_advisor = None
+
+    # Subclases por (módulo, nombre), para resolver _reference_fields: las
+    # clases de ODM.initApp no sustituyen a las de models.py
+    _registry: dict[tuple[str, str], Type['Model']] = {}
+    # Observadores de escrituras de la clase: evento -> callbacks(clase, instancias)
+    _listeners: dict[str, list] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        Model._registry[cls.__module__, cls.__name__] = cls
+        cls._listeners = {}
 
     def __init__(self, **kwargs: Any):
         self._id = kwargs.pop('_id', None)
         if self._id and not isinstance(self._id, ObjectId):
             self._id = ObjectId(self._id)
         self._changed_fields = set()
+        # Carga parcial: árbol de proyección (None = documento completo)
+        self._fields_tree = kwargs.pop('_fields', None)
+        self._loaded_fields = None if self._fields_tree is None else set(self._fields_tree)
+        self._lazy = kwargs.pop('_lazy', False)
         self._process_and_set_attributes(kwargs)
 
+    @classmethod
+    def _from_document(cls, doc: dict, fields: dict = None, lazy: bool = False) -> 'Model':
+        if fields is None:
+            return cls(**doc)
+        return cls(_fields=fields, _lazy=lazy, **doc)
+
     def _process_and_set_attributes(self, attributes: dict):
         # Procesar campos anidados
         for field_name in self._embedded_list_fields + self._embedded_fields:
@@ -64,11 +265,20 @@ class Model:
             if field_name in attributes:
                 attributes[field_name] = self._process_date_field(field_name, attributes[field_name])
 
+        # Procesar referencias
+        for field_name in self._reference_fields:
+            if field_name in attributes:
+                attributes[field_name] = self._process_reference_field(field_name, attributes[field_name])
+
         self.validate_attributes(attributes)
         self.__dict__.update(attributes)
 
     def validate_attributes(self, attributes: dict[str, Any]) -> None:
-        missing_vars = self.required_vars - attributes.keys()
+        required_vars = self.required_vars
+        if self._loaded_fields is not None:
+            # En una carga parcial solo se exigen los campos proyectados
+            required_vars = required_vars & self._loaded_fields
+        missing_vars = required_vars - attributes.keys()
         if missing_vars:
             raise ValueError(f"Faltan variables requeridas: {missing_vars}")
         invalid_vars = attributes.keys() - (self.required_vars | self.admissible_vars)
@@ -79,7 +289,11 @@ class Model:
         if name.startswith('_'):
             super().__setattr__(name, value)
         elif name in self.required_vars or name in self.admissible_vars:
-            if getattr(self, name, None) != value:
+            if self._loaded_fields is not None and name not in self._loaded_fields:
+                # Campo no cargado: se marca como cargado sin consultarlo
+                self._loaded_fields.add(name)
+                self._changed_fields.add(name)
+            elif getattr(self, name, None) != value:
                 self._changed_fields.add(name)
             self.__dict__[name] = value
         else:
@@ -89,6 +303,37 @@ class Model:
             else:
                 raise AttributeError(f"No se puede asignar una variable no admitida: {name}")
 
+    def __getattr__(self, name: str) -> Any:
+        # Solo se llama cuando el atributo no existe en la instancia
+        loaded_fields = self.__dict__.get('_loaded_fields')
+        if (loaded_fields is not None and name not in loaded_fields
+                and (name in self.required_vars or name in self.admissible_vars)):
+            if self.__dict__.get('_lazy') and self.__dict__.get('_id') is not None:
+                self._load_fields({name})
+                if name in self.__dict__:
+                    return self.__dict__[name]
+            else:
+                raise UnloadedFieldError(
+                    f"El campo {name} no se cargó en la proyección de {type(self).__name__}")
+        raise AttributeError(f"'{type(self).__name__}' no tiene el atributo '{name}'")
+
+    @property
+    def is_partial(self) -> bool:
+        return self._loaded_fields is not None
+
+    def _load_fields(self, names: set[str]) -> None:
+        # Carga perezosa de campos no proyectados, sin marcarlos como cambiados
+        doc = self.db.find_one({'_id': self._id}, {n: 1 for n in names}) or {}
+        doc.pop('_id', None)
+        for field_name in self._embedded_list_fields + self._embedded_fields:
+            if field_name in doc:
+                doc[field_name] = self._process_embedded_field(field_name, doc[field_name], full=True)
+        for field_name in self._date_fields:
+            if field_name in doc:
+                doc[field_name] = self._process_date_field(field_name, doc[field_name])
+        self.__dict__.update(doc)
+        self._loaded_fields |= names
+
     def to_dict(self) -> dict:
         doc = {}
         for k, v in self.__dict__.items():
@@ -107,77 +352,427 @@ class Model:
     def to_update_dict(self) -> dict:
         update_doc = {}
         for field in self._changed_fields:
-            value = getattr(self, field)
-            if isinstance(value, Model):
-                update_doc[field] = value.to_dict()
-            elif isinstance(value, list):
-                update_doc[field] = [item.to_dict() if isinstance(item, Model) else item for item in value]
-            else:
-                update_doc[field] = value
+            self._add_update(update_doc, field, getattr(self, field))
         return update_doc
 
+    @staticmethod
+    def _add_update(update_doc: dict, path: str, value: Any) -> None:
+        # Un subdocumento parcial solo escribe sus campos cargados (rutas con
+        # puntos); una lista con elementos parciales borraría los no cargados
+        if isinstance(value, Model):
+            if value._loaded_fields is None:
+                update_doc[path] = value.to_dict()
+            else:
+                for name in value._loaded_fields:
+                    if name in value.__dict__:
+                        Model._add_update(update_doc, f"{path}.{name}", value.__dict__[name])
+        elif isinstance(value, list):
+            if any(isinstance(item, Model) and item._loaded_fields is not None for item in value):
+                raise ValueError(f"No se puede guardar {path}: contiene subdocumentos cargados parcialmente")
+            update_doc[path] = [item.to_dict() if isinstance(item, Model) else item for item in value]
+        else:
+            update_doc[path] = value
+
     def pre_save(self):
         pass
 
+    def post_save(self):
+        pass
+
+    def post_delete(self):
+        pass
+
+    @classmethod
+    def subscribe(cls, event: str, callback) -> None:
+        # event: 'post_save' o 'post_delete'. También recibe las escrituras
+        # de las subclases
+        cls._listeners.setdefault(event, []).append(callback)
+
+    @classmethod
+    def unsubscribe(cls, event: str, callback) -> None:
+        if callback in cls._listeners.get(event, []):
+            cls._listeners[event].remove(callback)
+
+    @classmethod
+    def _notify(cls, event: str, instances: list['Model']) -> None:
+        for klass in cls.__mro__:
+            for callback in list(klass.__dict__.get('_listeners', {}).get(event, [])):
+                callback(cls, instances)
+
+    def _touch(self) -> None:
+        if self._timestamp_field and (not self._id or self._changed_fields):
+            setattr(self, self._timestamp_field, datetime.datetime.now(datetime.timezone.utc))
+
+    def _check_insertable(self) -> None:
+        if self._loaded_fields is not None:
+            raise ValueError(f"No se puede insertar un {type(self).__name__} cargado parcialmente")
+
     def save(self) -> None:
         self.pre_save()
+        self._ensure_indexes()
+        self._touch()
         if self._id:
             if self._changed_fields:
                 self.db.update_one({"_id": self._id}, {"$set": self.to_update_dict()})
                 self._changed_fields.clear()
         else:
+            self._check_insertable()
             self._id = self.db.insert_one(self.to_dict()).inserted_id
             self._changed_fields.clear()
 
-        # Actualizar la caché con el objeto completo
-        self._cache_set(self._id, self.to_dict())
+        if self._loaded_fields is None:
+            # Actualizar la caché con el objeto completo
+            self._cache_set(self._id, self.to_dict())
+        else:
+            # Un objeto parcial no puede sustituir al documento cacheado
+            self._cache_delete(self._id)
+        self.post_save()
+        self._notify('post_save', [self])
+
+    @classmethod
+    def save_many(cls, instances: list['Model']) -> None:
+        # Guardado en lote: un insert_many para los nuevos, un bulk_write para
+        # los modificados y un único pipeline de Redis para la caché
+        from pymongo import UpdateOne
+
+        cls._ensure_indexes()
+        new, updates = [], []
+        for instance in instances:
+            instance.pre_save()
+            instance._touch()
+            if instance._id:
+                if instance._changed_fields:
+                    updates.append(UpdateOne({"_id": instance._id}, {"$set": instance.to_update_dict()}))
+            else:
+                instance._check_insertable()
+                new.append(instance)
+        if new:
+            inserted = cls.db.insert_many([instance.to_dict() for instance in new]).inserted_ids
+            for instance, object_id in zip(new, inserted):
+                instance._id = object_id
+        if updates:
+            cls.db.bulk_write(updates, ordered=False)
+        for instance in instances:
+            instance._changed_fields.clear()
+
+        if cls.r_cache and instances:
+            def write():
+                pipe = cls.r_cache.pipeline(transaction=False)
+                for instance in instances:
+                    if instance._loaded_fields is None:
+                        pipe.setex(cls._cache_key(str(instance._id)), cls._cache_ttl, _cache_dumps(instance.to_dict()))
+                    else:
+                        pipe.delete(cls._cache_key(str(instance._id)))
+                return pipe.execute()
+
+            if cls._cache_call('set_many', write, False) is False:
+                cls._defer_invalidation([cls._cache_key(str(instance._id)) for instance in instances])
+        for instance in instances:
+            instance.post_save()
+        if instances:
+            cls._notify('post_save', instances)
 
     def delete(self) -> None:
         if self._id:
             self.db.delete_one({"_id": self._id})
             # Eliminar de la caché
             self._cache_delete(self._id)
+            self.post_delete()
+            self._notify('post_delete', [self])
+
+    # API asíncrona (Motor + redis.asyncio) sobre las mismas declaraciones
+    @classmethod
+    def _async_db(cls):
+        # Mismo servidor que la colección síncrona si su cliente es del registro
+        uri = resources.mongo_uri(getattr(cls.db.database, 'client', None))
+        return resources.get_async_database(cls.db.database.name, uri)[cls.db.name]
+
+    async def asave(self) -> None:
+        self.pre_save()
+        if not type(self).__dict__.get('_indexes_ready', True):
+            import asyncio
+            await asyncio.to_thread(self._ensure_indexes)
+        self._touch()
+        adb = self._async_db()
+        if self._id:
+            if self._changed_fields:
+                await adb.update_one({"_id": self._id}, {"$set": self.to_update_dict()})
+                self._changed_fields.clear()
+        else:
+            self._check_insertable()
+            self._id = (await adb.insert_one(self.to_dict())).inserted_id
+            self._changed_fields.clear()
+
+        if self._loaded_fields is None:
+            await self._acache_set(self._id, self.to_dict())
+        else:
+            await self._acache_delete(self._id)
+        self.post_save()
+        self._notify('post_save', [self])
+
+    async def adelete(self) -> None:
+        if self._id:
+            await self._async_db().delete_one({"_id": self._id})
+            await self._acache_delete(self._id)
+            self.post_delete()
+            self._notify('post_delete', [self])
 
     @classmethod
     def _cache_key(cls, key: str) -> str:
         return f"{cls.__name__}:{key}"
 
+    # Todas las llamadas a Redis pasan por el cortocircuito: si la caché
+    # falla o está abierto se devuelve `default` y se sigue con Mongo. Las
+    # escrituras de objetos que no llegan a Redis se invalidan al recuperarse
+    @classmethod
+    def _cache_call(cls, operation: str, fn, default: Any = None) -> Any:
+        if cls._cache_breaker is None:
+            return fn()
+        return cls._cache_breaker.call(operation, fn, default, cls.__name__)
+
+    @classmethod
+    async def _acache_call(cls, operation: str, fn, default: Any = None) -> Any:
+        if cls._cache_breaker is None:
+            return await fn()
+        return await cls._cache_breaker.acall(operation, fn, default, cls.__name__)
+
+    @classmethod
+    def _cache_available(cls) -> bool:
+        return bool(cls.r_cache) and (cls._cache_breaker is None or cls._cache_breaker.allow())
+
+    @classmethod
+    def _defer_invalidation(cls, keys: list[str]) -> None:
+        if cls._cache_breaker is not None:
+            cls._cache_breaker.defer_delete(keys)
+
     @classmethod
     def _cache_set(cls, object_id: ObjectId, value: dict) -> None:
         if cls.r_cache:
-            cls.r_cache.setex(cls._cache_key(str(object_id)), 86400, json.dumps(value, default=str))
+            started = instrumentation.start()
+            key = cls._cache_key(str(object_id))
+            if cls._cache_call('set', lambda: cls.r_cache.setex(key, cls._cache_ttl, _cache_dumps(value)), False) is False:
+                cls._defer_invalidation([key])
+                return
+            instrumentation.observe_cache('set', cls.__name__, started)
 
     @classmethod
     def _cache_get(cls, object_id: ObjectId) -> dict:
         if cls.r_cache:
-            data = cls.r_cache.get(cls._cache_key(str(object_id)))
+            started = instrumentation.start()
+            key = cls._cache_key(str(object_id))
+            data = cls._cache_call('get', lambda: cls.r_cache.get(key))
+            instrumentation.observe_cache('get', cls.__name__, started, 'hit' if data else 'miss')
             if data:
                 # Renueva el TTL al acceder
-                cls.r_cache.expire(cls._cache_key(str(object_id)), 86400)
-                return json.loads(data)
+                cls._cache_call('expire', lambda: cls.r_cache.expire(key, cls._cache_ttl))
+                return _cache_loads(data)
         return None
 
     @classmethod
     def _cache_delete(cls, object_id: ObjectId) -> None:
         if cls.r_cache:
-            cls.r_cache.delete(cls._cache_key(str(object_id)))
+            started = instrumentation.start()
+            key = cls._cache_key(str(object_id))
+            if cls._cache_call('delete', lambda: cls.r_cache.delete(key), False) is False:
+                cls._defer_invalidation([key])
+                return
+            instrumentation.observe_cache('delete', cls.__name__, started)
 
     @classmethod
     def _cache_query_key(cls, query_name: str) -> str:
         return f"{cls.__name__}:query:{query_name}"
 
     @classmethod
-    def _cache_query_set(cls, key: str, results: list[dict]) -> None:
+    def _cache_query_set_key(cls) -> str:
+        # Conjunto con las claves de consulta del modelo: se invalidan todas
+        # sin recorrer el keyspace con SCAN
+        return f"{cls.__name__}:queries"
+
+    @classmethod
+    def _queue_query_set(cls, pipe, key: str, results: list[dict], delta: float) -> None:
+        ttl = cls._query_cache_ttl + cls._query_stale_ttl
+        pipe.setex(cls._cache_query_key(key), ttl, cls._query_envelope(results, delta))
+        pipe.sadd(cls._cache_query_set_key(), cls._cache_query_key(key))
+        pipe.expire(cls._cache_query_set_key(), ttl)
+
+    # Las consultas se guardan en un sobre {"v": resultados, "d": segundos que
+    # costó calcularlos, "e": caducidad lógica}. La clave vive en Redis
+    # _query_stale_ttl segundos más que su caducidad lógica.
+    @classmethod
+    def _query_envelope(cls, results: Any, delta: float) -> str:
+        return _cache_dumps({'v': results, 'd': delta, 'e': time.time() + cls._query_cache_ttl})
+
+    @classmethod
+    def _cache_query_set(cls, key: str, results: list[dict], delta: float = 0.0) -> None:
         if cls.r_cache:
-            cls.r_cache.setex(cls._cache_query_key(key), 86400, json.dumps(results, default=str))
+            started = instrumentation.start()
+            pipe = cls.r_cache.pipeline(transaction=False)
+            cls._queue_query_set(pipe, key, results, delta)
+            cls._cache_call('query_set', pipe.execute)
+            instrumentation.observe_cache('query_set', cls.__name__, started)
+
+    @classmethod
+    def _cache_query_entry(cls, key: str) -> dict | None:
+        if cls.r_cache:
+            started = instrumentation.start()
+            data = cls._cache_call('query_get', lambda: cls.r_cache.get(cls._cache_query_key(key)))
+            instrumentation.observe_cache('query_get', cls.__name__, started, 'hit' if data else 'miss')
+            if data:
+                return _query_entry(data)
+        return None
 
     @classmethod
     def _cache_query_get(cls, key: str) -> list[dict]:
+        entry = cls._cache_query_entry(key)
+        if entry is not None and time.time() < entry['e']:
+            return entry['v']
+        return None
+
+    @classmethod
+    def _query_lock(cls, key: str):
+        # thread_local=False: el cerrojo puede liberarse desde el hilo de refresco
+        return cls.r_cache.lock(f"{cls.__name__}:lock:{key}", timeout=cls._query_lock_timeout,
+                                blocking=False, thread_local=False)
+
+    @classmethod
+    def _compute_query(cls, key: str, compute) -> Any:
+        start = time.perf_counter()
+        results = compute()
+        cls._cache_query_set(key, results, time.perf_counter() - start)
+        return results
+
+    @classmethod
+    def _release_lock(cls, lock) -> None:
+        from redis.exceptions import LockError
+        try:
+            cls._cache_call('unlock', lock.release)
+        except LockError:
+            # El cálculo duró más que _query_lock_timeout: el cerrojo ya expiró
+            # (o es de otro worker) y el resultado sigue siendo válido
+            pass
+
+    @classmethod
+    def _refresh_query(cls, key: str, compute, lock) -> None:
+        try:
+            cls._compute_query(key, compute)
+        except Exception as e:
+            logger.warning(f"Error recalculando la consulta cacheada de {cls.__name__}: {e}")
+        finally:
+            cls._release_lock(lock)
+
+    @classmethod
+    def _cached_query(cls, key: str, compute) -> tuple[Any, bool]:
+        # Devuelve (resultados, desde_cache). Un solo worker recalcula cada
+        # consulta (cerrojo en Redis); el resto sirve el valor actual o espera.
+        # Con la caché caída se consulta directamente, sin cerrojo
+        if not cls._cache_available():
+            return compute(), False
+
+        entry = cls._cache_query_entry(key)
+        if entry is not None:
+            now = time.time()
+            # XFetch: now - d·beta·ln(U) >= e adelanta el recálculo de forma
+            # probabilística, más cuanto más cara es la consulta
+            early = now - entry['d'] * cls._xfetch_beta * math.log(1.0 - random.random()) >= entry['e']
+            if not early:
+                return entry['v'], True
+            lock = cls._query_lock(key)
+            if not cls._cache_call('lock', lock.acquire, False):
+                # Otro worker ya la está recalculando (o Redis no responde)
+                return entry['v'], True
+            if cls._query_stale_ttl > 0:
+                # stale-while-revalidate: se sirve el valor actual y se refresca en segundo plano
+                threading.Thread(target=cls._refresh_query, args=(key, compute, lock), daemon=True).start()
+                return entry['v'], True
+            try:
+                return cls._compute_query(key, compute), False
+            finally:
+                cls._release_lock(lock)
+
+        # Fallo de caché: single-flight
+        lock = cls._query_lock(key)
+        acquired = cls._cache_call('lock', lock.acquire, None)
+        if acquired is None:
+            return compute(), False
+        deadline = time.monotonic() + cls._query_lock_timeout
+        wait = 0.01
+        while not acquired:
+            if time.monotonic() >= deadline or not cls._cache_available():
+                # El worker que tenía el cerrojo no terminó a tiempo
+                return cls._compute_query(key, compute), False
+            time.sleep(wait)
+            wait = min(wait * 2, 0.5)
+            entry = cls._cache_query_entry(key)
+            if entry is not None:
+                return entry['v'], True
+            # Si el worker falló sin guardar nada, otro toma el cerrojo
+            acquired = cls._cache_call('lock', lock.acquire, False)
+        try:
+            return cls._compute_query(key, compute), False
+        finally:
+            cls._release_lock(lock)
+
+    # Variantes asíncronas de la caché: mismas claves y mismo codec
+    @classmethod
+    def _async_cache(cls):
         if cls.r_cache:
-            data = cls.r_cache.get(cls._cache_query_key(key))
+            return resources.get_async_redis_cache()
+        return None
+
+    @classmethod
+    async def _acache_set(cls, object_id: ObjectId, value: dict) -> None:
+        r_cache = cls._async_cache()
+        if r_cache:
+            started = instrumentation.start()
+            key = cls._cache_key(str(object_id))
+            if await cls._acache_call('set', lambda: r_cache.setex(key, cls._cache_ttl, _cache_dumps(value)),
+                                      False) is False:
+                cls._defer_invalidation([key])
+                return
+            instrumentation.observe_cache('set', cls.__name__, started)
+
+    @classmethod
+    async def _acache_get(cls, object_id: ObjectId) -> dict:
+        r_cache = cls._async_cache()
+        if r_cache:
+            started = instrumentation.start()
+            key = cls._cache_key(str(object_id))
+            data = await cls._acache_call('get', lambda: r_cache.get(key))
+            instrumentation.observe_cache('get', cls.__name__, started, 'hit' if data else 'miss')
+            if data:
+                await cls._acache_call('expire', lambda: r_cache.expire(key, cls._cache_ttl))
+                return _cache_loads(data)
+        return None
+
+    @classmethod
+    async def _acache_delete(cls, object_id: ObjectId) -> None:
+        r_cache = cls._async_cache()
+        if r_cache:
+            key = cls._cache_key(str(object_id))
+            if await cls._acache_call('delete', lambda: r_cache.delete(key), False) is False:
+                cls._defer_invalidation([key])
+
+    @classmethod
+    async def _acache_query_set(cls, key: str, results: list[dict], delta: float = 0.0) -> None:
+        r_cache = cls._async_cache()
+        if r_cache:
+            started = instrumentation.start()
+            pipe = r_cache.pipeline(transaction=False)
+            cls._queue_query_set(pipe, key, results, delta)
+            await cls._acache_call('query_set', pipe.execute)
+            instrumentation.observe_cache('query_set', cls.__name__, started)
+
+    @classmethod
+    async def _acache_query_get(cls, key: str) -> list[dict]:
+        r_cache = cls._async_cache()
+        if r_cache:
+            started = instrumentation.start()
+            data = await cls._acache_call('query_get', lambda: r_cache.get(cls._cache_query_key(key)))
+            instrumentation.observe_cache('query_get', cls.__name__, started, 'hit' if data else 'miss')
             if data:
-                cls.r_cache.expire(cls._cache_query_key(key), 86400)
-                return json.loads(data)
+                entry = _query_entry(data)
+                if entry is not None and time.time() < entry['e']:
+                    return entry['v']
         return None
 
     @classmethod
@@ -189,75 +784,398 @@ class Model:
         return json.dumps(p, sort_keys=True, default=str)
 
     @classmethod
-    def find(cls, filter: dict[str, Any]) -> 'ModelCursor':
-        # Guardar la consulta en cache
-        serialized_filter = cls._serialize_filter(filter)
-        cached = cls._cache_query_get(serialized_filter)
-        if cached is not None:
-            # Devuelve directamente desde cache
-            return ModelCursor(cls, cached, raw=False, from_cache=True)
+    def _serialize_find(cls, f: dict, fields: dict | None) -> str:
+        # Sin proyección se mantiene la clave de siempre
+        if fields is None:
+            return cls._serialize_filter(f)
+        return cls._serialize_filter({'filter': f, 'projection': _projection_paths(fields)})
 
-        # Si no está en caché, consultar la BD y guardar en caché
-        cursor = list(cls.db.find(filter))
-        cls._cache_query_set(serialized_filter, cursor)
-        return ModelCursor(cls, cursor, raw=False)
+    @classmethod
+    def find(cls, filter: dict[str, Any], projection=None, lazy: bool = False) -> 'ModelCursor':
+        # projection: campos a cargar ("nombre", "cliente.nombre"...). Los demás
+        # se cargan al acceder si lazy=True o lanzan UnloadedFieldError
+        fields = _projection_tree(projection)
+        if cls._index_advisor:
+            cls._index_advisor.record_find(cls, filter)
+        cls._ensure_indexes()
+        # Consulta cacheada; si no está en caché se lee de la BD y se guarda
+        serialized_filter = cls._serialize_find(filter, fields)
+        mongo_projection = None if fields is None else _projection_paths(fields)
+        results, from_cache = cls._cached_query(serialized_filter,
+                                                lambda: list(cls.db.find(filter, mongo_projection)))
+        return ModelCursor(cls, results, raw=False, from_cache=from_cache, fields=fields, lazy=lazy)
 
     @classmethod
-    def find_by_id(cls, id: Any) -> 'Model':
+    def _text_index(cls) -> Index | None:
+        for index in map(Index.from_spec, cls._indexes):
+            if index.text_fields:
+                return index
+        return None
+
+    @classmethod
+    def search(cls, text: str, filters: dict[str, Any] = None, phrase: bool = True, limit: int = None,
+               projection=None, lazy: bool = False) -> 'ModelCursor':
+        """
+        Búsqueda en el índice de texto del modelo (un Index con campos
+        "text"), de más a menos relevante. Con phrase=True el texto debe
+        aparecer entero, como con el $regex insensible a mayúsculas al que
+        sustituye; con phrase=False basta cualquiera de sus palabras.
+        filters se añade a la consulta ({"proveedores.nombre": ...}).
+        """
+        if cls._text_index() is None:
+            raise ValueError(f"{cls.__name__} no declara un índice de texto")
+        terms = ' '.join(text.replace('"', ' ').split())
+        if not terms:
+            raise ValueError("El texto de búsqueda está vacío")
+        query = {'$text': {'$search': f'"{terms}"' if phrase else terms}, **(filters or {})}
+        fields = _projection_tree(projection)
+        cls._ensure_indexes()
+        serialized = cls._serialize_filter({'search': query, 'limit': limit,
+                                            'projection': fields and _projection_paths(fields)})
+        mongo_projection = None if fields is None else _projection_paths(fields)
+
+        def compute():
+            cursor = cls.db.find(query, mongo_projection).sort([('score', {'$meta': 'textScore'})])
+            return list(cursor.limit(limit) if limit else cursor)
+
+        results, from_cache = cls._cached_query(serialized, compute)
+        return ModelCursor(cls, results, raw=False, from_cache=from_cache, fields=fields, lazy=lazy)
+
+    @classmethod
+    def find_by_id(cls, id: Any, projection=None, lazy: bool = False) -> 'Model':
         if isinstance(id, str):
             id = ObjectId(id)
+        fields = _projection_tree(projection)
 
         # Intentar obtener desde caché
         cached = cls._cache_get(id)
         if cached:
-            return cls(**cached)
+            if fields is not None:
+                cached = _project_document(cached, fields)
+            return cls._from_document(cached, fields, lazy)
 
         # Si no está en cache, buscar en Mongo
         try:
-            doc = cls.db.find_one({'_id': id})
-            if doc:
-                # Guardar en caché
-                cls._cache_set(id, doc)
-                return cls(**doc)
+            if fields is None:
+                doc = cls.db.find_one({'_id': id})
+                if doc:
+                    # Guardar en caché
+                    cls._cache_set(id, doc)
+                    return cls(**doc)
+            else:
+                # Los documentos parciales no se cachean bajo la clave del objeto
+                doc = cls.db.find_one({'_id': id}, _projection_paths(fields))
+                if doc:
+                    return cls._from_document(doc, fields, lazy)
+        except Exception as e:
+            logger.warning(f"Error finding document by ID: {e}")
+
+        return None
+
+    @classmethod
+    def pipeline(cls) -> Pipeline:
+        # Constructor encadenable: Compra.pipeline().match(...).unwind(...).run()
+        return Pipeline(cls)
+
+    @classmethod
+    def aggregate(cls, pipeline: list[dict] | Pipeline, raw: bool = False, optimize: bool = False,
+                  partitions: int = None, partition_field: str = '_id') -> 'ModelCursor':
+        if isinstance(pipeline, Pipeline):
+            pipeline = pipeline.to_list()
+        if optimize:
+            pipeline = optimize_pipeline(pipeline)
+        if cls._index_advisor:
+            cls._index_advisor.record_aggregate(cls, pipeline)
+        cls._ensure_indexes()
+        timings = []
+
+        def compute():
+            # partitions > 1: rangos de partition_field en paralelo y fusión
+            # local, si los acumuladores del primer $group lo permiten
+            if partitions and partitions > 1:
+                outcome = parallel_aggregate.run(cls.db, pipeline, partitions, partition_field)
+                if outcome is not None:
+                    results, partition_timings = outcome
+                    timings.extend(partition_timings)
+                    return results
+            return list(cls.db.aggregate(pipeline))
+
+        # Consulta cacheada (un único worker recalcula los pipelines pesados)
+        serialized_pipeline = cls._serialize_pipeline(pipeline)
+        results, from_cache = cls._cached_query(serialized_pipeline, compute)
+        cursor = ModelCursor(cls, results, raw=raw, from_cache=from_cache)
+        cursor.partition_timings = timings
+        return cursor
+
+    @classmethod
+    def export_columnar(cls, path: str, filter: dict[str, Any] = None, pipeline: list[dict] | Pipeline = None,
+                        projection=None, batch_size: int = 10000, **options: Any) -> dict:
+        # Volcado por lotes a Parquet/Arrow sin hidratar modelos ni pasar por la caché
+        if isinstance(pipeline, Pipeline):
+            pipeline = pipeline.to_list()
+        return columnar.export(cls.db, path, filter=filter, pipeline=pipeline, projection=projection,
+                               batch_size=batch_size, **options)
+
+    @classmethod
+    def import_columnar(cls, path: str, batch_size: int = 10000, **options: Any) -> dict:
+        # Inserción masiva (insert_many) de un fichero de export_columnar
+        return columnar.import_file(path, cls.db, batch_size=batch_size, **options)
+
+    # Paginación por clave (keyset): cada página filtra por los valores de
+    # ordenación del último documento, así que su coste no depende de la
+    # profundidad como ocurre con skip
+    @classmethod
+    def _normalize_sort(cls, sort) -> list[tuple[str, int]]:
+        if sort is None:
+            sort = [('_id', ASCENDING)]
+        elif isinstance(sort, str):
+            sort = [(sort, ASCENDING)]
+        sort = [(field, direction) for field, direction in sort]
+        if all(field != '_id' for field, _ in sort):
+            # _id desempata claves repetidas (p.ej. misma fecha_compra)
+            sort.append(('_id', sort[-1][1]))
+        return sort
+
+    @classmethod
+    def _query_signature(cls, filter: dict, sort: list) -> str:
+        return hashlib.sha1(cls._serialize_filter([filter, sort]).encode()).hexdigest()[:12]
+
+    @classmethod
+    def _encode_page_token(cls, signature: str, values: list) -> str:
+        data = json_util.dumps({'q': signature, 'v': values})
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    @classmethod
+    def _decode_page_token(cls, token: str, signature: str) -> list:
+        try:
+            data = json_util.loads(base64.urlsafe_b64decode(token.encode()))
+        except ValueError:
+            raise ValueError("Token de paginación no válido")
+        if not isinstance(data, dict) or not isinstance(data.get('v'), list):
+            raise ValueError("Token de paginación no válido")
+        if data.get('q') != signature:
+            raise ValueError("El token de paginación pertenece a otra consulta")
+        return data['v']
+
+    @staticmethod
+    def _keyset_filter(sort: list, values: list) -> dict:
+        # (k1 > v1) OR (k1 = v1 AND k2 > v2) OR ...
+        clauses = []
+        for i, (field, direction) in enumerate(sort):
+            clause = {f: v for (f, _), v in zip(sort[:i], values[:i])}
+            clause[field] = {'$gt' if direction == ASCENDING else '$lt': values[i]}
+            clauses.append(clause)
+        return {'$or': clauses}
+
+    @classmethod
+    def paginate(cls, filter: dict[str, Any], sort=None, page_size: int = 50,
+                 token: str = None, projection=None) -> 'Page':
+        sort = cls._normalize_sort(sort)
+        fields = _projection_tree(projection)
+        signature = cls._query_signature(filter, sort)
+        if cls._index_advisor:
+            cls._index_advisor.record_find(cls, filter, sort)
+        cls._ensure_indexes()
+        query = filter
+        if token:
+            query = {'$and': [filter, cls._keyset_filter(sort, cls._decode_page_token(token, signature))]}
+
+        # Cada página se cachea bajo las claves de consulta habituales. Se
+        # guarda el token calculado sobre los valores BSON originales, que la
+        # serialización JSON de la caché no conserva
+        serialized = cls._serialize_filter({'filter': filter, 'sort': sort, 'after': token,
+                                            'limit': page_size,
+                                            'projection': fields and _projection_paths(fields)})
+        mongo_projection = None
+        if fields is not None:
+            mongo_projection = _projection_paths(fields)
+            mongo_projection.update({field: 1 for field, _ in sort})
+
+        def compute():
+            docs = list(cls.db.find(query, mongo_projection).sort(sort).limit(page_size + 1))
+            next_token = None
+            if len(docs) > page_size:
+                docs = docs[:page_size]
+                next_token = cls._encode_page_token(signature, [_get_path(docs[-1], f) for f, _ in sort])
+            return {'docs': docs, 'next': next_token}
+
+        page, from_cache = cls._cached_query(serialized, compute)
+        items = ModelCursor(cls, page['docs'], raw=False, from_cache=from_cache, fields=fields)
+        return Page(items, page['next'])
+
+    @classmethod
+    def iter_pages(cls, filter: dict[str, Any], sort=None, page_size: int = 50,
+                   projection=None) -> Generator['Page', None, None]:
+        token = None
+        while True:
+            page = cls.paginate(filter, sort=sort, page_size=page_size, token=token, projection=projection)
+            yield page
+            if page.next_token is None:
+                break
+            token = page.next_token
+
+    @classmethod
+    async def afind(cls, filter: dict[str, Any], projection=None) -> 'AsyncModelCursor':
+        fields = _projection_tree(projection)
+        if not cls.__dict__.get('_indexes_ready', True):
+            import asyncio
+            await asyncio.to_thread(cls._ensure_indexes)
+        serialized_filter = cls._serialize_find(filter, fields)
+        cached = await cls._acache_query_get(serialized_filter)
+        if cached is not None:
+            return AsyncModelCursor(cls, cached, raw=False, from_cache=True, fields=fields)
+
+        if fields is None:
+            cursor = await cls._async_db().find(filter).to_list(None)
+        else:
+            cursor = await cls._async_db().find(filter, _projection_paths(fields)).to_list(None)
+        await cls._acache_query_set(serialized_filter, cursor)
+        return AsyncModelCursor(cls, cursor, raw=False, fields=fields)
+
+    @classmethod
+    async def afind_by_id(cls, id: Any, projection=None) -> 'Model':
+        if isinstance(id, str):
+            id = ObjectId(id)
+        fields = _projection_tree(projection)
+
+        cached = await cls._acache_get(id)
+        if cached:
+            if fields is not None:
+                cached = _project_document(cached, fields)
+            return cls._from_document(cached, fields)
+
+        try:
+            if fields is None:
+                doc = await cls._async_db().find_one({'_id': id})
+                if doc:
+                    await cls._acache_set(id, doc)
+                    return cls(**doc)
+            else:
+                doc = await cls._async_db().find_one({'_id': id}, _projection_paths(fields))
+                if doc:
+                    return cls._from_document(doc, fields)
         except Exception as e:
             logger.warning(f"Error finding document by ID: {e}")
 
         return None
 
     @classmethod
-    def aggregate(cls, pipeline: list[dict], raw: bool = False) -> 'ModelCursor':
-        # Guardar la consulta en cache
+    async def aaggregate(cls, pipeline: list[dict] | Pipeline, raw: bool = False,
+                         optimize: bool = False) -> 'AsyncModelCursor':
+        if isinstance(pipeline, Pipeline):
+            pipeline = pipeline.to_list()
+        if optimize:
+            pipeline = optimize_pipeline(pipeline)
+        if not cls.__dict__.get('_indexes_ready', True):
+            import asyncio
+            await asyncio.to_thread(cls._ensure_indexes)
         serialized_pipeline = cls._serialize_pipeline(pipeline)
-        cached = cls._cache_query_get(serialized_pipeline)
+        cached = await cls._acache_query_get(serialized_pipeline)
         if cached is not None:
-            return ModelCursor(cls, cached, raw=raw, from_cache=True)
+            return AsyncModelCursor(cls, cached, raw=raw, from_cache=True)
+
+        cursor = await cls._async_db().aggregate(pipeline).to_list(None)
+        await cls._acache_query_set(serialized_pipeline, cursor)
+        return AsyncModelCursor(cls, cursor, raw=raw)
 
-        cursor = list(cls.db.aggregate(pipeline))
-        cls._cache_query_set(serialized_pipeline, cursor)
-        return ModelCursor(cls, cursor, raw=raw)
+    @staticmethod
+    def enable_index_advisor(advisor=None):
+        # Activa el registro de consultas para todos los modelos
+        if advisor is None:
+            from index_advisor import IndexAdvisor
+            advisor = IndexAdvisor()
+        Model._index_advisor = advisor
+        return advisor
+
+    @staticmethod
+    def disable_index_advisor() -> None:
+        Model._index_advisor = None
 
     @classmethod
-    def init_class(cls, db_collection: collection.Collection, r_cache=None) -> None:
+    def init_class(cls, db_collection: 'collection.Collection', r_cache=None) -> None:
+        # Sin E/S: los índices se sincronizan con la primera consulta o escritura
         cls.db = db_collection
         cls.r_cache = r_cache
-        cls._create_indexes()
+        cls._cache_breaker = circuit_breaker.for_client(r_cache) if r_cache is not None else None
+        cls._indexes_ready = False
+        instrumentation.configure()
+        instrumentation.watch_collection(db_collection.name)
+
+    @classmethod
+    def _ensure_indexes(cls) -> None:
+        if cls.__dict__.get('_indexes_ready', True):
+            return
+        with _indexes_lock:
+            if cls._indexes_ready:
+                return
+            if cls.r_cache is not None and _app_initialized:
+                # Configuración de memoria (se ignora en Redis gestionados)
+                cls._cache_call('configure', resources.configure_cache_memory)
+            cls._create_indexes()
+            cls._indexes_ready = True
 
     @classmethod
     def _create_indexes(cls):
-        for index in cls._indexes:
-            cls.db.create_index(index)
+        # Sincronización idempotente: solo se crean los índices que faltan y
+        # se recrean los declarados cuyo nombre existe con otra definición.
+        # Los índices no declarados en el modelo no se tocan.
+        existing = cls.db.index_information()
+        for index in map(Index.from_spec, cls._indexes):
+            info = existing.get(index.name)
+            if info is not None:
+                if index.matches(info):
+                    continue
+                logger.warning(f"Recreando el índice {index.name} de {cls.db.name}: la definición ha cambiado")
+                cls.db.drop_index(index.name)
+            elif any(index.matches(other) for other in existing.values()):
+                continue
+            cls.db.create_index(index.keys, name=index.name, **index.options)
 
-    def _process_embedded_field(self, field_name: str, value):
+    def _process_embedded_field(self, field_name: str, value, full: bool = False):
         model_class = self._model_classes.get(field_name, Model)
+        sub_fields = None
+        if not full and self._fields_tree is not None:
+            # Subdocumento parcial si la proyección baja a sus campos
+            sub = self._fields_tree.get(field_name, True)
+            sub_fields = None if sub is True else sub
         if isinstance(value, list):
-            return [model_class(**item) if isinstance(item, dict) else item for item in value]
+            return [model_class._from_document(item, sub_fields) if isinstance(item, dict) else item for item in value]
         elif isinstance(value, dict):
-            return model_class(**value)
+            return model_class._from_document(value, sub_fields)
         elif isinstance(value, Model):
             return value
         else:
             raise ValueError(f"{field_name} debe ser un dict, una lista o una instancia de Model")
 
+    def _process_reference_field(self, field_name: str, value):
+        # Se guarda solo el _id (de una instancia, un ObjectId o su representación en texto)
+        if value is None or isinstance(value, ObjectId):
+            return value
+        if isinstance(value, Model):
+            if value._id is None:
+                raise ValueError(f"{field_name} referencia un {type(value).__name__} sin guardar")
+            return value._id
+        if isinstance(value, list):
+            return [self._process_reference_field(field_name, item) for item in value]
+        return ObjectId(value)
+
+    @classmethod
+    def _resolve_model(cls, name: str) -> Type['Model']:
+        # Primero en el módulo de la clase y después en los de sus bases
+        for klass in cls.__mro__:
+            target = Model._registry.get((klass.__module__, name))
+            if target is not None:
+                return target
+        raise KeyError(f"Modelo desconocido: {name}")
+
+    def dereference(self, field_name: str) -> 'Model | list[Model] | None':
+        # Carga el documento (o documentos) referenciado, vía find_by_id y su caché
+        target = self._resolve_model(self._reference_fields[field_name])
+        value = getattr(self, field_name, None)
+        if isinstance(value, list):
+            return [target.find_by_id(item) for item in value]
+        return target.find_by_id(value) if value is not None else None
+
     def _process_date_field(self, field_name: str, value):
         if isinstance(value, str):
             for fmt in ('%Y-%m-%d', '%d/%m/%Y'):
@@ -269,10 +1187,11 @@ class Model:
                 return datetime.datetime.fromisoformat(value)
             except ValueError:
                 raise ValueError(f"El campo {field_name} debe ser una fecha válida en formato 'YYYY-MM-DD' o 'DD/MM/YYYY'")
-        elif isinstance(value, datetime.date):
-            return datetime.datetime.combine(value, datetime.time())
         elif isinstance(value, datetime.datetime):
+            # datetime hereda de date: se comprueba antes para no perder la hora
             return value
+        elif isinstance(value, datetime.date):
+            return datetime.datetime.combine(value, datetime.time())
         else:
             raise ValueError(f"El campo {field_name} debe ser un objeto datetime o una cadena de fecha válida")
 
@@ -280,7 +1199,7 @@ class Direccion(Model):
     required_vars = {"calle", "numero", "ciudad", "codigo_postal", "pais"}
     required_fields_order = ["calle", "numero", "portal", "piso", "codigo_postal", "ciudad", "pais"]
     admissible_vars = {"portal", "piso", "location"}
-    _indexes = [("location", pymongo.GEOSPHERE)]
+    _indexes = [Index([("location", GEOSPHERE)])]
 
     def save(self):
         if not getattr(self, 'location', None):
@@ -289,38 +1208,69 @@ class Direccion(Model):
             self.location = get_location_point(address_str)
         super().save()
 
+    async def asave(self):
+        if not getattr(self, 'location', None):
+            address_components = [str(getattr(self, key)) for key in self.required_fields_order if getattr(self, key, None)]
+            address_str = ', '.join(address_components)
+            import asyncio
+            # La geocodificación es bloqueante (sleeps y HTTP): fuera del bucle
+            self.location = await asyncio.to_thread(get_location_point, address_str)
+        await super().asave()
+
 class Cliente(Model):
     required_vars = {"nombre", "fecha_alta"}
     admissible_vars = {"direcciones_facturacion", "direcciones_envio", "tarjetas_pago", "fecha_ultimo_acceso"}
     _embedded_list_fields = ['direcciones_facturacion', 'direcciones_envio']
     _model_classes = {'direcciones_facturacion': Direccion, 'direcciones_envio': Direccion}
     _date_fields = {'fecha_alta', 'fecha_ultimo_acceso'}
+    _indexes = [Index("nombre")]
 
 class Proveedor(Model):
     required_vars = {"nombre"}
     admissible_vars = {"direcciones_almacenes"}
     _embedded_list_fields = ['direcciones_almacenes']
     _model_classes = {'direcciones_almacenes': Direccion}
+    # El índice geoespacial es obligatorio para $geoNear sobre los almacenes
+    _indexes = [
+        Index("nombre"),
+        Index([("direcciones_almacenes.location", GEOSPHERE)]),
+    ]
 
 class Producto(Model):
     required_vars = {"nombre", "codigo_producto_proveedor", "precio", "dimensiones", "peso", "proveedores"}
     admissible_vars = {"coste_envio", "descuento_rango_fechas"}
     _embedded_list_fields = ['proveedores']
     _model_classes = {'proveedores': Proveedor}
+    _indexes = [Index("nombre"), Index("proveedores.nombre"),
+                Index([("nombre", "text")], default_language="spanish")]
 
 class Compra(Model):
     required_vars = {"productos", "cliente", "precio_compra", "fecha_compra", "direccion_envio"}
-    admissible_vars = set()
+    # zona_envio: zona de reparto asignada por zones.classify_compras
+    admissible_vars = {"fecha_modificacion", "zona_envio"}
     _embedded_fields = ['direccion_envio', 'cliente', 'productos']
     _model_classes = {'direccion_envio': Direccion, 'cliente': Cliente, 'productos': Producto}
-    _date_fields = {'fecha_compra'}
-    _indexes = [("direccion_envio.location", pymongo.GEOSPHERE)]
+    _date_fields = {'fecha_compra', 'fecha_modificacion'}
+    _timestamp_field = 'fecha_modificacion'
+    _indexes = [
+        Index([("direccion_envio.location", GEOSPHERE)]),
+        Index([("fecha_compra", DESCENDING)]),
+        Index([("cliente.nombre", ASCENDING), ("fecha_compra", DESCENDING)]),
+        Index("productos.proveedores.nombre"),
+        Index("fecha_modificacion"),
+    ]
 
 class ModelCursor:
-    def __init__(self, model_class: Type[Model], cursor, raw: bool = False, from_cache: bool = False):
+    def __init__(self, model_class: Type[Model], cursor, raw: bool = False, from_cache: bool = False,
+                 fields: dict = None, lazy: bool = False):
         self.model_class = model_class
         self.raw = raw
         self.from_cache = from_cache
+        # Árbol de proyección para hidratar instancias parciales
+        self.fields = fields
+        self.lazy = lazy
+        # Tiempos por partición de Model.aggregate(partitions=...)
+        self.partition_timings = []
         # Si from_cache=True, cursor ya es una lista de dicts
         if from_cache:
             self.results = cursor
@@ -328,11 +1278,50 @@ class ModelCursor:
             self.results = list(cursor)
 
     def __iter__(self) -> Generator[Any, None, None]:
-        for doc in self.results:
-            if self.raw:
-                yield doc
-            else:
-                yield self.model_class(**doc)
+        if self.raw:
+            yield from self.results
+        elif not instrumentation.enabled:
+            for doc in self.results:
+                yield self.model_class._from_document(doc, self.fields, self.lazy)
+        else:
+            # Solo se mide la conversión, no el tiempo del consumidor entre documentos
+            seconds, count = 0.0, 0
+            try:
+                for doc in self.results:
+                    started = time.perf_counter()
+                    item = self.model_class._from_document(doc, self.fields, self.lazy)
+                    seconds += time.perf_counter() - started
+                    count += 1
+                    yield item
+            finally:
+                instrumentation.observe_hydration(self.model_class.__name__, seconds, count)
+
+
+class Page:
+    # Página de resultados de Model.paginate con el token de la siguiente
+    def __init__(self, items: ModelCursor, next_token: str | None):
+        self.items = items
+        self.next_token = next_token
+
+    @property
+    def has_next(self) -> bool:
+        return self.next_token is not None
+
+    def __iter__(self) -> Generator[Any, None, None]:
+        return iter(self.items)
+
+    def __len__(self) -> int:
+        return len(self.items.results)
+
+
+class AsyncModelCursor(ModelCursor):
+    # Cursor para `async for`; los resultados ya se han leído con Motor
+    async def __aiter__(self):
+        for item in self:
+            yield item
+
+    async def to_list(self) -> list:
+        return list(self)
 
 
 # ---------------------------------------------------------
@@ -374,45 +1363,79 @@ def packaging_service_secondary(r_queue, service_id):
         print(f"Servicio secundario {service_id} finaliza por inactividad.")
 
 
-def enqueue_compra(r_queue, compra_id: str):
+def enqueue_compra(r_queue, compra_id: str, queue: str = "pending_compras"):
     # Encolar una compra confirmada para su empaquetado
-    r_queue.rpush("pending_compras", compra_id)
+    r_queue.rpush(queue, compra_id)
+
+
+def enqueue_compras(r_queue, compra_ids, queue: str = "pending_compras", once_key: str = None,
+                    once_ttl: int = 7 * 86400, chunk_size: int = 1000) -> int:
+    # Encolado en bloque: RPUSH de chunk_size ids por comando, todo en una
+    # transacción (MULTI/EXEC). Con once_key el lote solo se encola una vez
+    # aunque se reintente (reanudación del despacho diario)
+    from redis.exceptions import WatchError
+    ids = [str(compra_id) for compra_id in compra_ids]
+    if not ids:
+        return 0
+    with r_queue.pipeline(transaction=True) as pipe:
+        try:
+            if once_key:
+                pipe.watch(once_key)
+                if pipe.exists(once_key):
+                    return 0
+                pipe.multi()
+            for start in range(0, len(ids), chunk_size):
+                pipe.rpush(queue, *ids[start:start + chunk_size])
+            if once_key:
+                pipe.set(once_key, len(ids), ex=once_ttl)
+            pipe.execute()
+        except WatchError:
+            # Otro proceso ha encolado el mismo lote a la vez
+            return 0
+    return len(ids)
 
 
 # ---------------------------------------------------------
 
-def init_app() -> None:
-    # Mongo
-    client = MongoClient(URL_DB)
-    db = client[DB_NAME]
-
-    # Redis caché (db=0)
-    r_cache = redis.Redis(host=CACHE_HOST, port=CACHE_PORT,
-                          username=CACHE_USERNAME,
-                          password=CACHE_PASSWORD,
-                          ssl=False, db=0)
-    # Configuración de memoria
-    r_cache.config_set('maxmemory', '150mb')
-    # Política para eliminar claves con menor TTL primero
-    r_cache.config_set('maxmemory-policy', 'volatile-ttl')
-
-    # Inicializar clases con cache
-    Cliente.init_class(db["cliente"], r_cache)
-    Producto.init_class(db["producto"], r_cache)
-    Compra.init_class(db["compra"], r_cache)
-    Proveedor.init_class(db["proveedor"], r_cache)
-    Direccion.init_class(db["direccion"], r_cache=None)  # Si es necesario
-
-    # Redis cola (db=1) para empaquetado
-    r_queue = redis.Redis(host=CACHE_HOST, port=CACHE_PORT,
-                          username=CACHE_USERNAME,
-                          password=CACHE_PASSWORD,
-                          ssl=False, db=1)
+_app_lock = threading.Lock()
+_app_initialized = False
+
+
+def init_app(force: bool = False) -> None:
+    # Idempotente: las conexiones salen del registro compartido de
+    # resources y los modelos solo se inicializan la primera vez
+    global _app_initialized
+    with _app_lock:
+        if _app_initialized and not force:
+            return
+
+        # Mongo
+        db = resources.get_database()
+
+        # Redis caché (db=0). Crear los clientes no abre conexiones: Mongo,
+        # Redis y la configuración de memoria esperan a la primera consulta.
+        # Con el almacenamiento en memoria no hay caché delante
+        r_cache = None if config.STORAGE_BACKEND == "memory" else resources.get_redis_cache()
+
+        # Inicializar clases con cache
+        Cliente.init_class(db["cliente"], r_cache)
+        Producto.init_class(db["producto"], r_cache)
+        Compra.init_class(db["compra"], r_cache)
+        Proveedor.init_class(db["proveedor"], r_cache)
+        Direccion.init_class(db["direccion"], r_cache=None)  # Si es necesario
+
+        # Agregados de las consultas 5 y 7 mantenidos en cada escritura
+        if config.ROLLUPS:
+            import rollups
+            rollups.enable()
+
+        _app_initialized = True
 
+    # Redis cola (db=1) para empaquetado: resources.get_redis_queue()
     # Iniciar el servicio principal de empaquetado
     # Esto se podría iniciar en otro hilo o proceso.
     # Por simplicidad, se deja comentado aquí.
-    # threading.Thread(target=packaging_service_main, args=(r_queue, 1), daemon=True).start()
+    # threading.Thread(target=packaging_service_main, args=(resources.get_redis_queue(), 1), daemon=True).start()
 
     # Ejemplo de uso:
-    # enqueue_compra(r_queue, "compra_12345")
+    # enqueue_compra(resources.get_redis_queue(), "compra_12345")
@@ -0,0 +1,177 @@
+import datetime
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from bson import ObjectId
+
+import local_aggregate
+
+# Agregación por particiones: el pipeline se divide en el primer $group,
+# la parte inicial se ejecuta en Mongo sobre rangos disjuntos de `_id` o
+# `fecha_compra` en paralelo y los grupos parciales se fusionan en el
+# cliente. Solo se aplica con acumuladores descomponibles ($sum, $count,
+# $min, $max y $avg como suma/cuenta); el resto del pipeline tras el
+# $group se termina con local_aggregate.
+logger = logging.getLogger(__name__)
+
+_DECOMPOSABLE = {'$sum', '$min', '$max', '$avg', '$count'}
+# Etapas previas al $group que no dependen de ver toda la colección
+_PARTITIONABLE = {'$match', '$project', '$addFields', '$set', '$unset', '$unwind', '$replaceRoot'}
+
+
+class PartitionPlan:
+    def __init__(self, prefix: list[dict], group: dict, accumulators: dict[str, str], suffix: list[dict]):
+        # prefix + [$group parcial] se ejecuta en cada partición
+        self.prefix = prefix
+        self.group = group
+        # nombre -> operador original
+        self.accumulators = accumulators
+        self.suffix = suffix
+
+    def partial_pipeline(self, match: dict) -> list[dict]:
+        return [{'$match': match}] + self.prefix + [{'$group': self.group}]
+
+
+def plan(pipeline: list[dict]) -> PartitionPlan | None:
+    # Devuelve None si el pipeline no se puede particionar
+    for i, stage in enumerate(pipeline):
+        name = next(iter(stage))
+        if name == '$group':
+            break
+        if name not in _PARTITIONABLE:
+            return None
+    else:
+        return None
+
+    spec = pipeline[i]['$group']
+    suffix = pipeline[i + 1:]
+    if not local_aggregate.supports(suffix):
+        return None
+    group, accumulators = {'_id': spec['_id']}, {}
+    for name, accumulator in spec.items():
+        if name == '_id':
+            continue
+        (op, expr), = accumulator.items()
+        if op not in _DECOMPOSABLE:
+            return None
+        accumulators[name] = op
+        if op == '$avg':
+            group[f"{name}__sum"] = {'$sum': expr}
+            group[f"{name}__count"] = {'$sum': {'$cond': [{'$isNumber': expr}, 1, 0]}}
+        elif op == '$count':
+            group[name] = {'$sum': 1}
+        else:
+            group[name] = {op: expr}
+    return PartitionPlan(pipeline[:i], group, accumulators, suffix)
+
+
+def _interpolate(low: Any, high: Any, fraction: float) -> Any:
+    if isinstance(low, ObjectId):
+        start, end = low.generation_time, high.generation_time
+        return ObjectId.from_datetime(start + (end - start) * fraction)
+    if isinstance(low, datetime.datetime):
+        return low + (high - low) * fraction
+    if isinstance(low, (int, float)) and not isinstance(low, bool):
+        return low + (high - low) * fraction
+    return None
+
+
+def partition_filters(collection, field: str, partitions: int) -> list[dict]:
+    # Rangos [b_i, b_i+1) entre el mínimo y el máximo del campo (ambos por índice)
+    first = collection.find_one({field: {'$ne': None}}, {field: 1}, sort=[(field, 1)])
+    last = collection.find_one({field: {'$ne': None}}, {field: 1}, sort=[(field, -1)])
+    if first is None:
+        return [{}]
+    low, high = first[field], last[field]
+    bounds = []
+    for i in range(1, partitions):
+        bound = _interpolate(low, high, i / partitions)
+        if bound is None:
+            # Tipo no interpolable: una sola partición
+            return [{}]
+        if not bounds or bound > bounds[-1]:
+            bounds.append(bound)
+    filters = []
+    for i in range(len(bounds) + 1):
+        condition = {}
+        if i > 0:
+            condition['$gte'] = bounds[i - 1]
+        if i < len(bounds):
+            condition['$lt'] = bounds[i]
+        filters.append({field: condition} if condition else {})
+    if field != '_id' and filters[0]:
+        # Los documentos sin el campo van con la primera partición
+        filters[0] = {'$or': [filters[0], {field: None}]}
+    return filters
+
+
+def _merge_value(op: str, current: Any, value: Any) -> Any:
+    if current is None:
+        return value
+    if value is None:
+        return current
+    if op in ('$sum', '$count'):
+        return current + value
+    if op == '$min':
+        return value if local_aggregate.compare(value, current) < 0 else current
+    return value if local_aggregate.compare(value, current) > 0 else current
+
+
+def merge(plan: PartitionPlan, partials: list[list[dict]]) -> list[dict]:
+    merged: dict[str, dict] = {}
+    for results in partials:
+        for doc in results:
+            key = local_aggregate.group_key(doc['_id'])
+            target = merged.get(key)
+            if target is None:
+                merged[key] = dict(doc)
+                continue
+            for name, op in plan.accumulators.items():
+                if op == '$avg':
+                    for part in (f"{name}__sum", f"{name}__count"):
+                        target[part] = target[part] + doc[part]
+                else:
+                    target[name] = _merge_value(op, target.get(name), doc.get(name))
+    groups = []
+    for doc in merged.values():
+        out = {'_id': doc['_id']}
+        for name, op in plan.accumulators.items():
+            if op == '$avg':
+                count = doc[f"{name}__count"]
+                out[name] = doc[f"{name}__sum"] / count if count else None
+            else:
+                out[name] = doc.get(name)
+        groups.append(out)
+    return groups
+
+
+def run(collection, pipeline: list[dict], partitions: int, field: str = '_id',
+        max_workers: int = None) -> tuple[list[dict], list[dict]] | None:
+    # -> (resultados, tiempos por partición), o None si no es particionable
+    partition_plan = plan(pipeline)
+    if partition_plan is None:
+        return None
+    filters = partition_filters(collection, field, partitions)
+
+    def execute(match: dict) -> tuple[list[dict], dict]:
+        start = time.perf_counter()
+        results = list(collection.aggregate(partition_plan.partial_pipeline(match), allowDiskUse=True))
+        return results, {'filter': match, 'groups': len(results), 'seconds': time.perf_counter() - start}
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(filters)) as executor:
+        outcomes = list(executor.map(execute, filters))
+    start = time.perf_counter()
+    groups = merge(partition_plan, [results for results, _ in outcomes])
+    try:
+        results = local_aggregate.run_pipeline(groups, partition_plan.suffix)
+    except NotImplementedError as e:
+        # El resto del pipeline usa un operador que local_aggregate no evalúa:
+        # el llamador lo ejecuta entero en Mongo
+        logger.debug(f"Agregación por particiones descartada: {e}")
+        return None
+    timings = [timing for _, timing in outcomes]
+    logger.debug(f"Agregación en {len(filters)} particiones de {field}: "
+                 f"{[round(t['seconds'], 3) for t in timings]}s, fusión {time.perf_counter() - start:.3f}s")
+    return results, timings
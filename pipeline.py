@@ -0,0 +1,331 @@
+import copy
+import json
+from typing import Any
+
+# Constructor de pipelines de agregación con una pasada de optimización
+# local previa a Model.aggregate:
+#   - adelanta los predicados de $match por delante de los $unwind cuando
+#     no dependen del array desanidado, y copia como prefiltro los que sí
+#     dependen pero solo pueden descartar documentos sin ningún elemento válido
+#   - añade un $project temprano con los campos que usa el pipeline
+#   - adelanta $limit tras un $sort por encima de etapas que no cambian el orden
+#   - fusiona etapas $match consecutivas
+
+# Operadores que, aplicados al array antes del $unwind, seleccionan un
+# superconjunto de los documentos que pasarían el filtro después
+_PREFILTER_OPS = {'$eq', '$in', '$gt', '$gte', '$lt', '$lte', '$regex', '$options', '$all'}
+# Etapas que no alteran ni el número ni el orden de los documentos
+_SHAPE_ONLY_STAGES = {'$project', '$addFields', '$set', '$unset'}
+# Etapas entre las que el $project temprano puede calcular dependencias
+_TRANSPARENT_STAGES = {'$match', '$unwind', '$sort', '$limit', '$skip', '$addFields', '$set'}
+
+
+def _stage_name(stage: dict) -> str:
+    return next(iter(stage))
+
+
+def _is_dependent(key: str, path: str) -> bool:
+    return key == path or key.startswith(path + '.') or path.startswith(key + '.')
+
+
+def _field_refs(expr: Any, refs: set) -> bool:
+    # Recoge las raíces de los campos referenciados ("$a.b" -> "a").
+    # Devuelve False si la expresión usa $$ROOT/$$CURRENT (dependencias desconocidas)
+    if isinstance(expr, str):
+        if expr.startswith('$$'):
+            return not (expr.startswith('$$ROOT') or expr.startswith('$$CURRENT'))
+        if expr.startswith('$'):
+            refs.add(expr[1:].split('.')[0])
+        return True
+    if isinstance(expr, dict):
+        return all(_field_refs(v, refs) for v in expr.values())
+    if isinstance(expr, list):
+        return all(_field_refs(v, refs) for v in expr)
+    return True
+
+
+def _match_refs(filter: dict, refs: set) -> bool:
+    for key, value in filter.items():
+        if key in ('$and', '$or', '$nor'):
+            if not all(_match_refs(sub, refs) for sub in value):
+                return False
+        elif key == '$expr':
+            if not _field_refs(value, refs):
+                return False
+        elif key.startswith('$'):
+            # $text, $where...: dependencias desconocidas
+            return False
+        else:
+            refs.add(key.split('.')[0])
+    return True
+
+
+def _prefilter_safe(condition: Any) -> bool:
+    if isinstance(condition, dict):
+        if not condition or not all(k.startswith('$') for k in condition):
+            return condition is not None
+        if not set(condition) <= _PREFILTER_OPS:
+            return False
+        if condition.get('$eq', 0) is None:
+            return False
+        if '$in' in condition and None in condition['$in']:
+            return False
+        return True
+    return condition is not None
+
+
+def _is_operator_dict(condition: Any) -> bool:
+    return isinstance(condition, dict) and bool(condition) and all(k.startswith('$') for k in condition)
+
+
+def _add_condition(filter: dict, key: str, condition: Any) -> None:
+    # Añade un predicado sin pisar otro sobre el mismo campo: los operadores
+    # distintos se fusionan ({$gte} + {$lt}) y el resto queda en un $and
+    if key not in filter:
+        filter[key] = condition
+    elif key == '$and':
+        filter['$and'] = filter['$and'] + condition
+    elif _is_operator_dict(filter[key]) and _is_operator_dict(condition) and \
+            set(filter[key]).isdisjoint(condition):
+        filter[key] = {**filter[key], **condition}
+    else:
+        filter['$and'] = filter.get('$and', []) + [{key: condition}]
+
+
+def _split_match(filter: dict, path: str, index_field: str | None) -> tuple[dict, dict, dict]:
+    # -> (independiente, prefiltro, dependiente)
+    independent, prefilter, dependent = {}, {}, {}
+    for key, condition in filter.items():
+        if key == '$and':
+            for sub in condition:
+                for target, part in zip((independent, prefilter, dependent), _split_match(sub, path, index_field)):
+                    for k, v in part.items():
+                        _add_condition(target, k, v)
+            continue
+        refs = set()
+        if key.startswith('$'):
+            known = _match_refs({key: condition}, refs)
+            keys = refs
+        else:
+            known = True
+            keys = {key}
+        touches = not known or any(_is_dependent(k, path) for k in keys) or \
+            (index_field is not None and any(_is_dependent(k, index_field) for k in keys))
+        if not touches:
+            _add_condition(independent, key, condition)
+            continue
+        _add_condition(dependent, key, condition)
+        if known and not key.startswith('$') and _prefilter_safe(condition) and \
+                not (index_field and _is_dependent(key, index_field)):
+            _add_condition(prefilter, key, condition)
+    return independent, prefilter, dependent
+
+
+def _merge_filters(a: dict, b: dict) -> dict:
+    if not a:
+        return b
+    if not b:
+        return a
+    merged = dict(a)
+    for key, condition in b.items():
+        _add_condition(merged, key, condition)
+    return merged
+
+
+def push_match_before_unwind(stages: list[dict]) -> list[dict]:
+    stages = copy.deepcopy(stages)
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(stages) - 1):
+            unwind, match = stages[i], stages[i + 1]
+            if _stage_name(unwind) != '$unwind' or _stage_name(match) != '$match':
+                continue
+            spec = unwind['$unwind']
+            if isinstance(spec, str):
+                path, index_field = spec[1:], None
+            else:
+                path, index_field = spec['path'][1:], spec.get('includeArrayIndex')
+            independent, prefilter, dependent = _split_match(match['$match'], path, index_field)
+            if not independent and not prefilter:
+                continue
+            # No repetir un prefiltro que ya está delante del $unwind
+            if i > 0 and _stage_name(stages[i - 1]) == '$match':
+                before = stages[i - 1]['$match']
+                prefilter = {k: v for k, v in prefilter.items() if before.get(k) != v}
+                if not independent and not prefilter:
+                    continue
+            new = [{'$match': _merge_filters(independent, prefilter)}, unwind]
+            if dependent:
+                new.append({'$match': dependent})
+            stages[i:i + 2] = new
+            changed = True
+            break
+    return merge_adjacent_matches(stages)
+
+
+def merge_adjacent_matches(stages: list[dict]) -> list[dict]:
+    merged = []
+    for stage in stages:
+        if merged and _stage_name(stage) == '$match' and _stage_name(merged[-1]) == '$match':
+            merged[-1] = {'$match': _merge_filters(merged[-1]['$match'], stage['$match'])}
+        else:
+            merged.append(stage)
+    return merged
+
+
+def push_limit_after_sort(stages: list[dict]) -> list[dict]:
+    stages = list(stages)
+    for i, stage in enumerate(stages):
+        if _stage_name(stage) != '$limit':
+            continue
+        j = i
+        while j > 0 and _stage_name(stages[j - 1]) in _SHAPE_ONLY_STAGES:
+            j -= 1
+        if j < i and j > 0 and _stage_name(stages[j - 1]) == '$sort':
+            stages.insert(j, stages.pop(i))
+    return stages
+
+
+def add_early_project(stages: list[dict]) -> list[dict]:
+    # Solo si existe una etapa que fija la salida ($group o $project de
+    # inclusión) y todas las anteriores tienen dependencias conocidas
+    refs: set = set()
+    barrier = None
+    for i, stage in enumerate(stages):
+        name = _stage_name(stage)
+        body = stage[name]
+        if name == '$group':
+            if not _field_refs(body, refs):
+                return stages
+            barrier = i
+            break
+        if name == '$project':
+            values = [v for k, v in body.items() if k != '_id']
+            if any(v in (0, False) for v in values):
+                return stages
+            refs.update(k.split('.')[0] for k, v in body.items() if v in (1, True))
+            if not _field_refs([v for v in values if v not in (1, True)], refs):
+                return stages
+            if body.get('_id', 1) not in (0, False):
+                refs.add('_id')
+            barrier = i
+            break
+        if name not in _TRANSPARENT_STAGES:
+            return stages
+        if name == '$match':
+            if not _match_refs(body, refs):
+                return stages
+        elif name == '$unwind':
+            path = body if isinstance(body, str) else body['path']
+            refs.add(path[1:].split('.')[0])
+        elif name == '$sort':
+            refs.update(k.split('.')[0] for k in body)
+        elif name in ('$addFields', '$set'):
+            if not _field_refs(body, refs):
+                return stages
+            refs.update(k.split('.')[0] for k in body)
+    if barrier is None or barrier == 0:
+        return stages
+    # El $project va tras los $match/$sort iniciales para no impedir el uso de índices
+    position = 0
+    while position < barrier and _stage_name(stages[position]) in ('$match', '$sort'):
+        position += 1
+    if position == barrier:
+        return stages
+    project = {field: 1 for field in sorted(refs)}
+    if '_id' not in refs:
+        project['_id'] = 0
+    return stages[:position] + [{'$project': project}] + stages[position:]
+
+
+def optimize_pipeline(stages: list[dict]) -> list[dict]:
+    stages = push_match_before_unwind(stages)
+    stages = push_limit_after_sort(stages)
+    stages = add_early_project(stages)
+    return stages
+
+
+def _plan_stages(plan: Any, found: list) -> list:
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            found.append(plan['stage'])
+        for value in plan.values():
+            _plan_stages(value, found)
+    elif isinstance(plan, list):
+        for value in plan:
+            _plan_stages(value, found)
+    return found
+
+
+class Pipeline:
+    def __init__(self, model=None, stages: list[dict] = None):
+        self.model = model
+        self.stages = list(stages or [])
+
+    def _add(self, stage: dict) -> 'Pipeline':
+        self.stages.append(stage)
+        return self
+
+    def match(self, filter: dict = None, **fields: Any) -> 'Pipeline':
+        return self._add({'$match': {**(filter or {}), **fields}})
+
+    def unwind(self, path: str, preserve_null: bool = False, include_index: str = None) -> 'Pipeline':
+        path = path if path.startswith('$') else f"${path}"
+        if not preserve_null and include_index is None:
+            return self._add({'$unwind': path})
+        spec = {'path': path, 'preserveNullAndEmptyArrays': preserve_null}
+        if include_index:
+            spec['includeArrayIndex'] = include_index
+        return self._add({'$unwind': spec})
+
+    def group(self, _id: Any, **accumulators: dict) -> 'Pipeline':
+        return self._add({'$group': {'_id': _id, **accumulators}})
+
+    def project(self, spec: dict = None, **fields: Any) -> 'Pipeline':
+        return self._add({'$project': {**(spec or {}), **fields}})
+
+    def add_fields(self, spec: dict = None, **fields: Any) -> 'Pipeline':
+        return self._add({'$addFields': {**(spec or {}), **fields}})
+
+    def sort(self, spec: dict = None, **fields: int) -> 'Pipeline':
+        return self._add({'$sort': {**(spec or {}), **fields}})
+
+    def limit(self, n: int) -> 'Pipeline':
+        return self._add({'$limit': n})
+
+    def skip(self, n: int) -> 'Pipeline':
+        return self._add({'$skip': n})
+
+    def stage(self, stage: dict) -> 'Pipeline':
+        # Cualquier otra etapa ($lookup, $geoNear, $merge...) sin tipar
+        return self._add(stage)
+
+    def to_list(self) -> list[dict]:
+        return copy.deepcopy(self.stages)
+
+    def optimize(self) -> 'Pipeline':
+        return Pipeline(self.model, optimize_pipeline(self.stages))
+
+    def run(self, raw: bool = True, optimize: bool = True):
+        return self.model.aggregate(self.to_list(), raw=raw, optimize=optimize)
+
+    def explain(self, optimize: bool = True) -> dict:
+        stages = optimize_pipeline(self.stages) if optimize else self.stages
+        db = self.model.db
+        return db.database.command('aggregate', db.name, pipeline=stages, explain=True)
+
+    def compare(self) -> str:
+        # Pipeline original frente al optimizado y etapas de sus planes
+        optimized = optimize_pipeline(self.stages)
+        lines = ["# Original", json.dumps(self.stages, indent=2, default=str, ensure_ascii=False),
+                 "# Optimizado", json.dumps(optimized, indent=2, default=str, ensure_ascii=False)]
+        if self.model is not None and self.model.db is not None:
+            for title, stages in (("original", self.stages), ("optimizado", optimized)):
+                plan = self.model.db.database.command('aggregate', self.model.db.name,
+                                                      pipeline=stages, explain=True)
+                lines.append(f"# Plan {title}: {' > '.join(_plan_stages(plan, []))}")
+        return '\n'.join(lines)
+
+    def __repr__(self) -> str:
+        return f"Pipeline({self.stages!r})"
@@ -0,0 +1,260 @@
+import logging
+import threading
+import weakref
+from typing import Any
+
+import config
+import instrumentation
+
+# Registro de recursos compartidos del proceso (Mongo, Redis y Neo4j).
+# Los clientes se crean de forma perezosa la primera vez que se piden y
+# se reutilizan después, de modo que llamar varias veces a init_app()
+# o crear varios LogisticsManager no abre conexiones nuevas.
+logger = logging.getLogger(__name__)
+
+_lock = threading.RLock()
+_mongo_clients: dict[str, Any] = {}
+_memory_databases: dict[str, Any] = {}
+# Por (uso, base lógica): caché y cola no comparten timeouts aunque usen la misma base
+_redis_clients: dict[tuple[str, int], Any] = {}
+_neo4j_drivers: dict[tuple, Any] = {}
+_cache_configured = False
+# Los clientes asyncio quedan ligados al bucle de eventos que los usa
+_async_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_mongo_client(uri: str = None):
+    # Un cliente por URI (por defecto URL_DB), con la configuración de pool de config.py
+    uri = uri or config.URL_DB
+    client = _mongo_clients.get(uri)
+    if client is None:
+        with _lock:
+            client = _mongo_clients.get(uri)
+            if client is None:
+                from pymongo import MongoClient
+                # connect=False: la conexión se abre con la primera operación
+                client = _mongo_clients[uri] = MongoClient(
+                    uri,
+                    maxPoolSize=config.MONGO_MAX_POOL_SIZE,
+                    minPoolSize=config.MONGO_MIN_POOL_SIZE,
+                    connectTimeoutMS=config.MONGO_CONNECT_TIMEOUT_MS,
+                    serverSelectionTimeoutMS=config.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                    event_listeners=instrumentation.event_listeners(),
+                    connect=False,
+                )
+    return client
+
+
+def mongo_uri(client) -> str | None:
+    # URI con la que se registró un cliente (None si no es del registro)
+    for uri, registered in list(_mongo_clients.items()):
+        if registered is client:
+            return uri
+    return None
+
+
+def get_database(name: str = None, uri: str = None):
+    if config.STORAGE_BACKEND == "memory":
+        return get_memory_database(name)
+    return get_mongo_client(uri)[name or config.DB_NAME]
+
+
+def get_memory_database(name: str = None):
+    # Base en memoria del proceso (STORAGE_BACKEND=memory), una por nombre
+    name = name or config.DB_NAME or "odm"
+    with _lock:
+        database = _memory_databases.get(name)
+        if database is None:
+            from memory_backend import MemoryDatabase
+            database = _memory_databases[name] = MemoryDatabase(name)
+    return database
+
+
+def _get_redis(role: str, db: int, socket_timeout: float | None, pool_timeout: float,
+               retries: int | None = None):
+    client = _redis_clients.get((role, db))
+    if client is None:
+        with _lock:
+            client = _redis_clients.get((role, db))
+            if client is None:
+                import redis
+                from redis.backoff import NoBackoff
+                from redis.retry import Retry
+                # Un pool por uso y base lógica (SELECT es por conexión). El pool
+                # bloqueante espera a que se libere una conexión en lugar de
+                # fallar cuando los hilos de empaquetado agotan el máximo.
+                pool = redis.BlockingConnectionPool(
+                    host=config.CACHE_HOST,
+                    port=config.CACHE_PORT,
+                    username=config.CACHE_USERNAME,
+                    password=config.CACHE_PASSWORD,
+                    db=db,
+                    max_connections=config.CACHE_MAX_CONNECTIONS,
+                    timeout=pool_timeout,
+                    socket_timeout=socket_timeout,
+                    socket_connect_timeout=config.CACHE_CONNECT_TIMEOUT,
+                    health_check_interval=config.CACHE_HEALTH_CHECK_INTERVAL,
+                    **({} if retries is None else {'retry': Retry(NoBackoff(), retries)}),
+                )
+                client = redis.Redis(connection_pool=pool)
+                _redis_clients[role, db] = client
+    return client
+
+
+def get_redis_cache():
+    # Redis caché (db=0 por defecto). Timeouts cortos y sin reintentos: si
+    # Redis no responde el cortocircuito de los modelos (circuit_breaker)
+    # deja de usarla en lugar de reintentar cada operación
+    return _get_redis('cache', config.CACHE_DB, config.CACHE_SOCKET_TIMEOUT, config.CACHE_POOL_TIMEOUT, retries=0)
+
+
+def get_redis_queue():
+    # Redis cola (db=1 por defecto). Sin socket_timeout: BLPOP puede
+    # bloquear indefinidamente en el servicio principal de empaquetado.
+    return _get_redis('queue', config.QUEUE_DB, None, config.QUEUE_POOL_TIMEOUT)
+
+
+def configure_cache_memory() -> None:
+    # Ajusta maxmemory una sola vez por proceso. En Redis gestionados
+    # CONFIG SET está deshabilitado, así que el error solo se registra.
+    global _cache_configured
+    if _cache_configured or not config.CACHE_MAXMEMORY:
+        return
+    with _lock:
+        if _cache_configured:
+            return
+        import redis
+        r_cache = get_redis_cache()
+        try:
+            r_cache.config_set('maxmemory', config.CACHE_MAXMEMORY)
+            # Política para eliminar claves con menor TTL primero
+            r_cache.config_set('maxmemory-policy', config.CACHE_MAXMEMORY_POLICY)
+        except redis.exceptions.ResponseError as e:
+            logger.warning(f"No se pudo configurar la memoria de Redis: {e}")
+        _cache_configured = True
+
+
+def _get_async_clients() -> dict[str, Any]:
+    import asyncio
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_clients.get(loop)
+        if clients is None:
+            clients = _async_clients[loop] = {}
+        return clients
+
+
+def get_async_database(name: str = None, uri: str = None):
+    # Un cliente Motor por bucle y URI, como get_mongo_client
+    uri = uri or config.URL_DB
+    clients = _get_async_clients().setdefault('mongo', {})
+    if uri not in clients:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        clients[uri] = AsyncIOMotorClient(
+            uri,
+            maxPoolSize=config.MONGO_MAX_POOL_SIZE,
+            minPoolSize=config.MONGO_MIN_POOL_SIZE,
+            connectTimeoutMS=config.MONGO_CONNECT_TIMEOUT_MS,
+            serverSelectionTimeoutMS=config.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            event_listeners=instrumentation.event_listeners(),
+        )
+    return clients[uri][name or config.DB_NAME]
+
+
+def get_async_redis_cache():
+    clients = _get_async_clients()
+    if 'redis_cache' not in clients:
+        import redis.asyncio
+        from redis.asyncio.retry import Retry
+        from redis.backoff import NoBackoff
+        pool = redis.asyncio.BlockingConnectionPool(
+            host=config.CACHE_HOST,
+            port=config.CACHE_PORT,
+            username=config.CACHE_USERNAME,
+            password=config.CACHE_PASSWORD,
+            db=config.CACHE_DB,
+            max_connections=config.CACHE_MAX_CONNECTIONS,
+            timeout=config.CACHE_POOL_TIMEOUT,
+            socket_timeout=config.CACHE_SOCKET_TIMEOUT,
+            socket_connect_timeout=config.CACHE_CONNECT_TIMEOUT,
+            health_check_interval=config.CACHE_HEALTH_CHECK_INTERVAL,
+            retry=Retry(NoBackoff(), 0),
+        )
+        clients['redis_cache'] = redis.asyncio.Redis(connection_pool=pool)
+    return clients['redis_cache']
+
+
+async def aclose_all() -> None:
+    # Cierra los clientes asyncio del bucle actual
+    import asyncio
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_clients.pop(loop, {})
+    for client in clients.get('mongo', {}).values():
+        client.close()
+    if 'redis_cache' in clients:
+        await clients['redis_cache'].aclose()
+
+
+def get_neo4j_driver(uri: str = None, user: str = None, password: str = None):
+    uri = uri or config.NEO4J_URI
+    user = user or config.NEO4J_USER
+    password = password or config.NEO4J_PASSWORD
+    key = (uri, user)
+    driver = _neo4j_drivers.get(key)
+    if driver is None:
+        with _lock:
+            driver = _neo4j_drivers.get(key)
+            if driver is None:
+                from neo4j import GraphDatabase
+                driver = GraphDatabase.driver(
+                    uri, auth=(user, password),
+                    max_connection_pool_size=config.NEO4J_MAX_POOL_SIZE,
+                    connection_timeout=config.NEO4J_CONNECTION_TIMEOUT,
+                    connection_acquisition_timeout=config.NEO4J_ACQUISITION_TIMEOUT,
+                    liveness_check_timeout=config.NEO4J_LIVENESS_CHECK_TIMEOUT,
+                )
+                _neo4j_drivers[key] = driver
+    return driver
+
+
+def health_check() -> dict[str, bool]:
+    # Comprueba solo los recursos ya creados, sin abrir conexiones nuevas
+    status = {}
+    for uri, client in list(_mongo_clients.items()):
+        name = 'mongo' if uri == config.URL_DB else f'mongo:{uri}'
+        try:
+            client.admin.command('ping')
+            status[name] = True
+        except Exception as e:
+            logger.warning(f"Mongo {name} no responde: {e}")
+            status[name] = False
+    for (role, db), client in list(_redis_clients.items()):
+        try:
+            status[f'redis:{role}:{db}'] = bool(client.ping())
+        except Exception as e:
+            logger.warning(f"Redis {role} db={db} no responde: {e}")
+            status[f'redis:{role}:{db}'] = False
+    for (uri, _), driver in list(_neo4j_drivers.items()):
+        try:
+            driver.verify_connectivity()
+            status[f'neo4j:{uri}'] = True
+        except Exception as e:
+            logger.warning(f"Neo4j {uri} no responde: {e}")
+            status[f'neo4j:{uri}'] = False
+    return status
+
+
+def close_all() -> None:
+    global _cache_configured
+    with _lock:
+        for client in _mongo_clients.values():
+            client.close()
+        _mongo_clients.clear()
+        for client in _redis_clients.values():
+            client.connection_pool.disconnect()
+        _redis_clients.clear()
+        for driver in _neo4j_drivers.values():
+            driver.close()
+        _neo4j_drivers.clear()
+        _cache_configured = False
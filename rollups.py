@@ -0,0 +1,388 @@
+import argparse
+import datetime
+import json
+import logging
+import time
+from typing import Any, Iterable, Type
+
+from models import Model, Compra, init_app
+
+# Agregados mantenidos en escritura para las consultas 5 y 7. Cada compra
+# suma sus contadores en dos colecciones compactas: peso y volumen por
+# (cliente, día) y facturación por (proveedor, mes). Con los observadores
+# post_save/post_delete de Compra cada escritura aplica un $inc con la
+# diferencia entre lo que la compra ya aportaba (guardado en un registro
+# por compra) y lo que aporta ahora, así que guardar dos veces la misma
+# compra o editarla no descuadra nada. El registro de cada compra se
+# cambia de forma atómica y lleva su fecha de modificación: dos escritores
+# a la vez (p.ej. backfill y un save) nunca restan la misma aportación dos
+# veces ni sustituyen una versión más reciente. Los informes pasan a ser lecturas
+# por _id; check() los compara con un recálculo completo en Mongo.
+logger = logging.getLogger(__name__)
+
+CLIENTE_DIA = "rollup_cliente_dia"
+PROVEEDOR_MES = "rollup_proveedor_mes"
+# Aportación aplicada de cada compra: _id de la compra -> contribución
+LEDGER = "_rollup_compras"
+
+# Campos de la compra que intervienen en los agregados (y su versión)
+_PROJECTION = {"cliente.nombre": 1, "fecha_compra": 1, "productos.peso": 1, "productos.precio": 1,
+               "productos.dimensiones": 1, "productos.proveedores.nombre": 1, "fecha_modificacion": 1}
+_EPSILON = 1e-9
+
+
+def _number(value: Any) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _day(fecha: datetime.date | datetime.datetime) -> datetime.datetime:
+    return datetime.datetime(fecha.year, fecha.month, fecha.day)
+
+
+def contribution(doc: dict) -> dict | None:
+    """
+    Lo que una compra suma a los agregados, o None si no tiene fecha. El
+    volumen va en m³ (dimensiones en cm) y la facturación, como en la
+    consulta 7, suma el precio del producto a cada uno de sus proveedores.
+    """
+    fecha = doc.get("fecha_compra")
+    if not isinstance(fecha, datetime.datetime):
+        return None
+    peso = volumen = 0.0
+    proveedores: dict[Any, list] = {}
+    for producto in doc.get("productos") or []:
+        peso += _number(producto.get("peso"))
+        dimensiones = producto.get("dimensiones") or {}
+        volumen += (_number(dimensiones.get("ancho")) * _number(dimensiones.get("alto"))
+                    * _number(dimensiones.get("profundidad")) / 1e6)
+        for proveedor in producto.get("proveedores") or []:
+            entry = proveedores.setdefault(proveedor.get("nombre"), [0.0, 0])
+            entry[0] += _number(producto.get("precio"))
+            entry[1] += 1
+    return {"cliente": (doc.get("cliente") or {}).get("nombre"), "dia": _day(fecha),
+            "anio": fecha.year, "mes": fecha.month, "peso_kg": peso, "volumen_m3": volumen,
+            "proveedores": [[nombre, facturacion, lineas] for nombre, (facturacion, lineas) in proveedores.items()]}
+
+
+def _cliente_key(cliente: Any, dia: datetime.datetime) -> dict:
+    # El orden de los campos forma parte del _id
+    return {"cliente": cliente, "dia": dia}
+
+
+def _proveedor_key(proveedor: Any, anio: int, mes: int) -> dict:
+    return {"proveedor": proveedor, "anio": anio, "mes": mes}
+
+
+def _add(deltas: dict, entry: dict | None, sign: int) -> None:
+    # deltas: (colección, clave) -> {campo: incremento}
+    if entry is None:
+        return
+    key = (CLIENTE_DIA, (entry["cliente"], entry["dia"]))
+    counters = deltas.setdefault(key, {"peso_kg": 0.0, "volumen_m3": 0.0, "compras": 0})
+    counters["peso_kg"] += sign * entry["peso_kg"]
+    counters["volumen_m3"] += sign * entry["volumen_m3"]
+    counters["compras"] += sign
+    for nombre, facturacion, lineas in entry["proveedores"]:
+        key = (PROVEEDOR_MES, (nombre, entry["anio"], entry["mes"]))
+        counters = deltas.setdefault(key, {"facturacion": 0.0, "lineas": 0})
+        counters["facturacion"] += sign * facturacion
+        counters["lineas"] += sign * lineas
+
+
+class Rollups:
+    def __init__(self, source: Type[Model] = Compra):
+        self.source = source
+        self._enabled = False
+
+    @property
+    def database(self):
+        return self.source.db.database
+
+    # -----------------------------------------------------
+    # Observadores
+
+    def enable(self) -> None:
+        if not self._enabled:
+            self.source.subscribe("post_save", self._on_save)
+            self.source.subscribe("post_delete", self._on_delete)
+            self._enabled = True
+
+    def disable(self) -> None:
+        self.source.unsubscribe("post_save", self._on_save)
+        self.source.unsubscribe("post_delete", self._on_delete)
+        self._enabled = False
+
+    def _on_save(self, model_class: Type[Model], instances: list[Model]) -> None:
+        docs, partial = [], []
+        for instance in instances:
+            if instance._loaded_fields is None:
+                docs.append(instance.to_dict())
+            else:
+                partial.append(instance._id)
+        try:
+            if partial:
+                # Una instancia parcial no tiene todos los campos: se relee
+                docs += list(self.source.db.find({"_id": {"$in": partial}}, _PROJECTION))
+            self.apply(docs)
+        except Exception as e:
+            # La compra ya está guardada: se avisa y backfill() lo corrige
+            logger.warning(f"No se pudieron actualizar los agregados de {len(instances)} compras: {e}")
+
+    def _on_delete(self, model_class: Type[Model], instances: list[Model]) -> None:
+        try:
+            self.remove([instance._id for instance in instances])
+        except Exception as e:
+            logger.warning(f"No se pudieron descontar de los agregados {len(instances)} compras: {e}")
+
+    # -----------------------------------------------------
+    # Escritura
+
+    def apply(self, docs: list[dict]) -> int:
+        # Aplica (o corrige) la aportación actual de las compras. Devuelve
+        # el número de contadores modificados
+        docs = [doc for doc in docs if doc.get("_id") is not None]
+        if not docs:
+            return 0
+        from pymongo.errors import DuplicateKeyError
+
+        deltas: dict = {}
+        for doc in docs:
+            entry = contribution(doc)
+            try:
+                previous = self._swap(doc, entry)
+            except DuplicateKeyError:
+                # El registro ya tiene una versión posterior de la compra
+                continue
+            _add(deltas, previous, -1)
+            _add(deltas, entry, 1)
+        # Primero el registro: si el proceso cae antes del $inc los
+        # agregados quedan descuadrados, y check() lo detecta
+        return self._increment(deltas)
+
+    def _swap(self, doc: dict, entry: dict | None) -> dict | None:
+        # Sustituye la aportación registrada de una compra y devuelve la
+        # anterior en una sola operación atómica
+        from pymongo import ReturnDocument
+
+        ledger = self.database[LEDGER]
+        if entry is None:
+            return ledger.find_one_and_delete({"_id": doc["_id"]})
+        filter = {"_id": doc["_id"]}
+        version = doc.get(self.source._timestamp_field) if self.source._timestamp_field else None
+        if version is not None:
+            # Con una versión más reciente registrada el filtro no casa y el
+            # upsert choca con el _id existente (DuplicateKeyError)
+            filter["version"] = {"$not": {"$gt": version}}
+            entry = {**entry, "version": version}
+        return ledger.find_one_and_replace(filter, entry, upsert=True, return_document=ReturnDocument.BEFORE)
+
+    def remove(self, compra_ids: Iterable[Any]) -> int:
+        ledger = self.database[LEDGER]
+        deltas: dict = {}
+        for compra_id in compra_ids:
+            _add(deltas, ledger.find_one_and_delete({"_id": compra_id}), -1)
+        return self._increment(deltas)
+
+    def _increment(self, deltas: dict) -> int:
+        from pymongo import UpdateOne
+
+        operations: dict[str, list] = {CLIENTE_DIA: [], PROVEEDOR_MES: []}
+        emptied: dict[str, list] = {CLIENTE_DIA: [], PROVEEDOR_MES: []}
+        for (collection, key), counters in deltas.items():
+            counters = {field: value for field, value in counters.items() if abs(value) > _EPSILON}
+            if not counters:
+                continue
+            if collection == CLIENTE_DIA:
+                _id, insert = _cliente_key(*key), {}
+                count = counters.get("compras", 0)
+            else:
+                _id = _proveedor_key(*key)
+                # Primer día del mes, para filtrar por periodo con un índice
+                insert = {"periodo": datetime.datetime(key[1], key[2], 1)}
+                count = counters.get("lineas", 0)
+            update = {"$inc": counters}
+            if insert:
+                update["$setOnInsert"] = insert
+            operations[collection].append(UpdateOne({"_id": _id}, update, upsert=True))
+            if count < 0:
+                emptied[collection].append(_id)
+        modified = 0
+        for collection, ops in operations.items():
+            if ops:
+                self.database[collection].bulk_write(ops, ordered=False)
+                modified += len(ops)
+        # Los grupos sin compras (o sin líneas) desaparecen
+        for collection, field in ((CLIENTE_DIA, "compras"), (PROVEEDOR_MES, "lineas")):
+            if emptied[collection]:
+                self.database[collection].delete_many({"_id": {"$in": emptied[collection]}, field: {"$lte": 0}})
+        return modified
+
+    def ensure_indexes(self) -> None:
+        self.database[PROVEEDOR_MES].create_index("periodo")
+
+    def backfill(self, batch_size: int = 5000, reset: bool = False) -> dict:
+        """
+        Calcula los agregados de las compras existentes. Sin reset corrige
+        por diferencia con el registro y puede ejecutarse con la aplicación
+        en marcha; reset=True los rehace desde cero (con las escrituras
+        detenidas).
+        """
+        started = time.perf_counter()
+        self.ensure_indexes()
+        if reset:
+            for collection in (CLIENTE_DIA, PROVEEDOR_MES, LEDGER):
+                self.database[collection].delete_many({})
+        report = {"compras": 0, "counters": 0, "orphans": 0}
+        batch = []
+        for doc in self.source.db.find({}, _PROJECTION, batch_size=min(batch_size, 10000)):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                report["counters"] += self.apply(batch)
+                report["compras"] += len(batch)
+                batch = []
+        if batch:
+            report["counters"] += self.apply(batch)
+            report["compras"] += len(batch)
+        # Compras borradas mientras los observadores no estaban activos
+        ids = [entry["_id"] for entry in self.database[LEDGER].find({}, {"_id": 1})]
+        for start in range(0, len(ids), batch_size):
+            chunk = ids[start:start + batch_size]
+            existing = {doc["_id"] for doc in self.source.db.find({"_id": {"$in": chunk}}, {"_id": 1})}
+            orphans = [object_id for object_id in chunk if object_id not in existing]
+            if orphans:
+                report["counters"] += self.remove(orphans)
+                report["orphans"] += len(orphans)
+        report["seconds"] = round(time.perf_counter() - started, 3)
+        return report
+
+    # -----------------------------------------------------
+    # Comprobación
+
+    def recompute(self) -> dict[str, dict]:
+        # Recálculo completo en Mongo con los pipelines de las consultas 5 y 7
+        clientes = self.source.db.aggregate([
+            {"$project": _PROJECTION},
+            {"$unwind": {"path": "$productos", "preserveNullAndEmptyArrays": True}},
+            {"$group": {
+                "_id": {"cliente": "$cliente.nombre",
+                        "dia": {"$dateFromParts": {"year": {"$year": "$fecha_compra"},
+                                                   "month": {"$month": "$fecha_compra"},
+                                                   "day": {"$dayOfMonth": "$fecha_compra"}}}},
+                "peso_kg": {"$sum": "$productos.peso"},
+                "volumen_m3": {"$sum": {"$divide": [{"$multiply": ["$productos.dimensiones.ancho",
+                                                                   "$productos.dimensiones.alto",
+                                                                   "$productos.dimensiones.profundidad"]}, 1e6]}},
+                "compras": {"$addToSet": "$_id"},
+            }},
+        ], allowDiskUse=True)
+        proveedores = self.source.db.aggregate([
+            {"$project": _PROJECTION},
+            {"$unwind": "$productos"},
+            {"$unwind": "$productos.proveedores"},
+            {"$group": {
+                "_id": {"proveedor": "$productos.proveedores.nombre",
+                        "anio": {"$year": "$fecha_compra"}, "mes": {"$month": "$fecha_compra"}},
+                "facturacion": {"$sum": "$productos.precio"},
+                "lineas": {"$sum": 1},
+            }},
+        ], allowDiskUse=True)
+        return {
+            CLIENTE_DIA: {(doc["_id"]["cliente"], doc["_id"]["dia"]):
+                          {"peso_kg": doc["peso_kg"], "volumen_m3": doc["volumen_m3"], "compras": len(doc["compras"])}
+                          for doc in clientes if doc["_id"].get("dia") is not None},
+            PROVEEDOR_MES: {(doc["_id"]["proveedor"], doc["_id"]["anio"], doc["_id"]["mes"]):
+                            {"facturacion": doc["facturacion"], "lineas": doc["lineas"]}
+                            for doc in proveedores if doc["_id"].get("anio") is not None},
+        }
+
+    def check(self, tolerance: float = 1e-6, samples: int = 10) -> dict:
+        """
+        Compara los agregados con un recálculo completo. Los contadores
+        reales se comparan con tolerancia relativa (los $inc acumulan
+        redondeo); los enteros, exactamente.
+        """
+        started = time.perf_counter()
+        expected = self.recompute()
+        report = {"ok": True, "seconds": None}
+        for collection, key_fields in ((CLIENTE_DIA, ("cliente", "dia")),
+                                       (PROVEEDOR_MES, ("proveedor", "anio", "mes"))):
+            stored = {tuple(doc["_id"][field] for field in key_fields): doc
+                      for doc in self.database[collection].find({})}
+            mismatches = []
+            for key in expected[collection].keys() | stored.keys():
+                want, have = expected[collection].get(key), stored.get(key)
+                if want is None or have is None:
+                    mismatches.append({"key": key, "expected": want, "stored": have and
+                                       {field: have.get(field) for field in have if field not in ("_id", "periodo")}})
+                    continue
+                for field, value in want.items():
+                    if abs(_number(have.get(field)) - value) > tolerance * max(1.0, abs(value)):
+                        mismatches.append({"key": key, "field": field, "expected": value, "stored": have.get(field)})
+            report[collection] = {"expected": len(expected[collection]), "stored": len(stored),
+                                  "mismatches": len(mismatches), "samples": mismatches[:samples]}
+            report["ok"] = report["ok"] and not mismatches
+        report["seconds"] = round(time.perf_counter() - started, 3)
+        return report
+
+    # -----------------------------------------------------
+    # Informes
+
+    def peso_volumen_cliente(self, cliente: str, fecha: datetime.date | datetime.datetime) -> dict | None:
+        # Consulta 5: una lectura por _id
+        doc = self.database[CLIENTE_DIA].find_one({"_id": _cliente_key(cliente, _day(fecha))})
+        if doc is None:
+            return None
+        return {"peso_total_kg": doc["peso_kg"], "volumen_total_m3": doc["volumen_m3"], "compras": doc["compras"]}
+
+    def top_proveedores(self, n: int = 3, desde: datetime.date = None, hasta: datetime.date = None) -> list[dict]:
+        # Consulta 7 sobre los meses [desde, hasta) (por defecto, todos)
+        periodo = {}
+        if desde is not None:
+            periodo["$gte"] = datetime.datetime(desde.year, desde.month, 1)
+        if hasta is not None:
+            periodo["$lt"] = datetime.datetime(hasta.year, hasta.month, 1)
+        return list(self.database[PROVEEDOR_MES].aggregate([
+            {"$match": {"periodo": periodo} if periodo else {}},
+            {"$group": {"_id": "$_id.proveedor", "total_facturacion": {"$sum": "$facturacion"}}},
+            {"$sort": {"total_facturacion": -1}},
+            {"$limit": n},
+        ]))
+
+
+ROLLUPS = Rollups(Compra)
+
+
+def enable() -> None:
+    ROLLUPS.enable()
+
+
+def disable() -> None:
+    ROLLUPS.disable()
+
+
+def peso_volumen_cliente(cliente: str, fecha: datetime.date | datetime.datetime) -> dict | None:
+    return ROLLUPS.peso_volumen_cliente(cliente, fecha)
+
+
+def top_proveedores(n: int = 3, desde: datetime.date = None, hasta: datetime.date = None) -> list[dict]:
+    return ROLLUPS.top_proveedores(n, desde, hasta)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Agregados de peso/volumen por cliente y de facturación por proveedor")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = subparsers.add_parser("backfill", help="calcular los agregados de las compras existentes")
+    backfill_parser.add_argument("--reset", action="store_true", help="rehacer desde cero")
+    backfill_parser.add_argument("--batch-size", type=int, default=5000)
+    subparsers.add_parser("check", help="comparar con un recálculo completo")
+    args = parser.parse_args()
+
+    init_app()
+    if args.command == "backfill":
+        report = ROLLUPS.backfill(batch_size=args.batch_size, reset=args.reset)
+    else:
+        report = ROLLUPS.check()
+    print(json.dumps(report, indent=2, default=str, ensure_ascii=False))
@@ -0,0 +1,205 @@
+import hashlib
+import os
+import pickle
+import re
+from typing import Any, Type
+
+import yaml
+
+import models
+from models import Model, Index
+
+# Compilación del esquema declarativo de models.yml. El YAML se valida y se
+# normaliza a una especificación de datos planos (conjuntos de campos,
+# conversores por campo e índices) que se guarda en un pickle junto al
+# fichero, identificado por el hash del YAML: los arranques siguientes solo
+# leen el pickle y crean las clases con type().
+
+# Se incrementa cuando cambia el formato de la especificación compilada
+SCHEMA_VERSION = 1
+
+_MODEL_KEYS = {'collection', 'base', 'cache', 'required_vars', 'admissible_vars', 'embedded', 'dates',
+               'references', 'indexes', 'timestamp_field', 'cache_ttl', 'query_cache_ttl'}
+_INDEX_KEYS = {'keys', 'name', 'unique', 'sparse', 'ttl', 'partial', 'weights', 'default_language'}
+_INDEX_DIRECTIONS = {1, -1, '2dsphere', '2d', 'text', 'hashed'}
+_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+class SchemaError(ValueError):
+    pass
+
+
+def _string_list(model: str, key: str, value: Any) -> list[str]:
+    if value is None:
+        return []
+    if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+        raise SchemaError(f"{model}.{key} debe ser una lista de nombres de campo")
+    return value
+
+
+def _compile_index(model: str, spec: Any) -> dict:
+    if isinstance(spec, str):
+        spec = {'keys': spec}
+    if not isinstance(spec, dict) or 'keys' not in spec:
+        raise SchemaError(f"{model}.indexes: cada índice es un campo o un mapa con 'keys'")
+    unknown = set(spec) - _INDEX_KEYS
+    if unknown:
+        raise SchemaError(f"{model}.indexes: opciones desconocidas {sorted(unknown)}")
+    keys = spec['keys']
+    if isinstance(keys, str):
+        keys = [[keys, 1]]
+    compiled_keys = []
+    for key in keys:
+        if isinstance(key, str):
+            key = [key, 1]
+        if not isinstance(key, list) or len(key) != 2 or key[1] not in _INDEX_DIRECTIONS:
+            raise SchemaError(f"{model}.indexes: clave no válida {key!r}")
+        compiled_keys.append((key[0], key[1]))
+    options = {k: v for k, v in spec.items() if k != 'keys'}
+    return {'keys': compiled_keys, 'options': options}
+
+
+def compile_schema(raw: dict) -> dict[str, dict]:
+    # Valida el YAML y devuelve la especificación normalizada por modelo
+    if not isinstance(raw, dict) or not raw:
+        raise SchemaError("El esquema debe ser un mapa de modelos")
+    names = set(raw)
+    compiled = {}
+    for name, spec in raw.items():
+        if not isinstance(name, str) or not _NAME.match(name):
+            raise SchemaError(f"Nombre de modelo no válido: {name!r}")
+        spec = spec or {}
+        if not isinstance(spec, dict):
+            raise SchemaError(f"{name}: la definición debe ser un mapa")
+        unknown = set(spec) - _MODEL_KEYS
+        if unknown:
+            raise SchemaError(f"{name}: claves desconocidas {sorted(unknown)}")
+
+        required = _string_list(name, 'required_vars', spec.get('required_vars'))
+        admissible = _string_list(name, 'admissible_vars', spec.get('admissible_vars'))
+        overlap = set(required) & set(admissible)
+        if overlap:
+            raise SchemaError(f"{name}: campos a la vez requeridos y admitidos {sorted(overlap)}")
+        fields = set(required) | set(admissible)
+
+        def check_field(key: str, field: str) -> None:
+            if field not in fields:
+                raise SchemaError(f"{name}.{key}: {field} no está en required_vars ni admissible_vars")
+
+        embedded_fields, embedded_list_fields, model_classes = [], [], {}
+        embedded = spec.get('embedded') or {}
+        if not isinstance(embedded, dict):
+            raise SchemaError(f"{name}.embedded debe ser un mapa campo -> modelo")
+        for field, target in embedded.items():
+            check_field('embedded', field)
+            if isinstance(target, str):
+                target = {'model': target}
+            if not isinstance(target, dict):
+                raise SchemaError(f"{name}.embedded.{field}: se espera un nombre de modelo o un mapa con 'model'")
+            if not isinstance(target.get('model'), str) or target['model'] not in names:
+                raise SchemaError(f"{name}.embedded.{field}: modelo desconocido {target.get('model')!r}")
+            (embedded_list_fields if target.get('list') else embedded_fields).append(field)
+            model_classes[field] = target['model']
+
+        dates = _string_list(name, 'dates', spec.get('dates'))
+        for field in dates:
+            check_field('dates', field)
+
+        references = spec.get('references') or {}
+        if not isinstance(references, dict):
+            raise SchemaError(f"{name}.references debe ser un mapa campo -> modelo")
+        for field, target in references.items():
+            check_field('references', field)
+            if not isinstance(target, str) or target not in names:
+                raise SchemaError(f"{name}.references.{field}: modelo desconocido {target!r}")
+
+        timestamp_field = spec.get('timestamp_field')
+        if timestamp_field is not None:
+            check_field('timestamp_field', timestamp_field)
+            if timestamp_field not in dates:
+                raise SchemaError(f"{name}.timestamp_field debe estar también en dates")
+
+        base = spec.get('base', 'Model')
+        compiled[name] = {
+            'name': name,
+            'base': base,
+            'collection': spec.get('collection', name.lower()),
+            'cache': spec.get('cache', True),
+            'attributes': {
+                'required_vars': set(required),
+                'admissible_vars': set(admissible),
+                '_embedded_fields': embedded_fields,
+                '_embedded_list_fields': embedded_list_fields,
+                '_date_fields': set(dates),
+                '_reference_fields': dict(references),
+                '_timestamp_field': timestamp_field,
+                **({'_cache_ttl': spec['cache_ttl']} if 'cache_ttl' in spec else {}),
+                **({'_query_cache_ttl': spec['query_cache_ttl']} if 'query_cache_ttl' in spec else {}),
+            },
+            'model_classes': model_classes,
+            'indexes': [_compile_index(name, index) for index in spec.get('indexes') or []],
+        }
+
+    # Orden de creación: cada modelo después de los que embebe
+    ordered, pending = [], dict(compiled)
+    while pending:
+        ready = [n for n, spec in pending.items()
+                 if all(target in ordered or target == n for target in spec['model_classes'].values())]
+        if not ready:
+            raise SchemaError(f"Dependencias circulares entre modelos embebidos: {sorted(pending)}")
+        for n in ready:
+            ordered.append(n)
+            del pending[n]
+    return {n: compiled[n] for n in ordered}
+
+
+def _cache_path(path: str) -> str:
+    directory, filename = os.path.split(os.path.abspath(path))
+    return os.path.join(directory, '__pycache__', f"{filename}.schema.pickle")
+
+
+def load_schema(path: str = "./models.yml", use_cache: bool = True) -> dict[str, dict]:
+    with open(path, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest()
+    cache_path = _cache_path(path)
+    if use_cache:
+        try:
+            with open(cache_path, 'rb') as f:
+                cached = pickle.load(f)
+            if cached.get('version') == SCHEMA_VERSION and cached.get('hash') == digest:
+                return cached['schema']
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            pass
+
+    schema = compile_schema(yaml.safe_load(content))
+    if use_cache:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({'version': SCHEMA_VERSION, 'hash': digest, 'schema': schema}, f)
+            # Sustitución atómica: varios procesos pueden arrancar a la vez
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+    return schema
+
+
+def build_models(schema: dict[str, dict], module: str = __name__) -> dict[str, Type[Model]]:
+    # Crea las subclases de Model en el orden de la especificación
+    classes: dict[str, Type[Model]] = {}
+    for name, spec in schema.items():
+        base = getattr(models, spec['base'], None)
+        if not isinstance(base, type) or not issubclass(base, Model):
+            raise SchemaError(f"{name}.base: {spec['base']!r} no es un Model de models.py")
+        attributes = dict(spec['attributes'])
+        attributes['_model_classes'] = {field: classes.get(target) for field, target in spec['model_classes'].items()}
+        attributes['_indexes'] = [Index(index['keys'], **index['options']) for index in spec['indexes']]
+        attributes['__module__'] = module
+        classes[name] = type(name, (base,), attributes)
+        # Un modelo que se embebe a sí mismo
+        for field, target in spec['model_classes'].items():
+            if target == name:
+                classes[name]._model_classes[field] = classes[name]
+    return classes
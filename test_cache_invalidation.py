@@ -0,0 +1,101 @@
+import datetime
+import time
+import unittest
+import fakeredis
+import mongomock
+import pymongo
+from pymongo.errors import PyMongoError
+import cache_invalidation
+import config
+import models
+import testutils
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+def replica_set_database():
+    # Los change streams necesitan un replica set (URL_SERVER); sin él se omite
+    if not config.URL_SERVER:
+        return None
+    try:
+        client = pymongo.MongoClient(config.URL_SERVER, serverSelectionTimeoutMS=1000)
+        if "setName" not in client.admin.command("hello"):
+            return None
+    except PyMongoError:
+        return None
+    return client["test_cache_invalidation"]
+
+class TestFlush(unittest.TestCase):
+    def setUp(self):
+        self.r_cache = fakeredis.FakeRedis()
+        db = mongomock.MongoClient().db
+        for model in (models.Cliente, models.Producto):
+            testutils.bind_model(self, model, db[model.__name__.lower()], self.r_cache)
+        self.worker = cache_invalidation.CacheInvalidationWorker([models.Cliente, models.Producto])
+
+    def event(self, object_id):
+        return {"ns": {"coll": "cliente"}, "documentKey": {"_id": object_id}, "operationType": "update",
+                "wallTime": datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)}
+
+    def test_invalida_las_consultas_del_modelo(self):
+        cliente = models.Cliente(nombre="Beatriz Gómez", fecha_alta=datetime.datetime(2024, 1, 1))
+        cliente.save()
+        list(models.Cliente.find({"nombre": "Beatriz Gómez"}))
+        list(models.Producto.find({"nombre": "Gorra"}))
+        consulta = models.Cliente._cache_query_key(models.Cliente._serialize_find({"nombre": "Beatriz Gómez"}, None))
+        self.assertEqual(self.r_cache.smembers(models.Cliente._cache_query_set_key()), {consulta.encode()})
+        self.worker.flush([self.event(cliente._id)], token={"_data": "1"})
+        self.assertFalse(self.r_cache.exists(consulta, models.Cliente._cache_query_set_key()))
+        # Las consultas de Producto no se tocan
+        self.assertEqual(self.r_cache.scard(models.Producto._cache_query_set_key()), 1)
+        self.assertEqual(self.worker.metrics["keys_deleted_total"], 2)
+
+    def test_token_solo_si_cambia(self):
+        tokens = self.worker.database[cache_invalidation.TOKEN_COLLECTION]
+        self.worker.flush([], token={"_data": "1"})
+        guardado = tokens.find_one(self.worker.name)["updated_at"]
+        self.worker.flush([], token={"_data": "1"})
+        self.assertEqual(tokens.find_one(self.worker.name)["updated_at"], guardado)
+        self.worker.flush([], token={"_data": "2"})
+        self.assertEqual(tokens.find_one(self.worker.name)["token"], {"_data": "2"})
+
+class TestChangeStreams(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.database = replica_set_database()
+        if cls.database is None:
+            raise unittest.SkipTest("URL_SERVER no apunta a un replica set")
+
+    def setUp(self):
+        self.r_cache = fakeredis.FakeRedis()
+        self.database.client.drop_database(self.database.name)
+        testutils.bind_model(self, models.Cliente, self.database.cliente, self.r_cache, indexes_ready=False)
+        self.worker = cache_invalidation.CacheInvalidationWorker([models.Cliente], max_wait=0.1)
+
+    def tearDown(self):
+        self.worker.stop(5)
+        self.database.client.drop_database(self.database.name)
+
+    def test_escritura_externa(self):
+        cliente = models.Cliente(nombre="Beatriz Gómez", fecha_alta=datetime.datetime(2024, 1, 1))
+        cliente.save()
+        models.Cliente.find_by_id(cliente._id)
+        list(models.Cliente.find({"nombre": "Beatriz Gómez"}))
+        self.worker.start()
+        time.sleep(0.5)
+        # Escritura que no pasa por Model.save()
+        self.database.cliente.update_one({"_id": cliente._id}, {"$set": {"nombre": "Beatriz G."}})
+        self.assertTrue(wait_for(lambda: not self.r_cache.exists(models.Cliente._cache_key(str(cliente._id)))))
+        self.assertEqual(self.r_cache.scard(models.Cliente._cache_query_set_key()), 0)
+        self.assertEqual([c.nombre for c in models.Cliente.find({"nombre": "Beatriz G."})], ["Beatriz G."])
+        # Tras reiniciar, el worker sigue desde el token guardado
+        self.worker.stop(5)
+        self.assertIsNotNone(cache_invalidation.CacheInvalidationWorker([models.Cliente])._load_token())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import datetime
+import time
+import unittest
+import fakeredis
+import mongomock
+import circuit_breaker
+import instrumentation
+import models
+import testutils
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        self.r_cache = fakeredis.FakeRedis(server=self.server)
+        testutils.bind_model(self, models.Cliente, mongomock.MongoClient().db.cliente, self.r_cache)
+        self.breaker = models.Cliente._cache_breaker
+        self.breaker.reset_timeout = 0.05
+
+    def test_caida_y_recuperacion(self):
+        cliente = models.Cliente(nombre="Beatriz Gómez", fecha_alta=datetime.datetime(2024, 1, 1))
+        cliente.save()
+        key = models.Cliente._cache_key(str(cliente._id))
+        self.assertTrue(self.r_cache.exists(key))
+
+        self.server.connected = False
+        # La escritura en Mongo se completa aunque Redis no responda
+        cliente.fecha_ultimo_acceso = datetime.datetime(2024, 5, 1)
+        cliente.save()
+        for _ in range(self.breaker.failure_threshold):
+            self.assertEqual(models.Cliente.find_by_id(cliente._id).fecha_ultimo_acceso, datetime.datetime(2024, 5, 1))
+        self.assertEqual(self.breaker.state, circuit_breaker.OPEN)
+        self.assertEqual(instrumentation.CACHE_BREAKER_STATE.value(cache=self.breaker.name), 1)
+        self.assertEqual([c.nombre for c in models.Cliente.find({"nombre": "Beatriz Gómez"})], ["Beatriz Gómez"])
+
+        self.server.connected = True
+        self.assertTrue(wait_for(lambda: self.breaker.state == circuit_breaker.CLOSED))
+        # La copia anterior a la caída se invalidó al recuperarse
+        self.assertFalse(self.r_cache.exists(key))
+        self.assertEqual(models.Cliente.find_by_id(cliente._id).fecha_ultimo_acceso, datetime.datetime(2024, 5, 1))
+
+    def test_errores_de_uso_no_abren(self):
+        def wrong_type():
+            self.r_cache.set("x", "1")
+            return self.r_cache.lpush("x", "2")
+        with self.assertRaises(Exception):
+            self.breaker.call("lpush", wrong_type)
+        self.assertEqual(self.breaker.state, circuit_breaker.CLOSED)
+
+if __name__ == "__main__":
+    unittest.main()
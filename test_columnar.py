@@ -0,0 +1,61 @@
+import datetime
+import importlib.util
+import os
+import tempfile
+import unittest
+from bson import ObjectId
+import columnar
+
+HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+
+COMPRA = {
+    "_id": ObjectId(),
+    "cliente": {"_id": ObjectId(), "nombre": "Beatriz Gómez"},
+    "productos": [
+        {"nombre": "Camiseta", "precio": 12.5,
+         "proveedores": [{"_id": ObjectId(), "nombre": "Modas Paqui"}, {"_id": ObjectId(), "nombre": "Textil Sur"}]},
+        {"nombre": "Gorra", "precio": 8.0, "proveedores": [{"_id": ObjectId(), "nombre": "Modas Paqui"}]},
+    ],
+    "direccion_envio": {"ciudad": "Madrid", "location": {"type": "Point", "coordinates": [-3.70, 40.41]}},
+    "fecha_compra": datetime.datetime(2024, 4, 11, 10, 30),
+}
+
+class TestColumnar(unittest.TestCase):
+    def test_aplanado(self):
+        object_ids = set()
+        row = columnar.flatten(COMPRA, object_ids)
+        self.assertEqual(row["cliente.nombre"], "Beatriz Gómez")
+        self.assertEqual(row["productos[].precio"], [12.5, 8.0])
+        self.assertEqual(row["productos[].proveedores[].nombre"], [["Modas Paqui", "Textil Sur"], ["Modas Paqui"]])
+        self.assertEqual(row["direccion_envio.location.coordinates"], [-3.70, 40.41])
+        self.assertIn("productos[].proveedores[]._id", object_ids)
+        self.assertEqual(columnar.unflatten(row, object_ids), COMPRA)
+
+    @unittest.skipUnless(HAS_PYARROW, "pyarrow no está instalado")
+    def test_ida_y_vuelta(self):
+        documents = [dict(COMPRA, _id=ObjectId(), precio_compra=i) for i in range(25)]
+        with tempfile.TemporaryDirectory() as directory:
+            for extension in (".parquet", ".arrow"):
+                path = os.path.join(directory, "compra" + extension)
+                report = columnar.write_documents(iter(documents), path, batch_size=10)
+                self.assertEqual((report["rows"], report["batches"]), (25, 3))
+                self.assertEqual(columnar.read(path, columns=["precio_compra"]).num_rows, 25)
+                batches = list(columnar.iter_documents(path, batch_size=7))
+                self.assertTrue(all(len(batch) <= 7 for batch in batches))
+                self.assertEqual([d for batch in batches for d in batch], documents)
+
+    @unittest.skipUnless(HAS_PYARROW, "pyarrow no está instalado")
+    def test_columnas_nuevas_tras_el_primer_lote(self):
+        documents = [{"_id": i, "precio": 1.0} for i in range(3)] + [{"_id": 3, "precio": 2.0, "descuento": 0.5}]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "compra.parquet")
+            with self.assertRaisesRegex(ValueError, "descuento"):
+                columnar.write_documents(iter(documents), path, batch_size=2)
+            # Con un esquema explícito la columna se descarta a propósito
+            import pyarrow as pa
+            schema = pa.schema([("_id", pa.int64()), ("precio", pa.float64())])
+            report = columnar.write_documents(iter(documents), path, batch_size=2, schema=schema)
+            self.assertEqual((report["rows"], report["columns"]), (4, 2))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import datetime
+import unittest
+import fakeredis
+from bson import ObjectId
+import dispatch
+import memory_backend
+import models
+import testutils
+
+FECHA = datetime.datetime(2024, 4, 11)
+
+def compra(hora, almacen="Mayor"):
+    return {"_id": ObjectId(), "fecha_compra": FECHA + datetime.timedelta(hours=hora),
+            "productos": [{"nombre": "Camisa", "proveedores": [{"nombre": "Modas Paqui", "direcciones_almacenes": [
+                {"calle": almacen, "numero": 1, "ciudad": "Madrid", "pais": "España",
+                 "location": {"type": "Point", "coordinates": [-3.70, 40.41]}}]}]}]}
+
+class TestDispatch(unittest.TestCase):
+    def setUp(self):
+        testutils.bind_model(self, models.Compra, memory_backend.MemoryDatabase("odm").compra)
+        self.compras = [compra(1), compra(1.5, "Sol"), compra(9), compra(23)]
+        models.Compra.db.insert_many(self.compras)
+        self.r_queue = fakeredis.FakeRedis()
+
+    def job(self, minutes=60):
+        return dispatch.DispatchJob(FECHA, window=datetime.timedelta(minutes=minutes))
+
+    def listas(self, job):
+        return {l["almacen"]["calle"]: sorted(l["compras"]) for l in job.lists()}
+
+    def test_repetir_es_idempotente(self):
+        job = self.job()
+        report = job.run(self.r_queue)
+        self.assertEqual((report["processed"], report["compras"], report["enqueued"]), (24, 4, 4))
+        listas = self.listas(job)
+        self.assertEqual({calle: len(ids) for calle, ids in listas.items()}, {"Mayor": 3, "Sol": 1})
+        self.assertEqual(job.run(self.r_queue)["processed"], 0)
+        # Rehacer todo no cambia las listas ni vuelve a encolar
+        self.assertEqual(job.run(self.r_queue, restart=True)["enqueued"], 0)
+        self.assertEqual(self.listas(job), listas)
+        self.assertEqual(self.r_queue.llen(job.queue), 4)
+
+    def test_reanudar_tras_una_ventana_interrumpida(self):
+        job = self.job()
+        job.run(self.r_queue)
+        # Se cae tras escribir y encolar la ventana de las 9 sin marcarla
+        job._state().update_one({"_id": job.name}, {"$pull": {"windows_done": 9}})
+        report = job.run(self.r_queue)
+        self.assertEqual((report["processed"], report["enqueued"]), (1, 0))
+        self.assertEqual(self.r_queue.llen(job.queue), 4)
+        self.assertEqual(len(self.listas(job)["Mayor"]), 3)
+
+    def test_otro_tamano_de_ventana(self):
+        self.job(60).run(self.r_queue)
+        with self.assertRaises(ValueError):
+            self.job(30).run(self.r_queue)
+        self.assertEqual(self.job(30).run(self.r_queue, restart=True)["processed"], 48)
+
+    def test_restart_quita_compras_movidas(self):
+        job = self.job()
+        job.run()
+        movida = self.compras[1]["_id"]
+        models.Compra.db.update_one({"_id": movida}, {"$set": {"fecha_compra": FECHA + datetime.timedelta(days=1)}})
+        job.run(restart=True)
+        self.assertEqual(list(self.listas(job)), ["Mayor"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import datetime
+import unittest
+import generator
+import memory_backend
+
+PARAMS = {"seed": 7, "proveedores": 20, "productos": 60, "clientes": 50, "compras": 200, "fixture_compras": 5}
+
+class TestSyntheticData(unittest.TestCase):
+    def test_independiente_de_procesos_y_lotes(self):
+        # Cada documento depende solo de la semilla y de su índice
+        total = generator.SyntheticData(**PARAMS).documents("compra", 0, 205)
+        for size in (1, 7, 64):
+            with self.subTest(chunk=size):
+                # Cada lote en su propio "proceso" y en orden inverso, como con imap_unordered
+                chunks = {start: generator.SyntheticData(**PARAMS).documents("compra", start, min(start + size, 205))
+                          for start in reversed(range(0, 205, size))}
+                self.assertEqual([doc for start in sorted(chunks) for doc in chunks[start]], total)
+
+    def test_ids_deterministas(self):
+        a, b = generator.SyntheticData(**PARAMS), generator.SyntheticData(**PARAMS)
+        for kind in generator.KINDS:
+            ids = [doc["_id"] for doc in a.documents(kind, 0, 10)]
+            self.assertEqual(ids, [doc["_id"] for doc in b.documents(kind, 0, 10)])
+            self.assertEqual(len(set(ids)), 10)
+        self.assertNotEqual(generator.SyntheticData(**dict(PARAMS, seed=8)).compra(0)["_id"], a.compra(0)["_id"])
+
+    def test_fixtures_del_notebook(self):
+        data = generator.SyntheticData(**PARAMS)
+        generator.check_schema(data)
+        for producto in data.documents("producto", 0, PARAMS["productos"]):
+            if "manga corta" in producto["nombre"]:
+                self.assertIn("Modas Paqui", [p["nombre"] for p in producto["proveedores"]])
+        fixtures = data.documents("compra", PARAMS["compras"], data.count("compra"))
+        self.assertEqual(len(fixtures), 5)
+        for compra in fixtures:
+            self.assertEqual(compra["cliente"]["nombre"], "Beatriz Gómez")
+            self.assertEqual(compra["fecha_compra"].date(), datetime.date(2024, 4, 11))
+
+    def test_repetir_solo_inserta_lo_que_falta(self):
+        db = memory_backend.MemoryDatabase("t")
+        generator._worker_state.update(data=generator.SyntheticData(**PARAMS), db=db)
+        self.addCleanup(generator._worker_state.clear)
+        self.assertEqual(generator._insert_chunk(("cliente", 0, 20))[1:3], (20, 0))
+        self.assertEqual(generator._insert_chunk(("cliente", 10, 30))[1:3], (10, 10))
+        self.assertEqual(db.cliente.count_documents({}), 30)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+import mongomock
+import index_advisor
+import models
+from models import Index, ASCENDING, DESCENDING, GEOSPHERE
+import testutils
+
+class Nota(models.Model):
+    required_vars = {"titulo"}
+    admissible_vars = {"autor", "creada", "location"}
+    _indexes = [
+        Index([("autor", ASCENDING), ("creada", DESCENDING)]),
+        Index("titulo", unique=True, partial={"autor": {"$exists": True}}),
+        Index("creada", ttl=3600),
+    ]
+
+class TestIndexSync(unittest.TestCase):
+    def setUp(self):
+        self.indexes = Nota._indexes
+        testutils.bind_model(self, Nota, mongomock.MongoClient().db.nota, indexes_ready=False)
+
+    def tearDown(self):
+        Nota._indexes = self.indexes
+
+    def test_nombres_y_opciones(self):
+        self.assertEqual(Index("titulo").keys, [("titulo", ASCENDING)])
+        self.assertEqual(Index(("location", GEOSPHERE)).keys, [("location", GEOSPHERE)])
+        self.assertEqual(Index([("autor", 1), ("creada", -1)]).name, "autor_1_creada_-1")
+        self.assertEqual(Index("creada", ttl=60, sparse=True).options, {"sparse": True, "expireAfterSeconds": 60})
+
+    def test_creacion(self):
+        Nota._create_indexes()
+        info = Nota.db.index_information()
+        self.assertEqual(info["autor_1_creada_-1"]["key"], [("autor", 1), ("creada", -1)])
+        self.assertTrue(info["titulo_1"]["unique"])
+        self.assertEqual(info["titulo_1"]["partialFilterExpression"], {"autor": {"$exists": True}})
+        self.assertEqual(info["creada_1"]["expireAfterSeconds"], 3600)
+
+    def test_sin_cambios_no_se_recrea(self):
+        # Un índice equivalente con otro nombre tampoco se duplica
+        Nota.db.create_index([("creada", ASCENDING)], name="caducidad", expireAfterSeconds=3600)
+        Nota._create_indexes()
+        before = Nota.db.index_information()
+        self.assertNotIn("creada_1", before)
+        with self.assertNoLogs(models.logger, "WARNING"):
+            Nota._create_indexes()
+        self.assertEqual(Nota.db.index_information(), before)
+
+    def test_opciones_cambiadas(self):
+        Nota._create_indexes()
+        Nota._indexes = [Index("titulo", unique=True), Index("creada", ttl=60)]
+        with self.assertLogs(models.logger, "WARNING") as logs:
+            Nota._create_indexes()
+        self.assertEqual(len(logs.output), 2)
+        info = Nota.db.index_information()
+        self.assertNotIn("partialFilterExpression", info["titulo_1"])
+        self.assertEqual(info["creada_1"]["expireAfterSeconds"], 60)
+        # Los índices que ya no se declaran no se tocan
+        self.assertIn("autor_1_creada_-1", info)
+
+class TestSuggestIndex(unittest.TestCase):
+    def test_regla_esr(self):
+        # Igualdad, después ordenación y por último rangos
+        filtro = {"precio": {"$gt": 10}, "cliente.nombre": "Ana", "estado": {"$in": ["a", "b"]}}
+        self.assertEqual(index_advisor.suggest_index(filtro, [("fecha_compra", DESCENDING), ("_id", DESCENDING)]),
+                         [("cliente.nombre", ASCENDING), ("estado", ASCENDING), ("fecha_compra", DESCENDING),
+                          ("precio", ASCENDING)])
+
+    def test_and_or_y_geo(self):
+        filtro = {"$and": [{"a": 1}, {"b": {"$lt": 3}}], "$or": [{"c": 1}, {"d": 2}],
+                  "location": {"$near": {"$geometry": {"type": "Point", "coordinates": [0, 0]}}}}
+        self.assertEqual(index_advisor.suggest_index(filtro),
+                         [("a", ASCENDING), ("b", ASCENDING), ("location", GEOSPHERE)])
+        # Un campo repetido aparece una sola vez, en su primera posición
+        self.assertEqual(index_advisor.suggest_index({"a": 1}, [("a", DESCENDING)]), [("a", ASCENDING)])
+
+if __name__ == "__main__":
+    unittest.main()
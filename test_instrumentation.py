@@ -0,0 +1,56 @@
+import datetime
+import json
+import types
+import unittest
+import fakeredis
+import mongomock
+import instrumentation
+import models
+import testutils
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.instrumentation = (instrumentation.enabled, instrumentation.slow_query_ms)
+        instrumentation.enable(slow_ms=50)
+        instrumentation.reset()
+        testutils.bind_model(self, models.Cliente, mongomock.MongoClient().db.cliente, fakeredis.FakeRedis())
+
+    def tearDown(self):
+        instrumentation.enabled, instrumentation.slow_query_ms = self.instrumentation
+        instrumentation.reset()
+
+    def test_metricas_de_find(self):
+        models.Cliente(nombre="Beatriz Gómez", fecha_alta=datetime.datetime(2024, 1, 1)).save()
+        for _ in range(2):
+            self.assertEqual(len(list(models.Cliente.find({"nombre": "Beatriz Gómez"}))), 1)
+        text = instrumentation.render()
+        self.assertIn('odm_cache_requests_total{model="Cliente",operation="query_get",result="miss"} 1\n', text)
+        self.assertIn('odm_cache_requests_total{model="Cliente",operation="query_get",result="hit"} 1\n', text)
+        self.assertIn("# TYPE odm_hydration_seconds histogram\n", text)
+        self.assertIn('odm_hydration_seconds_bucket{model="Cliente",le="+Inf"} 2\n', text)
+        self.assertIn('odm_hydration_seconds_count{model="Cliente"} 2\n', text)
+        self.assertIn('odm_hydrated_documents_total{model="Cliente"} 2\n', text)
+
+    def test_log_de_consultas_lentas(self):
+        # mongomock no emite eventos de monitorización: se pasan al listener
+        # los que enviaría pymongo para este find
+        listener = instrumentation.command_listener()
+        command = {"find": "cliente", "filter": {"nombre": "Ana", "fecha_alta": {"$gte": datetime.datetime(2024, 1, 1)}},
+                   "sort": {"fecha_alta": -1}}
+        with self.assertLogs("odm.slow_queries", "WARNING") as logs:
+            for request_id, micros in [(1, 120000), (2, 1000)]:
+                listener.started(types.SimpleNamespace(command_name="find", command=command, request_id=request_id))
+                listener.succeeded(types.SimpleNamespace(command_name="find", request_id=request_id,
+                                                         duration_micros=micros))
+        self.assertEqual(len(logs.records), 1)
+        entry = json.loads(logs.records[0].getMessage())
+        self.assertEqual((entry["kind"], entry["target"], entry["ms"]), ("find", "cliente", 120.0))
+        self.assertEqual(entry["shape"], {"filter": {"fecha_alta": {"$gte": "?"}, "nombre": "?"},
+                                          "sort": {"fecha_alta": "?"}})
+        text = instrumentation.render()
+        self.assertIn('odm_mongo_commands_total{collection="cliente",command="find"} 2\n', text)
+        self.assertIn('odm_mongo_command_seconds_count{collection="cliente",command="find"} 2\n', text)
+        self.assertIn('odm_slow_queries_total{kind="find",target="cliente"} 1\n', text)
+
+if __name__ == "__main__":
+    unittest.main()
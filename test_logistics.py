@@ -1,6 +1,8 @@
 import unittest
 from datetime import datetime, timedelta
-from logistics import LogisticsManager
+import types
+from logistics import (LogisticsManager, package_loads, first_fit_decreasing, encode_routes,
+                       evaluate_routes, deadline_windows, select_route)
 from config import NEO4J_URI, NEO4J_USER, NEO4J_PASSWORD
 
 class TestLogistics(unittest.TestCase):
@@ -81,5 +83,77 @@ class TestLogistics(unittest.TestCase):
             self.manager.update_vehicle_position(vehicle_id, next_node)
             # No podemos verificar fácilmente el cambio sin consultar la BD, pero al menos no debe fallar
 
+class TestLoadPlanning(unittest.TestCase):
+    # Planificación de carga: no necesita Neo4j
+
+    def test_package_loads(self):
+        compras = [
+            {"_id": 1, "productos": [{"peso": 1.5, "dimensiones": {"ancho": 10, "alto": 20, "profundidad": 30}},
+                                     {"peso": 2.0, "dimensiones": {"ancho": 100, "alto": 100, "profundidad": 100}}]},
+            {"_id": 2, "productos": []},
+        ]
+        ids, peso, volumen = package_loads(compras)
+        self.assertEqual(ids, [1, 2])
+        self.assertEqual(peso.tolist(), [3.5, 0.0])
+        self.assertAlmostEqual(volumen[0], 1.006)
+        self.assertEqual(volumen[1], 0.0)
+
+    def test_first_fit_decreasing(self):
+        peso = [600, 500, 400, 300, 200]
+        volumen = [1, 1, 1, 1, 9]
+        bins, free = first_fit_decreasing(peso, volumen, (1000, 10))
+        # El paquete voluminoso solo admite un acompañante: 3 es el óptimo
+        self.assertEqual(len(free), 3)
+        for b in range(len(free)):
+            self.assertLessEqual(sum(p for p, x in zip(peso, bins) if x == b), 1000)
+            self.assertLessEqual(sum(v for v, x in zip(volumen, bins) if x == b), 10)
+        self.assertTrue((free >= 0).all())
+
+    def test_vehiculos_existentes_primero(self):
+        # Un vehículo existente con hueco se llena antes de crear otro
+        bins, free = first_fit_decreasing([100, 100], [1, 1], (1000, 10), restante=[[250, 5]])
+        self.assertEqual(bins.tolist(), [0, 0])
+        self.assertEqual(free.tolist(), [[50, 3]])
+        with self.assertRaises(ValueError):
+            first_fit_decreasing([2000], [1], (1000, 10))
+
+class TestRouteEvaluation(unittest.TestCase):
+    # Evaluación vectorizada de rutas: no necesita Neo4j
+
+    def path(self, *segments):
+        nodes = [{"name": "A"}]
+        for distancia, transporte in segments:
+            nodes += [{"distancia_km": distancia, "transporte": transporte}, {"name": "B"}]
+        return types.SimpleNamespace(nodes=nodes)
+
+    def test_igual_que_por_nodo(self):
+        manager = LogisticsManager.__new__(LogisticsManager)
+        paths = [self.path((430, "Aéreo")),
+                 self.path((300, "Carretera"), (200, "Ferrocarril"), (100, "Ferrocarril"), (50, "Carretera")),
+                 self.path((0, "Marítimo"), (120, "Marítimo"))]
+        tiempo, coste = evaluate_routes(*encode_routes(paths))
+        for i, path in enumerate(paths):
+            esperado = manager._calcular_tiempo_coste_ruta(path)
+            self.assertAlmostEqual(tiempo[i], esperado[0])
+            self.assertAlmostEqual(coste[i], esperado[1])
+
+    def test_ventanas_con_now_fijo(self):
+        windows = deadline_windows(datetime(2024, 4, 11, 10, 0))
+        self.assertEqual(windows[1], 8 * 60)
+        self.assertEqual(windows[2], 28 * 60)
+        self.assertEqual(windows[3], float("inf"))
+        # Pasadas las 18h ya no cabe una entrega en el día
+        self.assertLess(deadline_windows(datetime(2024, 4, 11, 20, 0))[1], 0)
+
+    def test_select_route(self):
+        paths = [self.path((600, "Carretera")), self.path((600, "Aéreo")), self.path((600, "Marítimo"))]
+        windows = deadline_windows(datetime(2024, 4, 11, 10, 0))
+        # Tipo 1 (480 min): solo Carretera (360) y Aéreo (60) llegan; Carretera es más barata
+        self.assertEqual(select_route(paths, 1, windows)[0], 0)
+        # Tipo 3: la marítima, la más barata
+        self.assertEqual(select_route(paths, 3, windows)[0], 2)
+        self.assertIsNone(select_route(paths, 4, windows))
+        self.assertIsNone(select_route([paths[2]], 1, windows))
+
 if __name__ == '__main__':
     unittest.main()
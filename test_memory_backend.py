@@ -0,0 +1,134 @@
+import copy
+import datetime
+import unittest
+import mongomock
+from bson import ObjectId
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import bench
+import memory_backend
+import models
+import testutils
+
+def punto(lon, lat):
+    return {"type": "Point", "coordinates": [lon, lat]}
+
+class TestConsultas(unittest.TestCase):
+    # Mismos resultados que mongomock, pero con los índices de Compra
+    @classmethod
+    def setUpClass(cls):
+        docs = bench.compra_documents(600, seed=3)
+        for doc in docs:
+            doc["_id"] = ObjectId()
+        cls.memory = memory_backend.MemoryDatabase("t").compra
+        for index in map(models.Index.from_spec, models.Compra._indexes):
+            cls.memory.create_index(index.keys, name=index.name, **index.options)
+        cls.memory.insert_many(copy.deepcopy(docs))
+        cls.mock = mongomock.MongoClient().t.compra
+        cls.mock.insert_many(copy.deepcopy(docs))
+        cls.doc = docs[0]
+
+    def test_filtros(self):
+        cliente, fecha = self.doc["cliente"]["nombre"], self.doc["fecha_compra"]
+        proveedor = self.doc["productos"][0]["proveedores"][0]["nombre"]
+        filtros = [
+            ({"cliente.nombre": cliente}, True),
+            ({"fecha_compra": {"$gte": fecha, "$lt": fecha + datetime.timedelta(days=20)}}, True),
+            ({"productos.proveedores.nombre": proveedor, "precio_compra": {"$gt": 20}}, True),
+            ({"$or": [{"cliente.nombre": cliente}, {"fecha_compra": {"$lte": fecha}}]}, True),
+            ({"$or": [{"cliente.nombre": cliente}, {"precio_compra": {"$lt": 30}}]}, False),
+            ({"cliente.nombre": {"$in": [cliente, "Nadie"]}, "productos.nombre": {"$regex": "^c", "$options": "i"}}, True),
+        ]
+        for filtro, indexado in filtros:
+            with self.subTest(filtro=filtro):
+                esperado = sorted(doc["_id"] for doc in self.mock.find(filtro))
+                self.assertEqual(sorted(doc["_id"] for doc in self.memory.find(filtro)), esperado)
+                candidatos = self.memory._plan(filtro)
+                self.assertEqual(candidatos is not None, indexado)
+                if indexado:
+                    self.assertLess(len(candidatos), self.memory.estimated_document_count())
+
+    def test_orden_proyeccion_y_agregacion(self):
+        consulta = lambda c: list(c.find({}, {"cliente.nombre": 1, "productos.precio": 1}).sort("fecha_compra", -1).limit(5))
+        self.assertEqual(consulta(self.memory), consulta(self.mock))
+        pipeline = [{"$match": {"fecha_compra": {"$gte": self.doc["fecha_compra"]}}},
+                    {"$unwind": "$productos"}, {"$unwind": "$productos.proveedores"},
+                    {"$group": {"_id": "$productos.proveedores.nombre", "total": {"$sum": "$productos.precio"},
+                                "lineas": {"$sum": 1}}},
+                    {"$sort": {"total": -1}}, {"$limit": 3}, {"$project": {"total": 1}}]
+        self.assertEqual(list(self.memory.aggregate(pipeline)), list(self.mock.aggregate(pipeline)))
+
+class TestEscrituras(unittest.TestCase):
+    def setUp(self):
+        self.db = memory_backend.MemoryDatabase("t")
+
+    def test_indice_unico_y_lotes(self):
+        clientes = self.db.cliente
+        clientes.create_index("nombre", unique=True)
+        clientes.insert_one({"nombre": "Ana"})
+        with self.assertRaises(DuplicateKeyError):
+            clientes.insert_one({"nombre": "Ana"})
+        with self.assertRaises(BulkWriteError) as error:
+            clientes.insert_many([{"nombre": "Luis"}, {"nombre": "Ana"}, {"nombre": "Eva"}], ordered=False)
+        self.assertEqual(error.exception.details["nInserted"], 2)
+        result = clientes.bulk_write([UpdateOne({"nombre": "Luis"}, {"$inc": {"visitas": 2}}),
+                                      UpdateOne({"nombre": "Pepe"}, {"$setOnInsert": {"visitas": 1}}, upsert=True),
+                                      DeleteOne({"nombre": "Eva"})])
+        self.assertEqual((result.matched_count, result.upserted_count, result.deleted_count), (1, 1, 1))
+        self.assertEqual({c["nombre"]: c.get("visitas") for c in clientes.find({}, {"_id": 0})},
+                         {"Ana": None, "Luis": 2, "Pepe": 1})
+        self.assertEqual(clientes.find_one({"nombre": "Luis"}, {"nombre": 1}).keys(), {"_id", "nombre"})
+
+    def test_rango_multiclave(self):
+        # Cada límite del rango lo puede cumplir un elemento distinto del array
+        docs = [{"_id": 1, "x": [1, 10]}, {"_id": 2, "x": 3}, {"_id": 3, "x": [6, "a"]}]
+        coleccion, mock = self.db.rangos, mongomock.MongoClient().t.rangos
+        coleccion.create_index("x")
+        coleccion.insert_many(copy.deepcopy(docs))
+        mock.insert_many(copy.deepcopy(docs))
+        for filtro in [{"x": {"$gt": 5, "$lt": 8}}, {"x": {"$gte": 2, "$lte": 4}}, {"x": {"$gt": 0, "$lt": "b"}}]:
+            with self.subTest(filtro=filtro):
+                self.assertEqual([d["_id"] for d in coleccion.find(filtro)], [d["_id"] for d in mock.find(filtro)])
+
+    def test_geo_y_merge(self):
+        almacenes = self.db.almacen
+        almacenes.create_index([("location", "2dsphere")])
+        almacenes.insert_many([{"_id": "sol", "location": punto(-3.7038, 40.4168)},
+                               {"_id": "retiro", "location": punto(-3.6823, 40.4153)},
+                               {"_id": "getafe", "location": punto(-3.7325, 40.3083)}])
+        cerca = almacenes.find({"location": {"$near": {"$geometry": punto(-3.70, 40.42), "$maxDistance": 5000}}})
+        self.assertEqual([a["_id"] for a in cerca], ["sol", "retiro"])
+        caja = [[-3.75, 40.30], [-3.70, 40.30], [-3.70, 40.35], [-3.75, 40.35], [-3.75, 40.30]]
+        self.assertEqual([a["_id"] for a in almacenes.find({"location": {"$geoWithin": {"$geometry": {
+            "type": "Polygon", "coordinates": [caja]}}}})], ["getafe"])
+        merge = {"$merge": {"into": "despachos", "whenMatched": [
+            {"$set": {"compras": {"$setUnion": ["$compras", "$$new.compras"]}}}]}}
+        for compras in (["a", "b"], ["b", "c"]):
+            list(almacenes.aggregate([{"$match": {"_id": "sol"}}, {"$project": {"compras": {"$literal": compras}}}, merge]))
+        self.assertEqual(self.db.despachos.find_one("sol")["compras"], ["a", "b", "c"])
+
+class TestModelos(unittest.TestCase):
+    def setUp(self):
+        db = memory_backend.MemoryDatabase("odm")
+        testutils.bind_model(self, models.Producto, db.producto, indexes_ready=False)
+        testutils.bind_model(self, models.Compra, db.compra, indexes_ready=False)
+
+    def test_busqueda_y_paginacion(self):
+        proveedores = [{"nombre": "Modas Paqui"}]
+        for i, nombre in enumerate(["Camiseta manga corta", "Camisa de manga larga", "Pantalón corto"]):
+            models.Producto(nombre=nombre, codigo_producto_proveedor=f"P{i}", precio=10.0 + i, peso=0.3,
+                            dimensiones={"ancho": 30, "alto": 40, "profundidad": 2}, proveedores=proveedores).save()
+        self.assertIn("nombre_text", models.Producto.db.index_information())
+        self.assertEqual([p.nombre for p in models.Producto.search("MANGA corta")], ["Camiseta manga corta"])
+        self.assertEqual([p.nombre for p in models.Producto.search("corto pantalón", phrase=False)],
+                         ["Pantalón corto"])
+        self.assertEqual(len(list(models.Producto.search("manga", phrase=False, limit=1))), 1)
+        page = models.Producto.paginate({"proveedores.nombre": "Modas Paqui"}, sort=[("precio", -1)], page_size=2)
+        self.assertEqual([p.precio for p in page], [12.0, 11.0])
+        nxt = models.Producto.paginate({"proveedores.nombre": "Modas Paqui"}, sort=[("precio", -1)], page_size=2,
+                                       token=page.next_token)
+        self.assertEqual([p.precio for p in nxt], [10.0])
+        self.assertFalse(nxt.has_next)
+
+if __name__ == "__main__":
+    unittest.main()
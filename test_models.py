@@ -0,0 +1,172 @@
+import base64
+import datetime
+import threading
+import time
+import unittest
+import fakeredis
+import mongomock
+from mongomock_motor import AsyncMongoMockClient
+import config
+import models
+import resources
+import testutils
+
+class TestQueryCache(unittest.TestCase):
+    def setUp(self):
+        self.r_cache = fakeredis.FakeRedis()
+        testutils.bind_model(self, models.Cliente, mongomock.MongoClient().db.cliente, self.r_cache)
+
+    def test_valor_sin_sobre_es_fallo(self):
+        # Entradas escritas antes del sobre {'v', 'd', 'e'}
+        self.r_cache.set(models.Cliente._cache_query_key("q"), "[1, 2]")
+        self.assertEqual(models.Cliente._cached_query("q", lambda: [3]), ([3], False))
+        self.assertEqual(models.Cliente._cached_query("q", lambda: [4]), ([3], True))
+
+    def test_calculo_mas_largo_que_el_cerrojo(self):
+        models.Cliente._query_lock_timeout = 0.05
+        self.addCleanup(delattr, models.Cliente, "_query_lock_timeout")
+        def slow():
+            time.sleep(0.15)
+            return [1]
+        self.assertEqual(models.Cliente._cached_query("q", slow), ([1], False))
+
+    def test_espera_y_toma_el_cerrojo_abandonado(self):
+        # El worker que tenía el cerrojo falla sin guardar nada
+        lock = models.Cliente._query_lock("q")
+        self.assertTrue(lock.acquire())
+        threading.Timer(0.05, lock.release).start()
+        started = time.monotonic()
+        self.assertEqual(models.Cliente._cached_query("q", lambda: [1]), ([1], False))
+        self.assertLess(time.monotonic() - started, 5)
+
+class TestProyecciones(unittest.TestCase):
+    def setUp(self):
+        self.r_cache = fakeredis.FakeRedis()
+        testutils.bind_model(self, models.Cliente, mongomock.MongoClient().db.cliente, self.r_cache)
+        self.cliente = models.Cliente(nombre="Beatriz Gómez", fecha_alta=datetime.datetime(2024, 1, 1),
+                                      tarjetas_pago=["1234"],
+                                      direcciones_envio=[{"calle": "Mayor", "numero": 1, "ciudad": "Madrid",
+                                                          "codigo_postal": "28013", "pais": "España"}])
+        self.cliente.save()
+
+    def test_find_con_proyeccion(self):
+        cliente, = models.Cliente.find({"nombre": "Beatriz Gómez"}, projection=["nombre", "direcciones_envio.ciudad"])
+        self.assertTrue(cliente.is_partial)
+        self.assertEqual((cliente._id, cliente.nombre), (self.cliente._id, "Beatriz Gómez"))
+        self.assertEqual(cliente.direcciones_envio[0].ciudad, "Madrid")
+        # La proyección forma parte de la clave de la consulta cacheada
+        completo, = models.Cliente.find({"nombre": "Beatriz Gómez"})
+        self.assertFalse(completo.is_partial)
+        self.assertEqual(completo.tarjetas_pago, ["1234"])
+
+    def test_campo_no_cargado(self):
+        cliente = models.Cliente.find_by_id(self.cliente._id, projection=["nombre"])
+        with self.assertRaises(models.UnloadedFieldError):
+            cliente.fecha_alta
+        # Sigue siendo un AttributeError: getattr con valor por defecto funciona
+        self.assertIsNone(getattr(cliente, "tarjetas_pago", None))
+
+    def test_carga_perezosa(self):
+        cliente, = models.Cliente.find({"nombre": "Beatriz Gómez"}, projection=["nombre"], lazy=True)
+        self.assertEqual(cliente.fecha_alta, datetime.datetime(2024, 1, 1))
+        self.assertEqual(cliente.direcciones_envio[0].ciudad, "Madrid")
+        self.assertFalse(cliente._changed_fields)
+
+    def test_guardar_instancia_parcial(self):
+        cliente = models.Cliente.find_by_id(self.cliente._id, projection=["nombre"])
+        cliente.tarjetas_pago = ["5678"]
+        cliente.save()
+        doc = models.Cliente.db.find_one({"_id": self.cliente._id})
+        # Solo se escribe lo cambiado; el resto del documento se conserva
+        self.assertEqual((doc["tarjetas_pago"], doc["fecha_alta"], doc["direcciones_envio"][0]["calle"]),
+                         (["5678"], datetime.datetime(2024, 1, 1), "Mayor"))
+        # La copia parcial no sustituye al documento cacheado
+        self.assertFalse(self.r_cache.exists(models.Cliente._cache_key(str(self.cliente._id))))
+        self.assertEqual(models.Cliente.find_by_id(self.cliente._id).tarjetas_pago, ["5678"])
+
+    def test_subdocumentos_parciales(self):
+        cliente = models.Cliente.find_by_id(self.cliente._id, projection=["nombre", "direcciones_envio.ciudad"])
+        cliente.direcciones_envio = list(cliente.direcciones_envio) + [models.Direccion(
+            calle="Sol", numero=2, ciudad="Toledo", codigo_postal="45001", pais="España")]
+        with self.assertRaises(ValueError):
+            cliente.save()
+        doc = models.Cliente.db.find_one({"_id": self.cliente._id})
+        self.assertEqual((len(doc["direcciones_envio"]), doc["direcciones_envio"][0]["calle"]), (1, "Mayor"))
+        # Un subdocumento suelto parcial se escribe campo a campo
+        compra = models.Compra(_fields={"cliente": {"nombre": True}}, _id=self.cliente._id, cliente={"nombre": "Ana"})
+        compra.cliente = models.Cliente(_fields={"nombre": True}, nombre="Eva")
+        self.assertEqual(compra.to_update_dict(), {"cliente.nombre": "Eva"})
+
+    def test_no_se_inserta_una_instancia_parcial(self):
+        parcial = models.Cliente(_fields={"nombre": True}, nombre="Luis")
+        with self.assertRaises(ValueError):
+            parcial.save()
+        with self.assertRaises(ValueError):
+            models.Cliente.save_many([parcial])
+        self.assertEqual(models.Cliente.db.count_documents({"nombre": "Luis"}), 0)
+
+class TestPaginacion(unittest.TestCase):
+    def setUp(self):
+        testutils.bind_model(self, models.Cliente, mongomock.MongoClient().db.cliente)
+        # Fechas repetidas: el _id desempata
+        models.Cliente.save_many([models.Cliente(nombre=f"Cliente {i}", fecha_alta=datetime.datetime(2024, 1, 1 + i // 3))
+                                  for i in range(7)])
+
+    def test_desempate_por_id(self):
+        for direction in (1, -1):
+            with self.subTest(direction=direction):
+                pages = list(models.Cliente.iter_pages({}, sort=[("fecha_alta", direction)], page_size=2))
+                self.assertEqual([len(page) for page in pages], [2, 2, 2, 1])
+                seen = [(c.fecha_alta, c._id) for page in pages for c in page]
+                self.assertEqual(seen, sorted(seen, reverse=direction == -1))
+                self.assertEqual(len(set(seen)), 7)
+
+    def test_tokens_no_validos(self):
+        for token in ["no es base64!", base64.urlsafe_b64encode(b"[1, 2]").decode(),
+                      base64.urlsafe_b64encode(b'{"q": "x"}').decode()]:
+            with self.subTest(token=token), self.assertRaisesRegex(ValueError, "no válido"):
+                models.Cliente.paginate({}, sort="fecha_alta", token=token)
+
+    def test_token_de_otra_consulta(self):
+        token = models.Cliente.paginate({}, sort="fecha_alta", page_size=2).next_token
+        with self.assertRaisesRegex(ValueError, "otra consulta"):
+            models.Cliente.paginate({"nombre": "Cliente 1"}, sort="fecha_alta", token=token)
+        with self.assertRaisesRegex(ValueError, "otra consulta"):
+            models.Cliente.paginate({}, sort=[("fecha_alta", -1)], token=token)
+
+class TestAsync(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        server = fakeredis.FakeServer()
+        self.r_cache = fakeredis.FakeRedis(server=server)
+        testutils.bind_model(self, models.Cliente, mongomock.MongoClient().odm.cliente, self.r_cache)
+        # Clientes asíncronos del bucle del test
+        clients = resources._get_async_clients()
+        clients["mongo"] = {config.URL_DB: AsyncMongoMockClient()}
+        clients["redis_cache"] = fakeredis.FakeAsyncRedis(server=server)
+
+    async def asyncTearDown(self):
+        await resources.aclose_all()
+
+    async def test_asave_y_afind(self):
+        cliente = models.Cliente(nombre="Beatriz Gómez", fecha_alta=datetime.datetime(2024, 1, 1))
+        await cliente.asave()
+        # Misma clave y mismo codec que la API síncrona
+        self.assertEqual(models.Cliente.find_by_id(cliente._id).nombre, "Beatriz Gómez")
+        encontrados = await models.Cliente.afind({"nombre": "Beatriz Gómez"})
+        self.assertEqual([c._id for c in encontrados], [cliente._id])
+        self.assertFalse(encontrados.from_cache)
+        self.assertTrue((await models.Cliente.afind({"nombre": "Beatriz Gómez"})).from_cache)
+        cliente.fecha_alta = datetime.datetime(2024, 2, 1)
+        await cliente.asave()
+        self.assertEqual((await models.Cliente.afind_by_id(cliente._id)).fecha_alta, datetime.datetime(2024, 2, 1))
+
+    async def test_mismo_servidor_que_la_api_sincrona(self):
+        uri = "mongodb://otro-servidor:27017"
+        self.addCleanup(lambda: resources._mongo_clients.pop(uri).close())
+        testutils.bind_model(self, models.Cliente, resources.get_database("ventas", uri).cliente)
+        adb = models.Cliente._async_db()
+        self.assertEqual((adb.database.name, adb.name), ("ventas", "cliente"))
+        self.assertIs(adb.database.client, resources._get_async_clients()["mongo"][uri])
+
+if __name__ == "__main__":
+    unittest.main()
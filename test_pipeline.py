@@ -0,0 +1,106 @@
+import unittest
+import mongomock
+from pipeline import Pipeline, optimize_pipeline, push_match_before_unwind, push_limit_after_sort, add_early_project
+import parallel_aggregate
+
+class TestPipelineOptimizer(unittest.TestCase):
+    def test_match_independiente_antes_de_unwind(self):
+        # El filtro por nombre no depende de proveedores: se adelanta entero
+        stages = [{"$unwind": "$proveedores"}, {"$match": {"nombre": "Camiseta"}}]
+        self.assertEqual(push_match_before_unwind(stages),
+                         [{"$match": {"nombre": "Camiseta"}}, {"$unwind": "$proveedores"}])
+
+    def test_match_dependiente_se_copia_como_prefiltro(self):
+        # Consulta 4: el predicado sobre proveedores.nombre se duplica delante
+        stages = (Pipeline()
+                  .unwind("proveedores")
+                  .match({"proveedores.nombre": "Modas Paqui", "nombre": {"$regex": "camiseta", "$options": "i"}})
+                  .to_list())
+        self.assertEqual(push_match_before_unwind(stages), [
+            {"$match": {"nombre": {"$regex": "camiseta", "$options": "i"}, "proveedores.nombre": "Modas Paqui"}},
+            {"$unwind": "$proveedores"},
+            {"$match": {"proveedores.nombre": "Modas Paqui"}},
+        ])
+
+    def test_negaciones_no_se_copian(self):
+        # $ne o igualdad a null sobre el array no son prefiltros válidos
+        stages = [{"$unwind": "$productos"},
+                  {"$match": {"productos.nombre": {"$ne": "Gorra"}, "productos.precio": None}}]
+        self.assertEqual(push_match_before_unwind(stages), stages)
+
+    def test_campos_repetidos_en_and(self):
+        # Los predicados de un mismo campo en ramas del $and no se pisan
+        stages = [{"$unwind": "$productos"},
+                  {"$match": {"$and": [{"fecha_compra": {"$gte": 1}}, {"fecha_compra": {"$lt": 5}},
+                                       {"productos.precio": {"$gt": 10}}, {"productos.precio": {"$gt": 20}}]}}]
+        self.assertEqual(push_match_before_unwind(stages), [
+            {"$match": {"fecha_compra": {"$gte": 1, "$lt": 5},
+                        "$and": [{"productos.precio": {"$gt": 20}}], "productos.precio": {"$gt": 10}}},
+            {"$unwind": "$productos"},
+            {"$match": {"productos.precio": {"$gt": 10}, "$and": [{"productos.precio": {"$gt": 20}}]}},
+        ])
+
+    def test_include_array_index(self):
+        stages = [{"$unwind": {"path": "$productos", "includeArrayIndex": "i"}}, {"$match": {"i": 0}}]
+        self.assertEqual(push_match_before_unwind(stages), stages)
+
+    def test_match_atraviesa_varios_unwind(self):
+        stages = [{"$unwind": "$productos"}, {"$unwind": "$productos.proveedores"},
+                  {"$match": {"cliente.nombre": "Ana"}}]
+        self.assertEqual(push_match_before_unwind(stages)[0], {"$match": {"cliente.nombre": "Ana"}})
+
+    def test_limit_tras_sort(self):
+        stages = [{"$sort": {"total": -1}}, {"$project": {"total": 1}}, {"$limit": 3}]
+        self.assertEqual(push_limit_after_sort(stages),
+                         [{"$sort": {"total": -1}}, {"$limit": 3}, {"$project": {"total": 1}}])
+
+    def test_project_temprano(self):
+        stages = [{"$match": {"fecha_compra": {"$gte": 1}}}, {"$unwind": "$productos"},
+                  {"$group": {"_id": "$productos.nombre", "total": {"$sum": "$productos.precio"}}}]
+        self.assertEqual(add_early_project(stages)[1], {"$project": {"fecha_compra": 1, "productos": 1, "_id": 0}})
+
+    def test_sin_project_con_root(self):
+        stages = [{"$unwind": "$productos"}, {"$group": {"_id": "$productos.nombre", "docs": {"$push": "$$ROOT"}}}]
+        self.assertEqual(add_early_project(stages), stages)
+
+    def test_no_modifica_el_original(self):
+        stages = [{"$unwind": "$proveedores"}, {"$match": {"nombre": "Camiseta"}}]
+        optimize_pipeline(stages)
+        self.assertEqual(stages, [{"$unwind": "$proveedores"}, {"$match": {"nombre": "Camiseta"}}])
+
+class TestPartitionedAggregate(unittest.TestCase):
+    PIPELINE = [{"$unwind": "$productos"},
+                {"$group": {"_id": "$productos.nombre", "total": {"$sum": "$productos.precio"},
+                            "media": {"$avg": "$productos.precio"}, "max": {"$max": "$productos.precio"}}},
+                {"$sort": {"total": -1}}, {"$limit": 1}]
+
+    def test_plan_descompone_avg(self):
+        plan = parallel_aggregate.plan(self.PIPELINE)
+        self.assertIn("media__sum", plan.group)
+        self.assertIn("media__count", plan.group)
+        self.assertEqual(plan.suffix, [{"$sort": {"total": -1}}, {"$limit": 1}])
+
+    def test_acumulador_no_descomponible(self):
+        pipeline = [{"$group": {"_id": "$cliente.nombre", "ultima": {"$last": "$fecha_compra"}}}]
+        self.assertIsNone(parallel_aggregate.plan(pipeline))
+
+    def test_operador_no_soportado_en_el_resto(self):
+        # El $sqrt tras el $group solo lo evalúa Mongo: run() devuelve None
+        collection = mongomock.MongoClient().db.compra
+        collection.insert_many([{"producto": "Gorra", "precio": float(i)} for i in range(10)])
+        pipeline = [{"$group": {"_id": "$producto", "total": {"$sum": "$precio"}}},
+                    {"$project": {"raiz": {"$sqrt": "$total"}}}]
+        self.assertIsNotNone(parallel_aggregate.plan(pipeline))
+        self.assertIsNone(parallel_aggregate.run(collection, pipeline, 2))
+
+    def test_merge(self):
+        plan = parallel_aggregate.plan(self.PIPELINE)
+        partials = [[{"_id": "Gorra", "total": 10, "media__sum": 10, "media__count": 2, "max": 6}],
+                    [{"_id": "Gorra", "total": 20, "media__sum": 20, "media__count": 1, "max": 20},
+                     {"_id": "Bolso", "total": 5, "media__sum": 5, "media__count": 1, "max": 5}]]
+        merged = {doc["_id"]: doc for doc in parallel_aggregate.merge(plan, partials)}
+        self.assertEqual(merged["Gorra"], {"_id": "Gorra", "total": 30, "media": 10, "max": 20})
+        self.assertEqual(merged["Bolso"]["media"], 5)
+
+if __name__ == "__main__":
+    unittest.main()
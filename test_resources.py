@@ -0,0 +1,18 @@
+import unittest
+import config
+import resources
+
+class TestRedis(unittest.TestCase):
+    def test_cache_y_cola_en_la_misma_base(self):
+        config.QUEUE_DB = config.CACHE_DB
+        self.addCleanup(delattr, config, "QUEUE_DB")
+        self.addCleanup(resources.close_all)
+        cache, queue = resources.get_redis_cache(), resources.get_redis_queue()
+        self.assertIsNot(cache, queue)
+        # BLPOP en la cola no hereda el socket_timeout corto de la caché
+        self.assertEqual(cache.connection_pool.connection_kwargs["socket_timeout"], config.CACHE_SOCKET_TIMEOUT)
+        self.assertIsNone(queue.connection_pool.connection_kwargs["socket_timeout"])
+        self.assertIs(resources.get_redis_queue(), queue)
+
+if __name__ == "__main__":
+    unittest.main()
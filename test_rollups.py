@@ -0,0 +1,74 @@
+import datetime
+import unittest
+import memory_backend
+import models
+import rollups
+import testutils
+
+def compra(cliente, fecha, productos):
+    return models.Compra(
+        cliente={"nombre": cliente, "fecha_alta": datetime.datetime(2023, 1, 1)},
+        fecha_compra=fecha, precio_compra=sum(p["precio"] for p in productos),
+        direccion_envio={"calle": "Mayor", "numero": 1, "ciudad": "Madrid", "codigo_postal": "28013", "pais": "España"},
+        productos=productos)
+
+def producto(nombre, precio, peso, proveedores):
+    return {"nombre": nombre, "codigo_producto_proveedor": nombre, "precio": precio, "peso": peso,
+            "dimensiones": {"ancho": 10, "alto": 20, "profundidad": 50},
+            "proveedores": [{"nombre": p} for p in proveedores]}
+
+class TestRollups(unittest.TestCase):
+    def setUp(self):
+        # El backend en memoria admite bulk_write con cualquier versión de pymongo
+        testutils.bind_model(self, models.Compra, memory_backend.MemoryDatabase("db").compra)
+        self.rollups = rollups.Rollups(models.Compra)
+        self.rollups.enable()
+
+    def tearDown(self):
+        self.rollups.disable()
+
+    def test_escrituras(self):
+        dia = datetime.datetime(2024, 4, 11, 10, 30)
+        a = compra("Beatriz Gómez", dia, [producto("Camiseta", 12.5, 0.3, ["Modas Paqui", "Textil Sur"])])
+        b = compra("Beatriz Gómez", dia + datetime.timedelta(hours=2), [producto("Gorra", 8.0, 0.2, ["Modas Paqui"])])
+        models.Compra.save_many([a, b])
+        self.assertEqual(self.rollups.peso_volumen_cliente("Beatriz Gómez", datetime.date(2024, 4, 11)),
+                         {"peso_total_kg": 0.5, "volumen_total_m3": 0.02, "compras": 2})
+        # Guardar de nuevo sin cambios no vuelve a sumar; editar ajusta la diferencia
+        a.save()
+        b.productos = [producto("Gorra", 10.0, 0.2, ["Modas Paqui"])]
+        b.save()
+        top = self.rollups.top_proveedores()
+        self.assertEqual([(p["_id"], p["total_facturacion"]) for p in top], [("Modas Paqui", 22.5), ("Textil Sur", 12.5)])
+        a.delete()
+        self.assertEqual(self.rollups.peso_volumen_cliente("Beatriz Gómez", dia)["compras"], 1)
+        self.assertEqual([p["_id"] for p in self.rollups.top_proveedores()], ["Modas Paqui"])
+        self.assertTrue(self.rollups.check()["ok"])
+
+    def test_backfill_y_comprobacion(self):
+        self.rollups.disable()
+        dia = datetime.datetime(2024, 5, 2, 9)
+        models.Compra.save_many([compra(f"Cliente {i % 3}", dia + datetime.timedelta(days=i % 2),
+                                        [producto(f"P{i}", 5.0 + i, 1.0, ["Modas Paqui"])]) for i in range(12)])
+        report = self.rollups.check()
+        self.assertFalse(report["ok"])
+        self.assertEqual(report[rollups.PROVEEDOR_MES]["mismatches"], 1)
+        self.assertEqual(self.rollups.backfill(batch_size=5)["compras"], 12)
+        self.assertTrue(self.rollups.check()["ok"])
+        # Un segundo backfill no cambia nada
+        self.assertEqual(self.rollups.backfill()["counters"], 0)
+
+    def test_version_anterior_no_pisa_el_registro(self):
+        # Un backfill que leyó la compra antes de un save llega tarde
+        dia = datetime.datetime(2024, 6, 3, 12)
+        a = compra("Beatriz Gómez", dia, [producto("Gorra", 8.0, 0.2, ["Modas Paqui"])])
+        a.save()
+        leida = a.to_dict()
+        a.productos = [producto("Gorra", 10.0, 0.2, ["Modas Paqui"])]
+        a.save()
+        self.assertEqual(self.rollups.apply([leida]), 0)
+        self.assertEqual([p["total_facturacion"] for p in self.rollups.top_proveedores()], [10.0])
+        self.assertTrue(self.rollups.check()["ok"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+from bson import ObjectId
+import models
+import schema
+
+class TestSchema(unittest.TestCase):
+    def test_models_yml_equivale_a_models_py(self):
+        # El esquema declarativo describe los mismos modelos que models.py
+        classes = schema.build_models(schema.load_schema("models.yml", use_cache=False))
+        for name in ("Direccion", "Cliente", "Proveedor", "Producto", "Compra"):
+            declared, built = getattr(models, name), classes[name]
+            self.assertEqual(built.required_vars, declared.required_vars)
+            self.assertEqual(built.admissible_vars, declared.admissible_vars)
+            self.assertEqual(set(built._embedded_fields), set(declared._embedded_fields))
+            self.assertEqual(set(built._embedded_list_fields), set(declared._embedded_list_fields))
+            self.assertEqual(set(built._date_fields), set(declared._date_fields))
+            self.assertEqual([i.keys for i in built._indexes],
+                             [models.Index.from_spec(i).keys for i in declared._indexes])
+        self.assertIs(classes["Compra"]._model_classes["cliente"], classes["Cliente"])
+        self.assertTrue(issubclass(classes["Direccion"], models.Direccion))
+
+    def test_cache_por_hash(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "models.yml")
+            with open(path, "w") as f:
+                f.write("A:\n  required_vars: [x]\n")
+            self.assertEqual(schema.load_schema(path)["A"]["attributes"]["required_vars"], {"x"})
+            self.assertTrue(os.path.exists(schema._cache_path(path)))
+            with open(path, "w") as f:
+                f.write("A:\n  required_vars: [y]\n")
+            # El YAML ha cambiado: el pickle anterior no se reutiliza
+            self.assertEqual(schema.load_schema(path)["A"]["attributes"]["required_vars"], {"y"})
+
+    def test_validacion(self):
+        with self.assertRaises(schema.SchemaError):
+            schema.compile_schema({"A": {"required_vars": ["x"], "dates": ["y"]}})
+        with self.assertRaises(schema.SchemaError):
+            schema.compile_schema({"A": {"required_vars": ["x"], "embedded": {"x": "B"}}})
+        with self.assertRaises(schema.SchemaError):
+            schema.compile_schema({"A": {"required_vars": ["x"], "indexes": [{"keys": [["x", 2]]}]}})
+        for embedded in [{"x": ["B"]}, {"x": 3}, {"x": {"model": ["B"]}}, ["x"]]:
+            with self.subTest(embedded=embedded), self.assertRaises(schema.SchemaError):
+                schema.compile_schema({"A": {"required_vars": ["x"], "embedded": embedded}, "B": {}})
+        with self.assertRaises(schema.SchemaError):
+            schema.compile_schema({"A": {"required_vars": ["x"], "references": {"x": ["B"]}}, "B": {}})
+
+    def test_referencias(self):
+        classes = schema.build_models(schema.compile_schema({
+            "Autor": {"required_vars": ["nombre"]},
+            "Libro": {"required_vars": ["titulo", "autor"], "references": {"autor": "Autor"}},
+        }))
+        autor = classes["Autor"](_id=ObjectId(), nombre="Ana")
+        libro = classes["Libro"](titulo="T", autor=autor)
+        self.assertEqual(libro.autor, autor._id)
+        self.assertEqual(classes["Libro"](titulo="T", autor=str(autor._id)).autor, autor._id)
+
+    def test_registro_por_modulo(self):
+        # Clases homónimas de otro módulo (como las de ODM.initApp) no
+        # sustituyen a las de models.py al resolver referencias
+        schema.build_models(schema.compile_schema({"Cliente": {"required_vars": ["nombre"]}}), module="otro")
+        self.addCleanup(models.Model._registry.pop, ("otro", "Cliente"))
+        self.assertIs(models.Model._registry["models", "Cliente"], models.Cliente)
+        classes = schema.build_models(schema.compile_schema({
+            "Autor": {"required_vars": ["nombre"]},
+            "Libro": {"required_vars": ["titulo", "autor"], "references": {"autor": "Autor"}},
+        }), module="biblioteca")
+        self.assertIs(classes["Libro"]._resolve_model("Autor"), classes["Autor"])
+        self.assertIs(classes["Libro"]._resolve_model("Cliente"), models.Cliente)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+import mongomock
+import models
+import testutils
+
+class _Cursor(list):
+    def sort(self, keys):
+        self.sorted_by = keys
+        return self
+
+    def limit(self, n):
+        return _Cursor(self[:n])
+
+class _Collection:
+    # mongomock no implementa $text: se comprueba la consulta que se envía
+    name = "producto"
+
+    def __init__(self, docs):
+        self.docs, self.queries = docs, []
+
+    def find(self, query, projection=None):
+        self.queries.append(query)
+        return _Cursor(self.docs)
+
+PRODUCTO = {"nombre": "Camiseta manga corta", "codigo_producto_proveedor": "MC-1", "precio": 9.9,
+            "dimensiones": {"ancho": 30, "alto": 40, "profundidad": 2}, "peso": 0.2,
+            "proveedores": [{"nombre": "Modas Paqui"}]}
+
+class TestTextSearch(unittest.TestCase):
+    def test_indice_de_texto(self):
+        index = models.Index([("nombre", "text")], default_language="spanish")
+        # index_information() de Mongo agrupa los campos de texto en _fts/_ftsx
+        self.assertTrue(index.matches({"key": [("_fts", "text"), ("_ftsx", 1)],
+                                       "weights": {"nombre": 1}, "default_language": "spanish"}))
+        self.assertFalse(index.matches({"key": [("_fts", "text"), ("_ftsx", 1)],
+                                        "weights": {"nombre": 1}, "default_language": "english"}))
+        collection = mongomock.MongoClient().db.producto
+        testutils.bind_model(self, models.Producto, collection, indexes_ready=False)
+        models.Producto._ensure_indexes()
+        self.assertIn("nombre_text", collection.index_information())
+
+    def test_busqueda(self):
+        collection = _Collection([PRODUCTO])
+        testutils.bind_model(self, models.Producto, collection)
+        productos = list(models.Producto.search(' manga  "corta" ', filters={"proveedores.nombre": "Modas Paqui"}))
+        self.assertEqual(collection.queries, [{"$text": {"$search": '"manga corta"'},
+                                               "proveedores.nombre": "Modas Paqui"}])
+        self.assertEqual(productos[0].nombre, "Camiseta manga corta")
+        models.Producto.search("manga corta", phrase=False, limit=1)
+        self.assertEqual(collection.queries[-1], {"$text": {"$search": "manga corta"}})
+        with self.assertRaises(ValueError):
+            models.Cliente.search("Ana")
+
+if __name__ == "__main__":
+    unittest.main()
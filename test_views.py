@@ -0,0 +1,75 @@
+import datetime
+import unittest
+import memory_backend
+import models
+import testutils
+import views
+
+def compra(cliente, fecha, productos):
+    return models.Compra(
+        cliente={"nombre": cliente, "fecha_alta": datetime.datetime(2023, 1, 1)},
+        fecha_compra=fecha, precio_compra=sum(p["precio"] for p in productos),
+        direccion_envio={"calle": "Mayor", "numero": 1, "ciudad": "Madrid", "codigo_postal": "28013", "pais": "España"},
+        productos=productos)
+
+def producto(nombre, precio, proveedores):
+    return {"nombre": nombre, "codigo_producto_proveedor": nombre, "precio": precio, "peso": 1.0,
+            "dimensiones": {"ancho": 10, "alto": 20, "profundidad": 50},
+            "proveedores": [{"nombre": p} for p in proveedores]}
+
+class TestMaterializedViews(unittest.TestCase):
+    def setUp(self):
+        testutils.bind_model(self, models.Compra, memory_backend.MemoryDatabase("odm").compra, indexes_ready=False)
+        self.facturacion, self.productos = views.FACTURACION_PROVEEDOR_MES, views.PRODUCTOS_CLIENTE
+        self.ana = compra("Ana", datetime.datetime(2024, 3, 10), [producto("Camisa", 20.0, ["Modas Paqui", "Telas Juan"])])
+        self.luis = compra("Luis", datetime.datetime(2024, 3, 20), [producto("Falda", 15.0, ["Modas Paqui"])])
+        self.ana.save()
+        self.luis.save()
+        for view in (self.facturacion, self.productos):
+            view.refresh(full=True)
+
+    def facturas(self):
+        return {(d["_id"]["proveedor"], d["_id"]["mes"]): d["facturacion"] for d in self.facturacion.read()}
+
+    def test_cambio_de_mes_y_de_proveedores(self):
+        self.assertEqual(self.facturas(), {("Modas Paqui", 3): 35.0, ("Telas Juan", 3): 20.0})
+        self.ana.fecha_compra = datetime.datetime(2024, 4, 2)
+        self.ana.productos = [producto("Camisa", 20.0, ["Modas Paqui"])]
+        self.ana.save()
+        self.facturacion.refresh()
+        # El grupo de marzo de Telas Juan se queda sin compras y desaparece
+        self.assertEqual(self.facturas(), {("Modas Paqui", 3): 15.0, ("Modas Paqui", 4): 20.0})
+
+    def test_cambio_de_cliente(self):
+        self.ana.cliente = models.Cliente(nombre="Eva", fecha_alta=datetime.datetime(2023, 1, 1))
+        self.ana.save()
+        self.productos.apply_documents([self.ana.to_dict()])
+        self.assertEqual({d["_id"]: d["productos"] for d in self.productos.read()},
+                         {"Eva": ["Camisa"], "Luis": ["Falda"]})
+
+    def test_borrado(self):
+        self.ana.delete()
+        # Sin recarga: el borrado recalcula los grupos registrados de la compra
+        self.assertEqual(self.facturas(), {("Modas Paqui", 3): 15.0})
+        self.assertEqual([d["_id"] for d in self.productos.read()], ["Luis"])
+        self.assertIsNone(self.productos._scopes().find_one({"_id": self.productos._scope_id(self.ana._id)}))
+        self.assertEqual(self.facturacion.refresh()["mode"], "incremental")
+
+    def test_recarga_completa_sin_huecos(self):
+        self.productos.collection.insert_one({"_id": "Nadie", "productos": []})
+        self.productos.refresh(full=True)
+        self.assertEqual(sorted(d["_id"] for d in self.productos.read()), ["Ana", "Luis"])
+        self.assertNotIn(views.RUN_FIELD, self.productos.read()[0])
+
+    def test_marca_de_agua_con_reloj_retrasado(self):
+        # Otro proceso con el reloj un minuto por detrás escribe tras la recarga
+        models.Compra.db.update_one({"_id": self.luis._id}, {"$set": {
+            "fecha_compra": datetime.datetime(2024, 5, 1),
+            "fecha_modificacion": self.productos._state().find_one(self.facturacion.name)["watermark"]
+            - datetime.timedelta(minutes=1)}})
+        self.facturacion.refresh()
+        self.assertEqual(self.facturas(), {("Modas Paqui", 3): 20.0, ("Telas Juan", 3): 20.0,
+                                           ("Modas Paqui", 5): 15.0})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import numpy as np
+import memory_backend
+import models
+import testutils
+import warehouses
+
+class TestBallTree(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        self.lon, self.lat = rng.uniform(-9, 3, 500), rng.uniform(36, 43, 500)
+        self.groups = rng.integers(0, 20, 500)
+        self.tree = warehouses.BallTree(warehouses.to_unit_vectors(self.lon, self.lat), self.groups, leaf_size=16)
+        self.q_lon, self.q_lat = rng.uniform(-9, 3, 300), rng.uniform(36, 43, 300)
+        self.queries = warehouses.to_unit_vectors(self.q_lon, self.q_lat)
+
+    def test_vecino_mas_cercano(self):
+        chord, index = self.tree.query(self.queries, chunk_size=64)
+        distances = warehouses.haversine_km(self.q_lon[:, None], self.q_lat[:, None], self.lon, self.lat)
+        np.testing.assert_array_equal(index, distances.argmin(axis=1))
+        np.testing.assert_allclose(warehouses.chord_to_km(chord), distances.min(axis=1), atol=1e-6)
+
+    def test_grupos_admitidos(self):
+        allowed = np.zeros((len(self.queries), 20), dtype=bool)
+        allowed[:, 3] = True
+        allowed[0] = False
+        chord, index = self.tree.query(self.queries, allowed)
+        self.assertEqual(index[0], -1)
+        self.assertTrue(np.isinf(chord[0]))
+        candidates = np.nonzero(self.groups == 3)[0]
+        distances = warehouses.haversine_km(self.q_lon[1:, None], self.q_lat[1:, None],
+                                            self.lon[candidates], self.lat[candidates])
+        np.testing.assert_array_equal(index[1:], candidates[distances.argmin(axis=1)])
+
+class TestWarehouseIndex(unittest.TestCase):
+    def setUp(self):
+        testutils.bind_model(self, models.Proveedor, memory_backend.MemoryDatabase("odm").proveedor,
+                             indexes_ready=False)
+        self.index = warehouses.WarehouseIndex(models.Proveedor)
+
+    def tearDown(self):
+        self.index.close()
+
+    def test_proveedores_sin_almacenes(self):
+        # El último proveedor no tiene almacenes: allowed sigue teniendo su columna
+        models.Proveedor.db.insert_many([
+            {"nombre": "Modas Paqui", "direcciones_almacenes": [
+                {"calle": "Sol", "location": {"type": "Point", "coordinates": [-3.7038, 40.4168]}}]},
+            {"nombre": "Telas Juan", "direcciones_almacenes": []},
+        ])
+        compra = lambda *nombres: {"_id": len(nombres), "productos": [
+            {"proveedores": [{"_id": "copia", "nombre": n} for n in nombres]}],
+            "direccion_envio": {"location": {"type": "Point", "coordinates": [-3.70, 40.42]}}}
+        sol, ninguno = self.index.assign([compra("Modas Paqui", "Telas Juan"), compra("Telas Juan")])
+        self.assertEqual((sol["proveedor_nombre"], sol["almacen"]["calle"]), ("Modas Paqui", "Sol"))
+        self.assertLess(sol["distancia_km"], 1)
+        self.assertIsNone(ninguno)
+
+class TestHooks(unittest.TestCase):
+    def test_notificacion_a_subclases(self):
+        received = []
+        callback = lambda model_class, instances: received.append((model_class, len(instances)))
+        models.Proveedor.subscribe('post_save', callback)
+        try:
+            models.Proveedor._notify('post_save', [models.Proveedor(nombre="Modas Paqui")])
+            models.Cliente._notify('post_save', [])
+        finally:
+            models.Proveedor.unsubscribe('post_save', callback)
+        self.assertEqual(received, [(models.Proveedor, 1)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import fakeredis
+import mongomock
+import numpy as np
+import models
+import testutils
+import zones
+
+def square(x0, y0, x1, y1):
+    return [[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]
+
+class TestZones(unittest.TestCase):
+    def test_hueco(self):
+        rings = [np.array(square(0, 0, 10, 10), dtype=float), np.array(square(4, 4, 6, 6), dtype=float)]
+        inside = zones.points_in_polygon(np.array([1.0, 5.0, 11.0]), np.array([1.0, 5.0, 5.0]), rings)
+        self.assertEqual(inside.tolist(), [True, False, False])
+
+    def test_clasificacion_igual_a_fuerza_bruta(self):
+        rng = np.random.default_rng(3)
+        polygons = []
+        for i in range(60):
+            cx, cy, r = rng.uniform(-4, -3), rng.uniform(40, 41), rng.uniform(0.02, 0.1)
+            angles = np.sort(rng.uniform(0, 2 * np.pi, rng.integers(4, 12)))
+            polygons.append((f"Z{i}", {"type": "Polygon",
+                                       "coordinates": [np.column_stack([cx + r * np.cos(angles),
+                                                                        cy + r * np.sin(angles)]).tolist()]}))
+        index = zones.ZoneIndex(polygons, cell_size=0.05)
+        lon, lat = rng.uniform(-4.1, -2.9, 5000), rng.uniform(39.9, 41.1, 5000)
+        expected = np.full(5000, -1)
+        for i, (_, geometry) in enumerate(polygons):
+            inside = zones.points_in_polygon(lon, lat, [np.array(geometry["coordinates"][0])])
+            # La primera zona gana en los solapes
+            expected[(expected < 0) & inside] = i
+        np.testing.assert_array_equal(index.classify(lon, lat), expected)
+
+    def test_multipoligono_y_nan(self):
+        index = zones.ZoneIndex([("norte", {"type": "MultiPolygon",
+                                            "coordinates": [[square(0, 0, 1, 1)], [square(5, 5, 6, 6)]]})])
+        self.assertEqual(index.classify(np.array([0.5, 5.5, np.nan]), np.array([0.5, 5.5, 0.5])).tolist(), [0, 0, -1])
+        self.assertIsNone(index.zone_of(3, 3))
+
+    def test_cache_caida_no_aborta_la_clasificacion(self):
+        server = fakeredis.FakeServer()
+        testutils.bind_model(self, models.Compra, mongomock.MongoClient().db.compra, fakeredis.FakeRedis(server=server))
+        breaker = models.Compra._cache_breaker
+        models.Compra.db.insert_many([{"_id": i, "direccion_envio": {"location": {"coordinates": [0.5, 0.5]}}}
+                                      for i in range(3)])
+        server.connected = False
+        report = zones.classify_compras([("norte", {"type": "Polygon", "coordinates": [square(0, 0, 1, 1)]})],
+                                        compra_model=models.Compra, batch_size=2)
+        self.assertEqual(report["updated"], 3)
+        self.assertEqual(models.Compra.db.count_documents({"zona_envio": "norte"}), 3)
+        # Las copias cacheadas se borran cuando Redis se recupere
+        self.assertEqual(breaker._deferred, {models.Compra._cache_key(str(i)) for i in range(3)})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+
+# Utilidades compartidas por los tests (no es un módulo de tests)
+
+_BOUND = ("db", "r_cache", "_cache_breaker", "_indexes_ready")
+
+
+def bind_model(test: unittest.TestCase, model, collection, r_cache=None, indexes_ready: bool = True):
+    """
+    Liga model a collection (y r_cache) durante el test. Al terminar se
+    cierra el cortocircuito creado y se restauran la colección, la caché,
+    el cortocircuito y el estado de los índices que tenía la clase.
+    Con indexes_ready=False los índices se sincronizan en la primera
+    consulta o escritura, como en la aplicación.
+    """
+    saved = {name: model.__dict__[name] for name in _BOUND if name in model.__dict__}
+
+    def restore():
+        breaker = model.__dict__.get("_cache_breaker")
+        if breaker is not None and breaker is not saved.get("_cache_breaker"):
+            breaker.close()
+        for name in _BOUND:
+            if name in saved:
+                setattr(model, name, saved[name])
+            elif name in model.__dict__:
+                delattr(model, name)
+
+    test.addCleanup(restore)
+    model.init_class(collection, r_cache)
+    model._indexes_ready = indexes_ready
+    return model
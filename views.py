@@ -0,0 +1,359 @@
+import argparse
+import datetime
+import logging
+import time
+from typing import Any, Type
+
+from bson import ObjectId
+
+from models import Model, Compra, init_app
+
+# Vistas materializadas sobre la capa Model. Cada vista es un pipeline con
+# nombre cuyo resultado se guarda con $merge en una colección destino. La
+# recarga incremental solo reprocesa el "ámbito" (meses, clientes...) de las
+# compras escritas desde la última marca de agua, o de los documentos que
+# llegan por change streams, y sustituye esos grupos en el destino. El
+# ámbito anterior de cada documento se guarda en un registro: si una compra
+# cambia de mes o de cliente también se recalcula el grupo que deja.
+logger = logging.getLogger(__name__)
+
+STATE_COLLECTION = "_mv_state"
+# Ámbito aplicado de cada documento origen: {view, doc} -> claves
+SCOPE_COLLECTION = "_mv_scope"
+# Recarga que escribió cada documento del destino; los del ámbito que no
+# lleva la última recarga ya no tienen origen y se borran
+RUN_FIELD = "_mv_run"
+
+VIEWS: dict[str, 'MaterializedView'] = {}
+
+
+class Scope:
+    """
+    Ámbito de una vista. keys() da las claves de un documento origen;
+    source() y target() las traducen a filtros sobre el origen y sobre el
+    destino. Llamar al ámbito con una lista de documentos devuelve el
+    filtro del origen.
+    """
+    fields: list[str] = []
+
+    def keys(self, doc: dict) -> list:
+        raise NotImplementedError
+
+    def source(self, keys: set) -> dict | None:
+        raise NotImplementedError
+
+    def target(self, keys: set) -> dict | None:
+        raise NotImplementedError
+
+    def __call__(self, docs: list[dict]) -> dict | None:
+        return self.source({key for doc in docs for key in self.keys(doc)})
+
+
+class MonthScope(Scope):
+    # Ámbito por mes natural de `field`: se recalculan los meses completos.
+    # En el destino, el mes está en year/month (_id.anio, _id.mes)
+    def __init__(self, field: str, year: str = '_id.anio', month: str = '_id.mes'):
+        self.field, self.year, self.month = field, year, month
+        self.fields = [field]
+
+    def keys(self, doc: dict) -> list:
+        value = _path(doc, self.field)
+        return [(value.year, value.month)] if isinstance(value, datetime.datetime) else []
+
+    def source(self, keys: set) -> dict | None:
+        ranges = []
+        for year, month in sorted(keys):
+            start = datetime.datetime(year, month, 1)
+            end = datetime.datetime(year + month // 12, month % 12 + 1, 1)
+            ranges.append({self.field: {'$gte': start, '$lt': end}})
+        return {'$or': ranges} if ranges else None
+
+    def target(self, keys: set) -> dict | None:
+        return {'$or': [{self.year: year, self.month: month} for year, month in sorted(keys)]} if keys else None
+
+
+class FieldScope(Scope):
+    # Ámbito por valor de `field` (p.ej. cliente.nombre), que en el destino
+    # está en `target_field`
+    def __init__(self, field: str, target_field: str = '_id'):
+        self.field, self.target_field = field, target_field
+        self.fields = [field]
+
+    def keys(self, doc: dict) -> list:
+        return _flatten(_path(doc, self.field))
+
+    def source(self, keys: set) -> dict | None:
+        return {self.field: {'$in': sorted(keys)}} if keys else None
+
+    def target(self, keys: set) -> dict | None:
+        return {self.target_field: {'$in': sorted(keys)}} if keys else None
+
+
+def month_scope(field: str) -> MonthScope:
+    return MonthScope(field)
+
+
+def field_scope(field: str) -> FieldScope:
+    return FieldScope(field)
+
+
+def _flatten(value: Any) -> list:
+    if isinstance(value, list):
+        return [item for element in value for item in _flatten(element)]
+    return [] if value is None else [value]
+
+
+def _key(value: Any) -> Any:
+    # Las claves vuelven del registro como listas
+    return tuple(value) if isinstance(value, list) else value
+
+
+def _path(doc: Any, path: str) -> Any:
+    for part in path.split('.'):
+        if isinstance(doc, list):
+            return [_path(item, part) for item in doc]
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+class MaterializedView:
+    def __init__(self, name: str, source: Type[Model], pipeline: list[dict],
+                 scope: Scope, target: str = None, watermark_field: str = None,
+                 watermark_lag: datetime.timedelta = datetime.timedelta(minutes=5)):
+        self.name = name
+        self.source = source
+        self.pipeline = pipeline
+        self.scope = scope
+        self.target = target or f"mv_{name}"
+        self.watermark_field = watermark_field or source._timestamp_field
+        # La marca de agua la pone el reloj de cada proceso que escribe: la
+        # recarga incremental relee este margen antes de la última marca
+        self.watermark_lag = watermark_lag
+        # Los borrados no dejan marca de agua: se aplican al producirse
+        source.subscribe('post_delete', self._on_delete)
+        VIEWS[name] = self
+
+    @property
+    def collection(self):
+        return self.source.db.database[self.target]
+
+    def _state(self):
+        return self.source.db.database[STATE_COLLECTION]
+
+    def _scopes(self):
+        return self.source.db.database[SCOPE_COLLECTION]
+
+    def _scope_id(self, doc_id: Any) -> dict:
+        return {'view': self.name, 'doc': doc_id}
+
+    def _merge_stage(self) -> dict:
+        # Los documentos del destino se identifican por el _id del $group final
+        return {'$merge': {'into': self.target, 'on': '_id',
+                           'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+
+    def _run(self, match: dict | None, target: dict | None) -> None:
+        # Recalcula los grupos de `match` y borra después los de `target`
+        # que esta recarga no ha escrito: el destino nunca queda vacío. Los
+        # _id crecientes de las recargas evitan que una anterior borre lo
+        # que ha escrito una posterior
+        run = ObjectId()
+        pipeline = ([{'$match': match}] if match else []) + self.pipeline + [
+            {'$addFields': {RUN_FIELD: run}}, self._merge_stage()]
+        # $merge no devuelve documentos; se consume el cursor para ejecutarlo
+        list(self.source.db.aggregate(pipeline))
+        stale = {RUN_FIELD: {'$not': {'$gte': run}}}
+        self.collection.delete_many({'$and': [target, stale]} if target else stale)
+
+    def refresh_full(self) -> dict:
+        start = time.perf_counter()
+        started_at = self._now_watermark()
+        self._run(None, None)
+        self._rebuild_scopes()
+        self._save_state(started_at, dirty=False)
+        return {'view': self.name, 'mode': 'full', 'seconds': time.perf_counter() - start}
+
+    def _rebuild_scopes(self, batch_size: int = 5000) -> None:
+        scopes = self._scopes()
+        scopes.delete_many({'_id.view': self.name})
+        batch = []
+        for doc in self.source.db.find({}, {field: 1 for field in self.scope.fields}):
+            batch.append({'_id': self._scope_id(doc['_id']), 'keys': self.scope.keys(doc)})
+            if len(batch) >= batch_size:
+                scopes.insert_many(batch)
+                batch = []
+        if batch:
+            scopes.insert_many(batch)
+
+    def refresh(self, full: bool = False) -> dict:
+        state = self._state().find_one({'_id': self.name})
+        if full or state is None or state.get('dirty') or not self.watermark_field:
+            return self.refresh_full()
+
+        start = time.perf_counter()
+        watermark = state['watermark']
+        # Reprocesar documentos ya aplicados es inocuo (replace): con $gte y
+        # watermark_lag no se pierden escrituras con la misma marca de tiempo
+        # ni las de procesos con el reloj algo retrasado
+        projection = {field: 1 for field in self.scope.fields}
+        projection[self.watermark_field] = 1
+        changed = list(self.source.db.find({self.watermark_field: {'$gte': watermark - self.watermark_lag}},
+                                           projection))
+        processed = self.apply_documents(changed)
+        stamps = [doc[self.watermark_field] for doc in changed if doc.get(self.watermark_field)]
+        if stamps and max(stamps) > watermark:
+            self._save_state(max(stamps), dirty=False)
+        return {'view': self.name, 'mode': 'incremental', 'documents': processed,
+                'seconds': time.perf_counter() - start}
+
+    def apply_documents(self, docs: list[dict]) -> int:
+        # Recalcula los grupos afectados por `docs` (documentos completos o
+        # con los campos de ámbito y _id), tanto los actuales como los que
+        # tenían en la recarga anterior. Punto de entrada de los change streams.
+        if not docs:
+            return 0
+        from pymongo import ReplaceOne
+
+        current = {doc['_id']: self.scope.keys(doc) for doc in docs if '_id' in doc}
+        keys = {key for doc in docs for key in self.scope.keys(doc)}
+        if current:
+            for entry in self._scopes().find({'_id': {'$in': [self._scope_id(i) for i in current]}}):
+                keys.update(map(_key, entry['keys']))
+        if keys:
+            self._run(self.scope.source(keys), self.scope.target(keys))
+        # Después de recalcular: si el proceso cae antes, el ámbito anterior
+        # sigue registrado y se recalcula en la próxima escritura
+        if current:
+            self._scopes().bulk_write([ReplaceOne({'_id': self._scope_id(i)}, {'_id': self._scope_id(i), 'keys': k},
+                                                  upsert=True) for i, k in current.items()], ordered=False)
+        return len(docs)
+
+    def remove_documents(self, ids: list) -> int:
+        # Borrados: el documento ya no existe, pero su ámbito sigue en el
+        # registro. Se recalculan esos grupos y se olvida la entrada
+        if not ids:
+            return 0
+        scope_ids = [self._scope_id(i) for i in ids]
+        keys = {_key(key) for entry in self._scopes().find({'_id': {'$in': scope_ids}}) for key in entry['keys']}
+        if keys:
+            self._run(self.scope.source(keys), self.scope.target(keys))
+        self._scopes().delete_many({'_id': {'$in': scope_ids}})
+        return len(ids)
+
+    def _on_delete(self, model_class: Type[Model], instances: list[Model]) -> None:
+        try:
+            self.remove_documents([instance._id for instance in instances])
+        except Exception as e:
+            # La compra ya está borrada: la siguiente recarga será completa
+            logger.warning(f"No se pudo aplicar el borrado de {len(instances)} documentos a {self.name}: {e}")
+            self.invalidate()
+
+    def invalidate(self) -> None:
+        # Sin registro del que derivar el ámbito (p.ej. se perdió el
+        # historial del change stream): la siguiente recarga será completa
+        self._state().update_one({'_id': self.name}, {'$set': {'dirty': True}}, upsert=True)
+
+    def _now_watermark(self):
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    def _save_state(self, watermark, dirty: bool) -> None:
+        self._state().update_one({'_id': self.name},
+                                 {'$set': {'watermark': watermark, 'dirty': dirty}}, upsert=True)
+
+    def read(self, filter: dict = None, sort: list = None, limit: int = 0) -> list[dict]:
+        cursor = self.collection.find(filter or {}, {RUN_FIELD: 0})
+        if sort:
+            cursor = cursor.sort(sort)
+        return list(cursor.limit(limit))
+
+    def aggregate(self, pipeline: list[dict]) -> list[dict]:
+        return list(self.collection.aggregate(pipeline))
+
+
+# ---------------------------------------------------------
+# Vistas de los informes de consultas.ipynb / playground.mongodb
+
+# Envíos por almacén y mes (base de la consulta 6)
+ENVIOS_MES_ALMACEN = MaterializedView(
+    "envios_mes_almacen", Compra,
+    pipeline=[
+        {"$unwind": "$productos"},
+        {"$unwind": "$productos.proveedores"},
+        {"$unwind": "$productos.proveedores.direcciones_almacenes"},
+        {"$group": {
+            "_id": {
+                "almacen": {
+                    "calle": "$productos.proveedores.direcciones_almacenes.calle",
+                    "ciudad": "$productos.proveedores.direcciones_almacenes.ciudad",
+                },
+                "anio": {"$year": "$fecha_compra"},
+                "mes": {"$month": "$fecha_compra"},
+            },
+            "envios": {"$sum": 1},
+        }},
+    ],
+    scope=month_scope("fecha_compra"),
+)
+
+# Facturación por proveedor y mes (base de la consulta 7)
+FACTURACION_PROVEEDOR_MES = MaterializedView(
+    "facturacion_proveedor_mes", Compra,
+    pipeline=[
+        {"$unwind": "$productos"},
+        {"$unwind": "$productos.proveedores"},
+        {"$group": {
+            "_id": {
+                "proveedor": "$productos.proveedores.nombre",
+                "anio": {"$year": "$fecha_compra"},
+                "mes": {"$month": "$fecha_compra"},
+            },
+            "facturacion": {"$sum": "$productos.precio"},
+        }},
+    ],
+    scope=month_scope("fecha_compra"),
+)
+
+# Productos distintos comprados por cliente (consulta 3)
+PRODUCTOS_CLIENTE = MaterializedView(
+    "productos_cliente", Compra,
+    pipeline=[
+        {"$unwind": "$productos"},
+        {"$group": {"_id": "$cliente.nombre", "productos": {"$addToSet": "$productos.nombre"}}},
+    ],
+    scope=field_scope("cliente.nombre"),
+)
+
+
+def media_envios_mensuales() -> list[dict]:
+    return ENVIOS_MES_ALMACEN.aggregate([
+        {"$group": {"_id": {"almacen": "$_id.almacen", "mes": "$_id.mes"},
+                    "media_envios": {"$avg": "$envios"}}},
+        {"$group": {"_id": "$_id.almacen",
+                    "envios_por_mes": {"$push": {"mes": "$_id.mes", "media_envios": "$media_envios"}}}},
+    ])
+
+
+def top_proveedores(n: int = 3) -> list[dict]:
+    return FACTURACION_PROVEEDOR_MES.aggregate([
+        {"$group": {"_id": "$_id.proveedor", "total_facturacion": {"$sum": "$facturacion"}}},
+        {"$sort": {"total_facturacion": -1}},
+        {"$limit": n},
+    ])
+
+
+def productos_por_cliente(nombre: str = None) -> list[dict]:
+    return PRODUCTOS_CLIENTE.read({"_id": nombre} if nombre else None)
+
+
+def refresh_all(full: bool = False) -> list[dict]:
+    return [view.refresh(full=full) for view in VIEWS.values()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recarga las vistas materializadas")
+    parser.add_argument("--full", action="store_true", help="recalcular desde cero")
+    args = parser.parse_args()
+    init_app()
+    for stats in refresh_all(full=args.full):
+        print(stats)
@@ -0,0 +1,288 @@
+import threading
+import time
+from typing import Any, Iterable, Iterator
+
+import numpy as np
+
+# Asignación en bloque de compras al almacén más cercano de un proveedor
+# que sirve sus productos. Los almacenes se cargan en un índice espacial en
+# memoria (árbol de bolas sobre vectores unitarios: la distancia de cuerda
+# en la esfera crece con la de haversine, así que el vecino más cercano es
+# el mismo) y miles de compras se resuelven en una llamada con NumPy, en
+# lugar de un $geoNear por compra. El índice se recarga cuando se guarda o
+# borra un Proveedor a través del ODM.
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def to_unit_vectors(lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    lon, lat = np.radians(lon), np.radians(lat)
+    cos_lat = np.cos(lat)
+    return np.column_stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)])
+
+
+def chord_to_km(chord: np.ndarray) -> np.ndarray:
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0.0, 1.0))
+
+
+def haversine_km(lon1, lat1, lon2, lat2) -> np.ndarray:
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+class BallTree:
+    """
+    Árbol de bolas estático sobre puntos en la esfera unidad. Las hojas
+    se obtienen partiendo por la mediana del eje más ancho; cada hoja
+    guarda su centro y su radio para acotar inferiormente la distancia a
+    cualquiera de sus puntos. groups asigna a cada punto un grupo (p.ej.
+    el proveedor) para restringir la búsqueda por consulta; group_count
+    debe coincidir con las columnas de allowed en query (por defecto, el
+    mayor grupo más uno).
+    """
+
+    def __init__(self, points: np.ndarray, groups: np.ndarray = None, leaf_size: int = 32,
+                 group_count: int = None):
+        self.points = np.asarray(points, dtype=float)
+        self.groups = np.zeros(len(self.points), dtype=int) if groups is None else np.asarray(groups)
+        leaves = []
+        self._split(np.arange(len(self.points)), leaf_size, leaves)
+        # Hojas con relleno -1 hasta leaf_size para consultar en bloque
+        self.leaf_index = np.full((len(leaves), leaf_size), -1, dtype=int)
+        self.centers = np.zeros((len(leaves), 3))
+        self.radii = np.zeros(len(leaves))
+        if group_count is None:
+            group_count = int(self.groups.max()) + 1 if len(self.groups) else 0
+        self.leaf_groups = np.zeros((len(leaves), group_count), dtype=bool)
+        for i, leaf in enumerate(leaves):
+            self.leaf_index[i, :len(leaf)] = leaf
+            center = self.points[leaf].mean(axis=0)
+            self.centers[i] = center
+            self.radii[i] = np.linalg.norm(self.points[leaf] - center, axis=1).max()
+            self.leaf_groups[i, self.groups[leaf]] = True
+
+    def _split(self, indices: np.ndarray, leaf_size: int, leaves: list) -> None:
+        if len(indices) <= leaf_size:
+            if len(indices):
+                leaves.append(indices)
+            return
+        points = self.points[indices]
+        axis = np.argmax(points.max(axis=0) - points.min(axis=0))
+        order = indices[np.argsort(points[:, axis], kind='stable')]
+        middle = len(order) // 2
+        self._split(order[:middle], leaf_size, leaves)
+        self._split(order[middle:], leaf_size, leaves)
+
+    def query(self, queries: np.ndarray, allowed: np.ndarray = None,
+              chunk_size: int = 4096) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Vecino más cercano de cada consulta (n x 3). allowed (n x grupos)
+        indica qué grupos admite cada consulta. Devuelve la distancia de
+        cuerda y el índice del punto, o inf y -1 si no hay candidato.
+        """
+        queries = np.asarray(queries, dtype=float)
+        distances = np.full(len(queries), np.inf)
+        indices = np.full(len(queries), -1, dtype=int)
+        if not len(self.leaf_index):
+            return distances, indices
+        for start in range(0, len(queries), chunk_size):
+            stop = start + chunk_size
+            chunk_allowed = None if allowed is None else allowed[start:stop]
+            distances[start:stop], indices[start:stop] = self._query_chunk(queries[start:stop], chunk_allowed)
+        return distances, indices
+
+    def _query_chunk(self, queries: np.ndarray, allowed: np.ndarray | None) -> tuple[np.ndarray, np.ndarray]:
+        n = len(queries)
+        # Los centros quedan dentro de la esfera: |q - c|² = 1 + |c|² - 2 q·c
+        squared_norms = np.einsum('ld,ld->l', self.centers, self.centers)
+        to_centers = np.sqrt(np.maximum(1 + squared_norms - 2 * queries @ self.centers.T, 0))
+        bounds = np.maximum(to_centers - self.radii, 0)
+        if allowed is not None:
+            # Hojas sin ningún punto de un grupo admitido: no se visitan
+            bounds[(allowed.astype(np.float32) @ self.leaf_groups.T.astype(np.float32)) == 0] = np.inf
+        order = np.argsort(bounds, axis=1)
+        bounds = np.take_along_axis(bounds, order, axis=1)
+        best = np.full(n, np.inf)
+        best_index = np.full(n, -1, dtype=int)
+        # Visita de hojas por cota creciente, todas las consultas a la vez:
+        # una consulta termina cuando la siguiente cota supera su mejor distancia
+        for step in range(order.shape[1]):
+            active = np.nonzero(bounds[:, step] < best)[0]
+            if not len(active):
+                break
+            candidates = self.leaf_index[order[active, step]]
+            points = self.points[candidates]
+            dots = np.einsum('ad,ald->al', queries[active], points)
+            chord = np.sqrt(np.maximum(2 - 2 * dots, 0))
+            invalid = candidates < 0
+            if allowed is not None:
+                invalid |= ~allowed[active[:, None], self.groups[candidates]]
+            chord[invalid] = np.inf
+            column = np.argmin(chord, axis=1)
+            found = chord[np.arange(len(active)), column]
+            better = found < best[active]
+            best[active[better]] = found[better]
+            best_index[active[better]] = candidates[better, column[better]]
+        return best, best_index
+
+
+def _supplier_keys(producto: dict, codes_by_key: dict) -> list:
+    # Los proveedores embebidos se identifican por _id o, si no lo tienen o
+    # no está en el índice (copias embebidas con otro _id), por nombre
+    return [p['_id'] if p.get('_id') in codes_by_key else p.get('nombre')
+            for p in producto.get('proveedores') or []]
+
+
+def _location(direccion: Any) -> tuple[float, float] | None:
+    location = direccion.get('location') if isinstance(direccion, dict) else None
+    if isinstance(location, dict) and location.get('coordinates'):
+        lon, lat = location['coordinates'][:2]
+        return float(lon), float(lat)
+    return None
+
+
+class WarehouseIndex:
+    """
+    Índice de los almacenes de Proveedor. Se construye al primer uso, se
+    marca como obsoleto cuando el ODM guarda o borra un Proveedor y, con
+    max_age, también se recarga periódicamente (cambios hechos fuera del
+    ODM, como las cargas de generator.py).
+    """
+
+    def __init__(self, proveedor_model=None, leaf_size: int = 32, max_age: float = None):
+        if proveedor_model is None:
+            from models import Proveedor as proveedor_model
+        self.model = proveedor_model
+        self.leaf_size = leaf_size
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._stale = True
+        self._loaded_at = 0.0
+        self.model.subscribe('post_save', self._invalidate)
+        self.model.subscribe('post_delete', self._invalidate)
+
+    def close(self) -> None:
+        self.model.unsubscribe('post_save', self._invalidate)
+        self.model.unsubscribe('post_delete', self._invalidate)
+
+    def _invalidate(self, model_class, instances) -> None:
+        self._stale = True
+
+    def refresh(self) -> None:
+        # Antes de leer: una escritura durante la carga vuelve a marcarlo
+        self._stale = False
+        supplier_ids, supplier_names, warehouses = [], [], []
+        codes: dict[Any, int] = {}
+        coordinates, groups = [], []
+        for doc in self.model.db.find({}, {'nombre': 1, 'direcciones_almacenes': 1}):
+            code = len(supplier_ids)
+            supplier_ids.append(doc['_id'])
+            supplier_names.append(doc.get('nombre'))
+            codes[doc['_id']] = code
+            if doc.get('nombre') is not None:
+                codes.setdefault(doc['nombre'], code)
+            for direccion in doc.get('direcciones_almacenes') or []:
+                location = _location(direccion)
+                if location is not None:
+                    coordinates.append(location)
+                    groups.append(code)
+                    warehouses.append(direccion)
+        coordinates = np.array(coordinates, dtype=float).reshape(-1, 2)
+        tree = BallTree(to_unit_vectors(coordinates[:, 0], coordinates[:, 1]),
+                        np.array(groups, dtype=int), leaf_size=self.leaf_size,
+                        group_count=len(supplier_ids))
+        # Una sola asignación: las consultas en curso siguen con el estado anterior
+        self._state = (supplier_ids, supplier_names, codes, warehouses, np.array(groups, dtype=int), tree)
+        self._loaded_at = time.monotonic()
+
+    def _needs_refresh(self) -> bool:
+        return self._stale or (self.max_age is not None and time.monotonic() - self._loaded_at > self.max_age)
+
+    def _ensure_loaded(self) -> None:
+        if self._needs_refresh():
+            with self._lock:
+                if self._needs_refresh():
+                    self.refresh()
+
+    def __len__(self) -> int:
+        self._ensure_loaded()
+        return len(self._state[3])
+
+    @staticmethod
+    def _eligible(compra: dict, codes_by_key: dict, require_all: bool) -> set[int]:
+        suppliers = None
+        for producto in compra.get('productos') or []:
+            codes = {codes_by_key[key] for key in _supplier_keys(producto, codes_by_key) if key in codes_by_key}
+            if suppliers is None:
+                suppliers = codes
+            elif require_all:
+                suppliers &= codes
+            else:
+                suppliers |= codes
+        return suppliers or set()
+
+    def assign(self, compras: Iterable[Any], require_all: bool = True) -> list[dict | None]:
+        """
+        Almacén más cercano a direccion_envio de cada compra (instancias de
+        Compra o documentos) entre los de proveedores que sirven todos sus
+        productos (con require_all=False, alguno de ellos). Devuelve, en el
+        mismo orden, None o un dict con compra, proveedor, almacen y
+        distancia_km.
+        """
+        self._ensure_loaded()
+        supplier_ids, supplier_names, codes_by_key, warehouses, groups, tree = self._state
+        compras = [c.to_dict() if hasattr(c, 'to_dict') else c for c in compras]
+        coordinates = np.full((len(compras), 2), np.nan)
+        allowed = np.zeros((len(compras), len(supplier_ids)), dtype=bool)
+        for i, compra in enumerate(compras):
+            location = _location(compra.get('direccion_envio'))
+            if location is None:
+                continue
+            coordinates[i] = location
+            allowed[i, list(self._eligible(compra, codes_by_key, require_all))] = True
+
+        located = ~np.isnan(coordinates[:, 0])
+        chord = np.full(len(compras), np.inf)
+        nearest = np.full(len(compras), -1, dtype=int)
+        if located.any():
+            chord[located], nearest[located] = tree.query(
+                to_unit_vectors(coordinates[located, 0], coordinates[located, 1]), allowed[located])
+        distances = chord_to_km(np.where(np.isfinite(chord), chord, 0))
+
+        results = []
+        for i, compra in enumerate(compras):
+            if nearest[i] < 0:
+                results.append(None)
+                continue
+            code = groups[nearest[i]]
+            results.append({'compra': compra.get('_id'), 'proveedor': supplier_ids[code],
+                            'proveedor_nombre': supplier_names[code], 'almacen': warehouses[nearest[i]],
+                            'distancia_km': float(distances[i])})
+        return results
+
+    def assign_compras(self, filter: dict = None, compra_model=None, batch_size: int = 5000,
+                       require_all: bool = True) -> Iterator[dict | None]:
+        # Recorre las compras del filtro (p.ej. las de un día) leyendo solo
+        # la ubicación y los proveedores, y las asigna por lotes
+        if compra_model is None:
+            from models import Compra as compra_model
+        projection = {'direccion_envio.location': 1, 'productos.proveedores._id': 1,
+                      'productos.proveedores.nombre': 1}
+        batch = []
+        for doc in compra_model.db.find(filter or {}, projection, batch_size=batch_size):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                yield from self.assign(batch, require_all)
+                batch = []
+        if batch:
+            yield from self.assign(batch, require_all)
+
+
+def nearest_warehouses(compras: Iterable[Any], require_all: bool = True) -> list[dict | None]:
+    # Atajo para una asignación puntual (sin reutilizar el índice)
+    index = WarehouseIndex()
+    try:
+        return index.assign(compras, require_all)
+    finally:
+        index.close()